@@ -11,6 +11,11 @@ class BaseClient(abc.ABC):
     def __init_client__(self, *args, **kwargs):
         ...
 
+    def close(self) -> None:
+        """
+        Release connections held by the client.
+        """
+
 
 class ForecastBaseClient(BaseClient):
     @abc.abstractmethod
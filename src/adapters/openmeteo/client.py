@@ -1,7 +1,7 @@
 import datetime
 import os
 from http import HTTPStatus
-from typing import Iterable
+from typing import Iterable, Sequence
 
 import requests
 
@@ -11,14 +11,23 @@ from adapters.models import ForecastBaseClient
 class OpenMeteoClient(ForecastBaseClient):
     base_url: str
     archive_base_url: str
+    #: Seconds to wait for the server before giving up.
+    timeout: float
 
     def __init_client__(
         self,
         base_url=os.environ["OPENMETEO_API_URL"],
         archive_base_url=os.environ["OPENMETEO_ARCHIVE_API_URL"],
+        timeout=30,
     ):
         self.base_url = base_url
         self.archive_base_url = archive_base_url
+        self.timeout = timeout
+        # Reuses connections across calls of a long-lived client.
+        self.session = requests.Session()
+
+    def close(self) -> None:
+        self.session.close()
 
     def get_forecast_data(
         self, lon: str, lat: str, target_timestamp: datetime.datetime, params: Iterable, model: str
@@ -31,11 +40,46 @@ class OpenMeteoClient(ForecastBaseClient):
             ("models", str(model)),
             ("windspeed_unit", "kn"),
         )
-        response = requests.get(self.base_url, params=query_params)
+        response = self.session.get(self.base_url, params=query_params, timeout=self.timeout)
         if response.status_code != HTTPStatus.OK:
             raise Exception(f"External call failed. Msg: {response.status_code} - {response.text}")
         return response.json()["hourly"]
 
+    def get_forecast_points_data(
+        self,
+        lons: Sequence[float],
+        lats: Sequence[float],
+        params: Iterable,
+        model: str,
+        max_points_per_request: int = 100,
+    ) -> list[dict]:
+        """
+        Hourly forecast of many points, in the order of the given coordinates.
+        """
+        params = list(params)
+        points_data = []
+        for start in range(0, len(lats), max_points_per_request):
+            stop = start + max_points_per_request
+            query_params = (
+                ("latitude", ",".join(str(lat) for lat in lats[start:stop])),
+                ("longitude", ",".join(str(lon) for lon in lons[start:stop])),
+                ("forecast_days", 7),
+                ("hourly", ",".join(params)),
+                ("models", str(model)),
+                ("windspeed_unit", "kn"),
+            )
+            response = self.session.get(self.base_url, params=query_params, timeout=self.timeout)
+            if response.status_code != HTTPStatus.OK:
+                raise Exception(
+                    f"External call failed. Msg: {response.status_code} - {response.text}"
+                )
+            data = response.json()
+            # A single point is returned as an object, many points as a list.
+            points_data += [
+                point["hourly"] for point in (data if isinstance(data, list) else [data])
+            ]
+        return points_data
+
     def get_historical_data(
         self,
         lon: str,
@@ -54,7 +98,7 @@ class OpenMeteoClient(ForecastBaseClient):
             ("models", str(model)),
             ("windspeed_unit", "kn"),
         )
-        response = requests.get(self.base_url, params=query_params)
+        response = self.session.get(self.base_url, params=query_params, timeout=self.timeout)
         if response.status_code != HTTPStatus.OK:
             raise Exception(f"External call failed. Msg: {response.status_code} - {response.text}")
         return response.json()["hourly"]
@@ -14,23 +14,34 @@ class WindyComClient(ForecastBaseClient):
     base_url: str
     user: str
     password: str
+    #: Seconds to wait for the server before giving up.
+    timeout: float
 
-    def __init_client__(self, user, password, base_url=os.environ["METEOMATICS_API_URL"]):
+    def __init_client__(
+        self, user, password, base_url=os.environ["METEOMATICS_API_URL"], timeout=30
+    ):
         self.base_url = base_url
+        self.timeout = timeout
+        # Reuses connections across calls of a long-lived client.
+        self.session = requests.Session()
         # this is not safe
         self.user = user
         self.password = password
 
+    def close(self) -> None:
+        self.session.close()
+
     def get_forecast_data(
         self, lon: str, lat: str, target_timestamp: datetime.datetime, params: list, model: str
     ) -> dict:
         query_params = {"model": model}
         date = str(target_timestamp.date())
         path = f"{self.base_url}/{date}T00:00:00Z/{','.join(params)}/{lon},{lat}/json"
-        response = requests.get(
+        response = self.session.get(
             path,
             auth=HTTPBasicAuth(self.user, self.password),
             params=query_params,
+            timeout=self.timeout,
         )
         if response.status_code != HTTPStatus.OK:
             raise Exception(
@@ -38,3 +49,37 @@ class WindyComClient(ForecastBaseClient):
             )
 
         return response.json()["data"][0]["coordinates"][0]["dates"][0]["value"]
+
+    def get_forecast_grid_data(
+        self,
+        lat_min: float,
+        lat_max: float,
+        lon_min: float,
+        lon_max: float,
+        n_lats: int,
+        n_lons: int,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        params: list,
+        model: str,
+    ) -> list[dict]:
+        """
+        Hourly values on a regular n_lats x n_lons grid, one entry per param with
+        the `coordinates` list of every grid point.
+        """
+        query_params = {"model": model}
+        time_range = f"{start:%Y-%m-%dT%H:%M:%SZ}--{end:%Y-%m-%dT%H:%M:%SZ}:PT1H"
+        grid = f"{lat_max},{lon_min}_{lat_min},{lon_max}:{n_lats}x{n_lons}"
+        path = f"{self.base_url}/{time_range}/{','.join(params)}/{grid}/json"
+        response = self.session.get(
+            path,
+            auth=HTTPBasicAuth(self.user, self.password),
+            params=query_params,
+            timeout=self.timeout,
+        )
+        if response.status_code != HTTPStatus.OK:
+            raise Exception(
+                f"External call failed. Msg: {response.status_code} - {response.text} {path}"
+            )
+
+        return response.json()["data"]
@@ -0,0 +1,196 @@
+"""
+Alignment of weather series onto a shared UTC time grid.
+
+Providers return data on different time grids, some with naive timestamps
+(always assumed to be UTC) and some timezone-aware. Everything here works on
+whole arrays: one searchsorted per series and matrix operations over all of its
+columns. Circular params (wind direction) are interpolated and averaged through
+their sin/cos components.
+"""
+import dataclasses
+from datetime import datetime, timedelta
+from typing import Optional, Sequence, TypeVar, Union
+
+import numpy as np
+import pandas as pd
+
+from domain.models import WeatherData, WeatherParams
+from domain.schema import is_circular
+
+WeatherDataT = TypeVar("WeatherDataT", bound=WeatherData)
+
+INTERPOLATE = "interpolate"
+MEAN = "mean"
+
+
+def to_utc(index: pd.Index) -> pd.DatetimeIndex:
+    """
+    Convert index to a UTC DatetimeIndex, treating naive timestamps as UTC.
+    """
+    index = pd.DatetimeIndex(index)
+    if index.tz is None:
+        return index.tz_localize("UTC")
+    return index.tz_convert("UTC")
+
+
+def naive_utc(timestamp: Union[datetime, pd.Timestamp]) -> datetime:
+    """
+    timestamp in UTC without timezone, treating naive timestamps as UTC.
+    """
+    return to_utc(pd.DatetimeIndex([timestamp]))[0].tz_localize(None).to_pydatetime()
+
+
+def make_grid(
+    start: Union[datetime, pd.Timestamp],
+    end: Union[datetime, pd.Timestamp],
+    freq: str = "1H",
+) -> pd.DatetimeIndex:
+    """
+    Regular UTC grid covering [start, end], snapped to multiples of freq.
+    """
+    start, end = to_utc(pd.DatetimeIndex([start, end]))
+    return pd.date_range(start.floor(freq), end.ceil(freq), freq=freq, name=WeatherParams.TIMESTAMP)
+
+
+def _to_angles(values: np.ndarray, circular: np.ndarray) -> np.ndarray:
+    """
+    Replace each circular column with its sin and cos columns appended at the end.
+    """
+    radians = np.radians(values[:, circular])
+    return np.hstack([values[:, ~circular], np.sin(radians), np.cos(radians)])
+
+
+def _from_angles(values: np.ndarray, circular: np.ndarray) -> np.ndarray:
+    n_circular = int(circular.sum())
+    n_linear = values.shape[1] - 2 * n_circular
+    result = np.empty((values.shape[0], len(circular)))
+    result[:, ~circular] = values[:, :n_linear]
+    split = n_linear + n_circular
+    sin, cos = values[:, n_linear:split], values[:, split:]
+    result[:, circular] = np.degrees(np.arctan2(sin, cos)) % 360
+    return result
+
+
+def _interpolate(
+    source: np.ndarray, values: np.ndarray, grid: np.ndarray, max_gap: Optional[int]
+) -> np.ndarray:
+    right = np.clip(np.searchsorted(source, grid, side="left"), 1, len(source) - 1)
+    left = right - 1
+    span = source[right] - source[left]
+    weight = ((grid - source[left]) / np.where(span == 0, 1, span))[:, None]
+
+    # Blend only finite neighbours, so a NaN with zero weight doesn't hide an exact hit.
+    finite = np.isfinite(values[left]) & np.isfinite(values[right])
+    with np.errstate(invalid="ignore"):
+        blended = values[left] * (1 - weight) + values[right] * weight
+    result = np.where(finite, blended, np.nan)
+    on_left, on_right = grid == source[left], grid == source[right]
+    result = np.where(on_left[:, None], values[left], result)
+    result = np.where(on_right[:, None], values[right], result)
+
+    invalid = (grid < source[0]) | (grid > source[-1])
+    if max_gap is not None:
+        invalid |= (span > max_gap) & ~on_left & ~on_right
+    result[invalid] = np.nan
+    return result
+
+
+def _bucket_mean(source: np.ndarray, values: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """
+    Mean of source rows in [grid[i], grid[i + 1]); the last bucket is as wide as the previous.
+    """
+    step = grid[-1] - grid[-2] if len(grid) > 1 else 1
+    bucket = np.searchsorted(grid, source, side="right") - 1
+    inside = (bucket >= 0) & (source < grid[-1] + step)
+    bucket, values = bucket[inside], values[inside]
+
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    n_rows, n_columns = len(grid), values.shape[1]
+    flat = (bucket[:, None] * n_columns + np.arange(n_columns)).ravel()
+    sums = np.bincount(flat, weights=filled.ravel(), minlength=n_rows * n_columns)
+    counts = np.bincount(flat, weights=valid.ravel(), minlength=n_rows * n_columns)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (sums / counts).reshape(n_rows, n_columns)
+
+
+def align_frame(
+    data: pd.DataFrame,
+    grid: pd.DatetimeIndex,
+    method: str = INTERPOLATE,
+    max_gap: Optional[timedelta] = None,
+) -> pd.DataFrame:
+    """
+    Put numeric columns of data onto grid.
+
+    `interpolate` linearly interpolates between neighbouring rows (no further apart
+    than max_gap), `mean` averages all rows falling into each grid step. Grid points
+    outside the data or without rows are NaN.
+    """
+    if isinstance(data.index, pd.MultiIndex):
+        raise Exception("Only data indexed by timestamp can be aligned.")
+
+    data = data.select_dtypes("number")
+    index = to_utc(data.index)
+    order = np.argsort(index.asi8, kind="stable")
+    source = index.asi8[order]
+    keep = np.append(source[1:] != source[:-1], True)
+    source = source[keep]
+    values = data.to_numpy(dtype="float64")[order][keep]
+
+    grid = to_utc(grid)
+    result = np.full((len(grid), data.shape[1]), np.nan)
+    if len(source) == 0 or len(grid) == 0:
+        return pd.DataFrame(result, index=grid, columns=data.columns)
+
+    circular = np.array([is_circular(column) for column in data.columns], dtype=bool)
+    values = _to_angles(values, circular)
+
+    if method == INTERPOLATE:
+        if len(source) == 1:
+            aligned = np.where((grid.asi8 == source[0])[:, None], values, np.nan)
+        else:
+            gap = None if max_gap is None else pd.Timedelta(max_gap).value
+            aligned = _interpolate(source, values, grid.asi8, gap)
+    elif method == MEAN:
+        aligned = _bucket_mean(source, values, grid.asi8)
+    else:
+        raise Exception(f"Unknown alignment method: {method}.")
+
+    result = _from_angles(aligned, circular)
+    return pd.DataFrame(result, index=grid, columns=data.columns)
+
+
+def align(
+    weather_data: WeatherDataT,
+    grid: pd.DatetimeIndex,
+    method: str = INTERPOLATE,
+    max_gap: Optional[timedelta] = None,
+) -> WeatherDataT:
+    """
+    Copy of weather_data (WeatherData or Forecast) with its data put onto grid.
+    """
+    data = align_frame(weather_data.data, grid, method=method, max_gap=max_gap)
+    return dataclasses.replace(weather_data, data=data)
+
+
+def align_many(
+    items: Sequence[WeatherData],
+    grid: pd.DatetimeIndex,
+    params: Sequence[WeatherParams],
+    method: str = INTERPOLATE,
+    max_gap: Optional[timedelta] = None,
+) -> np.ndarray:
+    """
+    Stack items onto grid as an array of shape (len(items), len(grid), len(params)).
+
+    Params missing from an item are NaN.
+    """
+    result = np.full((len(items), len(grid), len(params)), np.nan)
+    for position, item in enumerate(items):
+        columns = [param for param in params if param in item.data.columns]
+        if not columns:
+            continue
+        aligned = align_frame(item.data[columns], grid, method=method, max_gap=max_gap)
+        result[position] = aligned.reindex(columns=list(params)).to_numpy()
+    return result
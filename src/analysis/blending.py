@@ -0,0 +1,264 @@
+"""
+Skill-weighted blending of several forecast models into one consensus forecast.
+
+Past errors of every (spot, model) are binned by lead time into a mean squared
+error table. Blending stacks the forecasts of all spots and models into one
+(spots, models, time, params) array and weights each model by its inverse MSE at
+the matching spot and lead time. Alongside the weighted mean it returns the
+weighted spread between models and an uncertainty combining the spread with the
+expected error of the blend. Circular params are blended through sin/cos.
+"""
+from dataclasses import dataclass
+from typing import Hashable, Mapping, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from analysis.alignment import align_frame, align_many, make_grid, to_utc
+from domain.models import Forecast, ForecastModels, WeatherData, WeatherParams
+from domain.schema import is_circular
+from services.cache import ForecastCache
+
+#: Lead time bins in hours; the last bin is open ended.
+DEFAULT_LEAD_EDGES = (0, 6, 12, 24, 48, 72, 120, 168)
+
+SPREAD_SUFFIX = "_spread"
+UNCERTAINTY_SUFFIX = "_uncertainty"
+
+
+def lead_hours(index: pd.DatetimeIndex, issued_at) -> np.ndarray:
+    return (to_utc(index).asi8 - to_utc(pd.DatetimeIndex([issued_at])).asi8[0]) / 3.6e12
+
+
+def lead_bins(leads: np.ndarray, edges: Sequence[float]) -> np.ndarray:
+    """
+    Bin of each lead time; leads before the first edge fall into the first bin.
+    """
+    return np.clip(np.searchsorted(edges, leads, side="right") - 1, 0, len(edges) - 1)
+
+
+def _errors(forecasts: np.ndarray, observations: np.ndarray, circular: np.ndarray) -> np.ndarray:
+    errors = forecasts - observations
+    errors[..., circular] = (errors[..., circular] + 180) % 360 - 180
+    return errors
+
+
+@dataclass
+class BlendWeights:
+    locations: list[str]
+    members: list[Hashable]
+    params: list[WeatherParams]
+    lead_edges: tuple
+    #: Mean squared errors of shape (locations, members, lead bins, params), NaN if unknown.
+    mse: np.ndarray
+
+    @classmethod
+    def fit(
+        cls,
+        history: Mapping[tuple[str, Hashable], Sequence[Forecast]],
+        observations: Mapping[str, WeatherData],
+        params: Sequence[WeatherParams],
+        lead_edges: Sequence[float] = DEFAULT_LEAD_EDGES,
+        min_count: int = 3,
+    ) -> "BlendWeights":
+        """
+        Estimate errors from past forecasts per (location name, member) against the
+        observations of their location. Bins with fewer than min_count errors stay unknown.
+        """
+        params = list(params)
+        locations = list(dict.fromkeys(location for location, _ in history))
+        members = list(dict.fromkeys(member for _, member in history))
+        circular = np.array([is_circular(param) for param in params], dtype=bool)
+
+        shape = (len(locations), len(members), len(lead_edges), len(params))
+        sums, counts = np.zeros(shape), np.zeros(shape)
+        for (location, member), forecasts in history.items():
+            if location not in observations:
+                continue
+            observed = observations[location].data
+            position = locations.index(location), members.index(member)
+            for forecast in forecasts:
+                columns = [param for param in params if param in forecast.data.columns]
+                if not columns:
+                    continue
+                index = to_utc(forecast.data.index)
+                predicted = forecast.data.reindex(columns=params).to_numpy(dtype="float64")
+                actual = align_frame(observed.reindex(columns=params), index).to_numpy()
+                errors = _errors(predicted, actual, circular)
+                valid = ~np.isnan(errors)
+
+                bins = lead_bins(lead_hours(index, forecast.created_at), lead_edges)
+                np.add.at(sums[position], bins, np.where(valid, errors**2, 0.0))
+                np.add.at(counts[position], bins, valid)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mse = np.where(counts >= min_count, sums / counts, np.nan)
+        return cls(locations, members, params, tuple(lead_edges), mse)
+
+    def lookup(
+        self,
+        locations: Sequence[str],
+        members: Sequence[Hashable],
+        params: Sequence[WeatherParams],
+        leads: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Errors for leads of shape (locations, members, time), as (locations, members, time, params).
+
+        Locations, members or params without history are unknown (NaN).
+        """
+        location_rows = np.array([self._position(self.locations, name) for name in locations])
+        member_rows = np.array([self._position(self.members, member) for member in members])
+        param_columns = np.array([self._position(self.params, param) for param in params])
+        bins = lead_bins(leads, self.lead_edges)
+
+        padded = np.full(np.add(self.mse.shape, (1, 1, 0, 1)), np.nan)
+        padded[:-1, :-1, :, :-1] = self.mse
+        selected = padded[location_rows[:, None, None], member_rows[None, :, None], bins]
+        return selected[..., param_columns]
+
+    @staticmethod
+    def _position(values: list, value) -> int:
+        return values.index(value) if value in values else -1
+
+
+def blend_arrays(
+    values: np.ndarray, mse: np.ndarray, circular: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Blend values of shape (spots, members, time, params) with inverse-MSE weights.
+
+    Members with unknown MSE get the weight of the worst known member at that point,
+    points without any known MSE are blended with equal weights. Returns the weighted
+    mean, spread and uncertainty, each of shape (spots, time, params).
+    """
+    available = ~np.isnan(values)
+    known = available & np.isfinite(mse) & (mse > 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        inverse = np.where(known, 1 / np.where(known, mse, 1.0), np.nan)
+        fallback = np.where(known, inverse, np.inf).min(axis=1, keepdims=True)
+    fallback = np.where(np.isinf(fallback), 1.0, fallback)
+    weights = np.where(known, inverse, fallback) * available
+    total = weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weights = weights / total[:, None]
+    filled = np.where(available, values, 0.0)
+
+    mean = (weights * filled).sum(axis=1)
+    spread = np.sqrt((weights * (filled - mean[:, None]) ** 2).sum(axis=1))
+    if circular.any():
+        radians = np.radians(filled[..., circular])
+        weighted = weights[..., circular]
+        sin = (weighted * np.sin(radians)).sum(axis=1)
+        cos = (weighted * np.cos(radians)).sum(axis=1)
+        mean[..., circular] = np.degrees(np.arctan2(sin, cos)) % 360
+        resultant = np.clip(np.hypot(sin, cos), 1e-12, 1.0)
+        spread[..., circular] = np.degrees(np.sqrt(-2 * np.log(resultant)))
+
+    # Expected error variance of an inverse-variance weighted blend of independent members.
+    with np.errstate(invalid="ignore", divide="ignore"):
+        expected = 1 / np.where(known, inverse, 0.0).sum(axis=1)
+    uncertainty = np.sqrt(spread**2 + np.where(np.isfinite(expected), expected, 0.0))
+
+    empty = total == 0
+    for result in (mean, spread, uncertainty):
+        result[empty] = np.nan
+    return mean, spread, uncertainty
+
+
+class EnsembleBlender:
+    """
+    Blends forecasts of many spots at once and caches each spot's blend for the
+    model runs it was made from, so it is computed once per run.
+    """
+
+    def __init__(
+        self,
+        weights: BlendWeights,
+        params: Optional[Sequence[WeatherParams]] = None,
+        freq: str = "1H",
+        cache: Optional[ForecastCache] = None,
+    ):
+        self.weights = weights
+        self.params = list(params or weights.params)
+        self.freq = freq
+        self.cache = cache if cache is not None else ForecastCache(max_size=1_000)
+
+    @staticmethod
+    def _cache_key(location: str, runs: Mapping[Hashable, Forecast]) -> tuple:
+        members = sorted((str(member), forecast.created_at) for member, forecast in runs.items())
+        return "blend", location, tuple(members)
+
+    def blend(self, forecasts: Mapping[tuple[str, Hashable], Forecast]) -> dict[str, Forecast]:
+        """
+        Blended forecast per location name from forecasts per (location name, member).
+
+        Data holds the blended params plus `<param>_spread` and `<param>_uncertainty`.
+        """
+        runs: dict[str, dict[Hashable, Forecast]] = {}
+        for (location, member), forecast in forecasts.items():
+            runs.setdefault(location, {})[member] = forecast
+
+        blended, pending = {}, []
+        for location, members in runs.items():
+            entry = self.cache.get(self._cache_key(location, members))
+            if entry is not None:
+                blended[location] = entry.forecast
+            else:
+                pending.append(location)
+
+        if pending:
+            for location, forecast in self._blend(pending, runs).items():
+                blended[location] = forecast
+                self.cache.put(self._cache_key(location, runs[location]), forecast)
+        return blended
+
+    def _blend(
+        self, locations: list[str], runs: Mapping[str, Mapping[Hashable, Forecast]]
+    ) -> dict[str, Forecast]:
+        members = list(dict.fromkeys(member for name in locations for member in runs[name]))
+        items = [runs[name].get(member) for name in locations for member in members]
+        present = [item for item in items if item is not None]
+        grid = make_grid(
+            min(to_utc(item.data.index).min() for item in present),
+            max(to_utc(item.data.index).max() for item in present),
+            freq=self.freq,
+        )
+
+        values = np.full((len(items), len(grid), len(self.params)), np.nan)
+        rows = [position for position, item in enumerate(items) if item is not None]
+        values[rows] = align_many(present, grid, self.params)
+        values = values.reshape(len(locations), len(members), len(grid), len(self.params))
+
+        issued = np.full(len(items), np.nan)
+        issued[rows] = to_utc(pd.DatetimeIndex([item.created_at for item in present])).asi8
+        leads = (grid.asi8[None, :] - issued[:, None]) / 3.6e12
+        leads = np.nan_to_num(leads.reshape(len(locations), len(members), len(grid)))
+
+        circular = np.array([is_circular(param) for param in self.params], dtype=bool)
+        mse = self.weights.lookup(locations, members, self.params, leads)
+        mean, spread, uncertainty = blend_arrays(values, mse, circular)
+
+        columns = (
+            self.params
+            + [f"{param.value}{SPREAD_SUFFIX}" for param in self.params]
+            + [f"{param.value}{UNCERTAINTY_SUFFIX}" for param in self.params]
+        )
+        result = {}
+        for position, name in enumerate(locations):
+            data = pd.DataFrame(
+                np.hstack([mean[position], spread[position], uncertainty[position]]),
+                index=grid,
+                columns=columns,
+            )
+            data = data[~np.isnan(mean[position]).all(axis=1)]
+            first = next(iter(runs[name].values()))
+            created_at = max(forecast.created_at for forecast in runs[name].values())
+            result[name] = Forecast(
+                data=data,
+                location=first.location,
+                created_at=created_at,
+                valid_at=created_at,
+                weather_model=ForecastModels.BLEND,
+            )
+        return result
@@ -0,0 +1,57 @@
+"""
+Shape-preserving downsampling of long series for plotting.
+
+`min_max_indices` returns positions of the points to keep, so any number of
+columns can be reduced along with the plotted one. It keeps the first, last,
+lowest and highest point of every x bucket of every series in one vectorized
+pass; peaks such as gusts always survive. Largest-Triangle-Three-Buckets is not
+offered: each of its buckets depends on the point chosen in the previous one, so
+it can't be vectorized and would loop in Python once per bucket.
+"""
+from typing import Optional
+
+import numpy as np
+
+
+def _group_bounds(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    First and last position of every run of equal values in sorted keys.
+    """
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+    ends = np.append(starts[1:] - 1, len(keys) - 1)
+    return starts, ends
+
+
+def min_max_indices(
+    x: np.ndarray, y: np.ndarray, n_buckets: int, series: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Sorted positions of the first, last, min and max point of n_buckets equal-width
+    x buckets of every series, at most 4 * n_buckets points per series.
+
+    Points where x or y is NaN are dropped.
+    """
+    x, y = np.asarray(x, dtype="float64"), np.asarray(y, dtype="float64")
+    if series is None:
+        series = np.zeros(len(x), dtype=np.int64)
+    else:
+        series = np.unique(np.asarray(series), return_inverse=True)[1]
+
+    positions = np.flatnonzero(~np.isnan(x) & ~np.isnan(y))
+    if len(positions) == 0:
+        return positions
+    x, y, series = x[positions], y[positions], series[positions]
+
+    n_series = int(series.max()) + 1
+    low, high = np.full(n_series, np.inf), np.full(n_series, -np.inf)
+    np.minimum.at(low, series, x)
+    np.maximum.at(high, series, x)
+    span = np.where(high > low, high - low, 1.0)
+    bucket = ((x - low[series]) / span[series] * n_buckets).astype(np.int64)
+    key = series * n_buckets + np.minimum(bucket, n_buckets - 1)
+
+    by_x = np.lexsort((x, key))
+    by_y = np.lexsort((y, key))
+    starts, ends = _group_bounds(key[by_x])
+    keep = np.concatenate([by_x[starts], by_x[ends], by_y[starts], by_y[ends]])
+    return positions[np.unique(keep)]
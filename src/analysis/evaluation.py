@@ -0,0 +1,167 @@
+"""
+Scoring of forecast models against observations across many locations.
+
+Forecasts and observations are aligned onto a common grid and stacked into two
+arrays placed in shared memory. Worker processes attach to them by name and
+score contiguous blocks of (location, model) series, so no data is pickled on
+the way to the workers; only the small metric arrays come back.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+from analysis.alignment import align_many
+from domain.models import Forecast, ForecastModels, WeatherData, WeatherParams
+from domain.schema import is_circular
+
+METRICS = ("count", "bias", "mae", "rmse")
+
+#: Forecast values below which scoring stays in-process; starting a pool costs more.
+PARALLEL_MIN_VALUES = 1_000_000
+
+#: Arrays attached by a worker process, by name.
+_worker_arrays: dict[str, np.ndarray] = {}
+_worker_memory: list[shared_memory.SharedMemory] = []
+
+
+@dataclass(frozen=True)
+class SharedArraySpec:
+    name: str
+    shape: tuple
+    dtype: str
+
+
+class SharedArray:
+    """
+    Numpy array backed by a shared memory block owned by this process.
+    """
+
+    def __init__(self, array: np.ndarray):
+        self._memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array: np.ndarray = np.ndarray(array.shape, array.dtype, buffer=self._memory.buf)
+        self.array[...] = array
+        self.spec = SharedArraySpec(self._memory.name, array.shape, array.dtype.str)
+
+    def release(self) -> None:
+        del self.array
+        self._memory.close()
+        self._memory.unlink()
+
+
+def _attach(specs: Mapping[str, SharedArraySpec]) -> None:
+    for key, spec in specs.items():
+        memory = shared_memory.SharedMemory(name=spec.name)
+        _worker_memory.append(memory)
+        _worker_arrays[key] = np.ndarray(spec.shape, np.dtype(spec.dtype), buffer=memory.buf)
+
+
+def _score(forecasts: np.ndarray, observations: np.ndarray, circular: bool) -> np.ndarray:
+    """
+    Metrics of every forecast row against the matching observation row, shape (rows, METRICS).
+    """
+    errors = forecasts - observations
+    if circular:
+        errors = (errors + 180) % 360 - 180
+    valid = ~np.isnan(errors)
+    count = valid.sum(axis=1)
+    errors = np.where(valid, errors, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bias = errors.sum(axis=1) / count
+        mae = np.abs(errors).sum(axis=1) / count
+        rmse = np.sqrt((errors**2).sum(axis=1) / count)
+    return np.column_stack([count, bias, mae, rmse])
+
+
+def _score_block(start: int, stop: int, circular: bool) -> tuple[int, np.ndarray]:
+    forecasts = _worker_arrays["forecasts"][start:stop]
+    observations = _worker_arrays["observations"][_worker_arrays["observation_rows"][start:stop]]
+    return start, _score(forecasts, observations, circular)
+
+
+def score_arrays(
+    forecasts: np.ndarray,
+    observations: np.ndarray,
+    observation_rows: np.ndarray,
+    circular: bool = False,
+    n_workers: Optional[int] = 1,
+    block_size: Optional[int] = None,
+    min_parallel_values: int = PARALLEL_MIN_VALUES,
+) -> np.ndarray:
+    """
+    Score forecasts (series, time) against observations (locations, time), where
+    forecast series i is compared with observations[observation_rows[i]].
+
+    Scoring runs in-process unless n_workers is above 1 (None for every CPU) and
+    forecasts hold at least min_parallel_values values.
+
+    Returns an array of shape (series, len(METRICS)).
+    """
+    n_series = len(forecasts)
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or n_series <= 1 or forecasts.size < min_parallel_values:
+        return _score(forecasts, observations[observation_rows], circular)
+
+    block_size = block_size or max(1, -(-n_series // (n_workers * 4)))
+    shared = {
+        "forecasts": SharedArray(np.ascontiguousarray(forecasts, dtype="float64")),
+        "observations": SharedArray(np.ascontiguousarray(observations, dtype="float64")),
+        "observation_rows": SharedArray(np.asarray(observation_rows, dtype="int64")),
+    }
+    result = np.empty((n_series, len(METRICS)))
+    try:
+        specs = {key: array.spec for key, array in shared.items()}
+        with ProcessPoolExecutor(n_workers, initializer=_attach, initargs=(specs,)) as pool:
+            blocks = [
+                pool.submit(_score_block, start, min(start + block_size, n_series), circular)
+                for start in range(0, n_series, block_size)
+            ]
+            for block in blocks:
+                start, scores = block.result()
+                stop = start + len(scores)
+                result[start:stop] = scores
+    finally:
+        for array in shared.values():
+            array.release()
+    return result
+
+
+def evaluate_models(
+    observations: Mapping[str, WeatherData],
+    forecasts: Mapping[tuple[str, ForecastModels], Forecast],
+    grid: pd.DatetimeIndex,
+    param: WeatherParams,
+    n_workers: Optional[int] = 1,
+    min_parallel_values: int = PARALLEL_MIN_VALUES,
+) -> pd.DataFrame:
+    """
+    Score every (location name, model) forecast against the observations of its location.
+    Batch callers opt in to worker processes with n_workers, see score_arrays.
+
+    Returns a metrics table with one row per (location, model).
+    """
+    locations = list(observations)
+    keys = [key for key in forecasts if key[0] in observations]
+    rows = {location: row for row, location in enumerate(locations)}
+    observation_rows = np.array([rows[location] for location, _ in keys], dtype=int)
+
+    observed = align_many([observations[location] for location in locations], grid, [param])
+    forecasted = align_many([forecasts[key] for key in keys], grid, [param])
+    scores = score_arrays(
+        forecasted[:, :, 0],
+        observed[:, :, 0],
+        observation_rows,
+        circular=is_circular(param),
+        n_workers=n_workers,
+        min_parallel_values=min_parallel_values,
+    )
+
+    metrics = pd.DataFrame(scores, columns=list(METRICS))
+    metrics["count"] = metrics["count"].astype(int)
+    metrics.insert(0, "location", [location for location, _ in keys])
+    metrics.insert(1, "weather_model", [model.value for _, model in keys])
+    return metrics
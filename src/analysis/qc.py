@@ -0,0 +1,278 @@
+"""
+Quality control of hourly observations.
+
+Observations of many stations are placed onto one regular grid as a
+(stations, time, params) array and every check runs as a vectorized pass over
+the whole array. Each value gets a bit mask of QCFlags. Values failing the range,
+spike, step or stuck checks are removed and gaps up to max_gap steps long are
+filled by linear interpolation, through sin/cos for circular params.
+"""
+import enum
+from dataclasses import dataclass
+from typing import Mapping, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from analysis.alignment import make_grid, to_utc
+from analysis.windows import find_runs
+from domain.models import WeatherData, WeatherParams
+from domain.schema import CANONICAL_SCHEMA, is_circular
+
+
+class QCFlags(enum.IntFlag):
+    OUT_OF_RANGE = 1
+    SPIKE = 2
+    STEP = 4
+    STUCK = 8
+    #: Other rows with the same timestamp were dropped.
+    DUPLICATE = 16
+    MISSING = 32
+    GAP_FILLED = 64
+
+
+#: Flags of values that are removed.
+REJECTED = QCFlags.OUT_OF_RANGE | QCFlags.SPIKE | QCFlags.STEP | QCFlags.STUCK
+
+
+@dataclass(frozen=True)
+class QCLimits:
+    """
+    Limits of a param in canonical units per grid step; the valid range comes
+    from CANONICAL_SCHEMA.
+    """
+
+    #: Largest plausible change from one step to the next.
+    max_step: float = np.inf
+    #: Smallest departure from both neighbours, in the same direction, that makes a spike.
+    spike: float = np.inf
+    #: Steps of an unchanged value after which the sensor counts as stuck; None disables.
+    stuck_steps: Optional[int] = None
+    #: Value that may legitimately stay unchanged, e.g. calm wind.
+    stuck_ignore: Optional[float] = None
+
+
+DEFAULT_LIMITS: dict[WeatherParams, QCLimits] = {
+    WeatherParams.TEMPERATURE: QCLimits(max_step=8.0, spike=5.0, stuck_steps=12),
+    WeatherParams.WIND_SPEED: QCLimits(max_step=30.0, spike=20.0, stuck_steps=12, stuck_ignore=0.0),
+    # Direction may turn any amount within an hour.
+    WeatherParams.WIND_DIRECTION: QCLimits(stuck_steps=24),
+    WeatherParams.WIND_GUSTS: QCLimits(max_step=50.0, spike=35.0, stuck_steps=12, stuck_ignore=0.0),
+}
+
+
+def to_grid(
+    frames: Sequence[pd.DataFrame], grid: pd.DatetimeIndex, params: Sequence[WeatherParams]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Place frames exactly onto grid as an array (frames, time, params), keeping the
+    first of duplicated timestamps. Rows off the grid are dropped.
+
+    Also returns the (frames, time) mask of grid steps that had duplicates.
+    """
+    values = np.full((len(frames), len(grid), len(params)), np.nan)
+    duplicated = np.zeros((len(frames), len(grid)), dtype=bool)
+    grid_values = to_utc(grid).asi8
+    for row, frame in enumerate(frames):
+        timestamps = to_utc(frame.index).asi8
+        positions = np.clip(np.searchsorted(grid_values, timestamps), 0, len(grid) - 1)
+        on_grid = np.flatnonzero(grid_values[positions] == timestamps)
+        unique, first = np.unique(positions[on_grid], return_index=True)
+        counts = np.bincount(positions[on_grid], minlength=len(grid))
+
+        frame_values = frame.reindex(columns=list(params)).to_numpy(dtype="float64")
+        values[row, unique] = frame_values[on_grid[first]]
+        duplicated[row] = counts > 1
+    return values, duplicated
+
+
+def _differences(values: np.ndarray, circular: np.ndarray) -> np.ndarray:
+    """
+    values[t] - values[t - 1] along the time axis, NaN at the first step.
+    """
+    differences = np.full(values.shape, np.nan)
+    differences[:, 1:] = np.diff(values, axis=1)
+    differences[..., circular] = (differences[..., circular] + 180) % 360 - 180
+    return differences
+
+
+def _stuck(values: np.ndarray, differences: np.ndarray, limits: Sequence[QCLimits]) -> np.ndarray:
+    stuck = np.zeros(values.shape, dtype=bool)
+    for column, limit in enumerate(limits):
+        if limit.stuck_steps is None:
+            continue
+        unchanged = differences[:, 1:, column] == 0
+        if limit.stuck_ignore is not None:
+            unchanged &= values[:, 1:, column] != limit.stuck_ignore
+        rows, starts, ends = find_runs(unchanged)
+        long = ends - starts >= limit.stuck_steps - 1
+        rows, starts, ends = rows[long], starts[long], ends[long]
+
+        # Difference i compares steps i and i + 1, so a run covers steps start..end.
+        marks = np.zeros((values.shape[0], values.shape[1] + 1), dtype=np.int64)
+        np.add.at(marks, (rows, starts), 1)
+        np.add.at(marks, (rows, ends + 1), -1)
+        stuck[..., column] = np.cumsum(marks, axis=1)[:, :-1] > 0
+    return stuck
+
+
+def fill_gaps(
+    values: np.ndarray, max_gap: int, circular: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Linearly interpolate gaps of at most max_gap steps along the time axis of a
+    (series, time, params) array. Returns the filled array and the filled mask.
+    """
+    n_steps = values.shape[1]
+    valid = ~np.isnan(values)
+    steps = np.arange(n_steps)[None, :, None]
+    previous = np.maximum.accumulate(np.where(valid, steps, -1), axis=1)
+    following = np.where(valid, steps, n_steps)
+    following = np.minimum.accumulate(following[:, ::-1], axis=1)[:, ::-1]
+    filled_mask = (
+        ~valid & (previous >= 0) & (following < n_steps) & (following - previous - 1 <= max_gap)
+    )
+    if not filled_mask.any():
+        return values, filled_mask
+
+    previous = np.clip(previous, 0, n_steps - 1)
+    following = np.clip(following, 0, n_steps - 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = (steps - previous) / (following - previous)
+
+    filled = values.copy()
+    before = np.take_along_axis(values, previous, axis=1)
+    after = np.take_along_axis(values, following, axis=1)
+    interpolated = before + (after - before) * weight
+    if circular.any():
+        radians_before, radians_after = np.radians(before), np.radians(after)
+        sin = np.sin(radians_before) * (1 - weight) + np.sin(radians_after) * weight
+        cos = np.cos(radians_before) * (1 - weight) + np.cos(radians_after) * weight
+        angles = np.degrees(np.arctan2(sin, cos)) % 360
+        interpolated[..., circular] = angles[..., circular]
+    filled[filled_mask] = interpolated[filled_mask]
+    return filled, filled_mask
+
+
+class QualityControl:
+    def __init__(self, limits: Mapping[WeatherParams, QCLimits] = DEFAULT_LIMITS, max_gap: int = 3):
+        """
+        max_gap is the longest gap, in grid steps, that is filled.
+        """
+        self.limits = dict(limits)
+        self.max_gap = max_gap
+
+    def check(
+        self, values: np.ndarray, params: Sequence[WeatherParams]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Check a (series, time, params) array on a regular grid.
+
+        Returns the cleaned and gap-filled values and the QCFlags of every value.
+        """
+        params = [WeatherParams(param) for param in params]
+        limits = [self.limits.get(param, QCLimits()) for param in params]
+        specs = [CANONICAL_SCHEMA.get(param) for param in params]
+        circular = np.array([is_circular(param) for param in params], dtype=bool)
+        low = np.array([spec.valid_min if spec else -np.inf for spec in specs])
+        high = np.array([spec.valid_max if spec else np.inf for spec in specs])
+        max_step = np.array([limit.max_step for limit in limits])
+        spike_size = np.array([limit.spike for limit in limits])
+
+        flags = np.zeros(values.shape, dtype=np.uint8)
+        flags[np.isnan(values)] |= QCFlags.MISSING
+
+        with np.errstate(invalid="ignore"):
+            out_of_range = (values < low) | (values > high)
+            values = np.where(out_of_range, np.nan, values)
+
+            differences = _differences(values, circular)
+            upcoming = np.full(values.shape, np.nan)
+            upcoming[:, :-1] = -differences[:, 1:]
+            spike = (
+                (np.abs(differences) > spike_size)
+                & (np.abs(upcoming) > spike_size)
+                & (np.sign(differences) == np.sign(upcoming))
+            )
+            after_spike = np.zeros(values.shape, dtype=bool)
+            after_spike[:, 1:] = spike[:, :-1]
+            step = (np.abs(differences) > max_step) & ~spike & ~after_spike
+            stuck = _stuck(values, differences, limits)
+
+        for mask, flag in (
+            (out_of_range, QCFlags.OUT_OF_RANGE),
+            (spike, QCFlags.SPIKE),
+            (step, QCFlags.STEP),
+            (stuck, QCFlags.STUCK),
+        ):
+            flags[mask] |= flag
+
+        cleaned = np.where(flags & REJECTED, np.nan, values)
+        cleaned, filled = fill_gaps(cleaned, self.max_gap, circular)
+        flags[filled] |= QCFlags.GAP_FILLED
+        return cleaned, flags
+
+    def check_frames(
+        self, frames: Sequence[pd.DataFrame], freq: str = "1H", batch_size: int = 256
+    ) -> list[tuple[pd.DataFrame, pd.DataFrame]]:
+        """
+        Check observation frames of many stations, batch_size stations per pass.
+
+        Returns (cleaned data, flags) per frame on a regular grid of freq over the
+        period of the frame. Timestamps are floored to multiples of freq, so the
+        result of a frame does not depend on the other frames of its batch; rows
+        falling onto the same step are flagged DUPLICATE and the first is kept.
+        """
+        results = []
+        for start in range(0, len(frames), batch_size):
+            stop = start + batch_size
+            results += self._check_batch(list(frames[start:stop]), freq)
+        return results
+
+    def _check_batch(
+        self, frames: list[pd.DataFrame], freq: str
+    ) -> list[tuple[pd.DataFrame, pd.DataFrame]]:
+        params = list(
+            dict.fromkeys(
+                column for frame in frames for column in frame.columns if column in CANONICAL_SCHEMA
+            )
+        )
+        present = [frame for frame in frames if len(frame)]
+        if not present or not params:
+            return [(frame, pd.DataFrame(index=frame.index)) for frame in frames]
+
+        snapped = [frame.set_axis(to_utc(frame.index).floor(freq)) for frame in frames]
+        indexes = [frame.index for frame in snapped if len(frame)]
+        grid = make_grid(
+            min(index.min() for index in indexes), max(index.max() for index in indexes), freq
+        )
+        values, duplicated = to_grid(snapped, grid, params)
+        cleaned, flags = self.check(values, params)
+        flags[duplicated] |= QCFlags.DUPLICATE
+
+        results = []
+        for row, frame in enumerate(frames):
+            if not len(frame):
+                results.append((frame, pd.DataFrame(index=frame.index)))
+                continue
+            index = snapped[row].index
+            first, stop = grid.searchsorted(index.min()), grid.searchsorted(index.max(), "right")
+            own_grid = grid[first:stop]
+            if frame.index.tz is None:
+                own_grid = own_grid.tz_localize(None)
+            own_grid.name = frame.index.name
+            columns = [param for param in params if param in frame.columns]
+            positions = [params.index(param) for param in columns]
+            results.append(
+                (
+                    pd.DataFrame(cleaned[row, first:stop][:, positions], own_grid, columns),
+                    pd.DataFrame(flags[row, first:stop][:, positions], own_grid, columns),
+                )
+            )
+        return results
+
+    def check_weather_data(
+        self, weather_data: WeatherData, freq: str = "1H"
+    ) -> tuple[WeatherData, pd.DataFrame]:
+        ((data, flags),) = self.check_frames([weather_data.data], freq)
+        return WeatherData(data=data, location=weather_data.location), flags
@@ -0,0 +1,177 @@
+"""
+Rideable window detection.
+
+Forecasts of many spots and models are stacked into (series, time) arrays on a
+regular grid. Rules are evaluated for all of them at once into a boolean mask
+and contiguous runs of the mask are found by differencing, without Python loops
+over time steps or windows.
+"""
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Mapping, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from analysis.alignment import align_many
+from domain.models import Forecast, WeatherParams
+
+#: Direction sector (from, to) in degrees, clockwise; (315, 45) spans north.
+Sector = tuple[float, float]
+
+WINDOW_COLUMNS = [
+    "location",
+    "weather_model",
+    "start",
+    "end",
+    "duration",
+    "mean_speed",
+    "max_gust",
+    "skill",
+]
+
+
+@dataclass(frozen=True)
+class RideRules:
+    #: Wind speed range in knots.
+    min_speed: float = 12.0
+    max_speed: float = 35.0
+    #: Highest allowed ratio of gusts to wind speed.
+    max_gust_factor: float = 1.6
+    min_duration: timedelta = timedelta(hours=2)
+
+
+def find_runs(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Runs of True along the last axis of a 2-D mask as (rows, starts, ends), ends exclusive.
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    start_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return start_rows, starts, ends
+
+
+def sector_mask(directions: np.ndarray, sectors: Sequence[Sequence[Sector]]) -> np.ndarray:
+    """
+    Whether each direction lies in any sector of its row. Rows without sectors accept all.
+    """
+    n_sectors = max((len(row) for row in sectors), default=0)
+    if n_sectors == 0:
+        return np.ones(directions.shape, dtype=bool)
+
+    bounds = np.full((len(sectors), n_sectors, 2), np.nan)
+    for row, row_sectors in enumerate(sectors):
+        if row_sectors:
+            bounds[row, : len(row_sectors)] = row_sectors
+    start, end = bounds[:, None, :, 0], bounds[:, None, :, 1]
+    offset = (directions[:, :, None] - start) % 360
+    inside = (offset <= (end - start) % 360).any(axis=2)
+    unrestricted = np.array([not row for row in sectors])
+    return inside | unrestricted[:, None]
+
+
+def ride_mask(
+    speed: np.ndarray,
+    gusts: np.ndarray,
+    directions: np.ndarray,
+    rules: RideRules,
+    sectors: Sequence[Sequence[Sector]],
+) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        gusts_ok = ~(gusts / speed > rules.max_gust_factor)
+        return (
+            (speed >= rules.min_speed)
+            & (speed <= rules.max_speed)
+            & gusts_ok
+            & sector_mask(directions, sectors)
+        )
+
+
+def find_windows(
+    speed: np.ndarray,
+    gusts: np.ndarray,
+    directions: np.ndarray,
+    grid: pd.DatetimeIndex,
+    series: Sequence[tuple[str, str]],
+    rules: RideRules = RideRules(),
+    sectors: Optional[Mapping[str, Sequence[Sector]]] = None,
+    skill: Optional[Mapping[tuple[str, str], float]] = None,
+) -> pd.DataFrame:
+    """
+    Rideable windows of (series, time) arrays on a regular grid.
+
+    series holds the (location name, model) of every row, sectors the allowed
+    directions per location and skill a score per (location, model), higher is
+    better. Windows are ranked by skill, then by duration.
+    """
+    sectors = sectors or {}
+    step = grid[1] - grid[0] if len(grid) > 1 else pd.Timedelta(hours=1)
+    mask = ride_mask(speed, gusts, directions, rules, [sectors.get(loc, ()) for loc, _ in series])
+
+    rows, starts, ends = find_runs(mask)
+    min_steps = int(np.ceil(pd.Timedelta(rules.min_duration) / step))
+    keep = ends - starts >= max(min_steps, 1)
+    rows, starts, ends = rows[keep], starts[keep], ends[keep]
+    if len(rows) == 0:
+        return pd.DataFrame(columns=WINDOW_COLUMNS)
+
+    n_time = speed.shape[1]
+    cumulative = np.zeros((speed.shape[0], n_time + 1))
+    cumulative[:, 1:] = np.cumsum(np.nan_to_num(speed), axis=1)
+    mean_speed = (cumulative[rows, ends] - cumulative[rows, starts]) / (ends - starts)
+
+    flat_gusts = np.append(np.where(np.isnan(gusts), -np.inf, gusts).ravel(), -np.inf)
+    bounds = np.column_stack([rows * n_time + starts, rows * n_time + ends]).ravel()
+    max_gust = np.maximum.reduceat(flat_gusts, bounds)[::2]
+
+    skill = skill or {}
+    windows = pd.DataFrame(
+        {
+            "location": [series[row][0] for row in rows],
+            "weather_model": [series[row][1] for row in rows],
+            "start": grid[starts],
+            "end": grid[ends - 1] + step,
+            "duration": (ends - starts) * step,
+            "mean_speed": mean_speed,
+            "max_gust": np.where(np.isinf(max_gust), np.nan, max_gust),
+            "skill": [skill.get(series[row], np.nan) for row in rows],
+        }
+    )
+    return windows.sort_values(
+        ["skill", "duration", "mean_speed"], ascending=False, na_position="last", kind="stable"
+    ).reset_index(drop=True)
+
+
+def find_forecast_windows(
+    forecasts: Sequence[Forecast],
+    grid: pd.DatetimeIndex,
+    rules: RideRules = RideRules(),
+    sectors: Optional[Mapping[str, Sequence[Sector]]] = None,
+    skill: Optional[Mapping[tuple[str, str], float]] = None,
+) -> pd.DataFrame:
+    """
+    Rideable windows of forecasts of any spots and models, aligned onto grid.
+    """
+    params = [WeatherParams.WIND_SPEED, WeatherParams.WIND_GUSTS, WeatherParams.WIND_DIRECTION]
+    stacked = align_many(forecasts, grid, params)
+    series = [(forecast.location.name, forecast.weather_model.value) for forecast in forecasts]
+    return find_windows(
+        stacked[:, :, 0],
+        stacked[:, :, 1],
+        stacked[:, :, 2],
+        grid,
+        series,
+        rules=rules,
+        sectors=sectors,
+        skill=skill,
+    )
+
+
+def skill_from_metrics(metrics: pd.DataFrame) -> dict[tuple[str, str], float]:
+    """
+    Skill 1 / (1 + RMSE) per (location, model) from an analysis.evaluation metrics table.
+    """
+    skill = 1 / (1 + metrics["rmse"].to_numpy())
+    return dict(zip(zip(metrics["location"], metrics["weather_model"]), skill))
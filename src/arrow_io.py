@@ -0,0 +1,248 @@
+"""
+Arrow IPC export and streaming of forecasts and observations.
+
+Every Forecast or WeatherData becomes one record batch of the stable SCHEMA:
+key columns identifying the series (type, location, weather_model, created_at,
+...) followed by the timestamp and one float64 column per canonical param, in
+the units of CANONICAL_SCHEMA. Missing params are NaN columns, so batches of
+different sources always share the schema and can be combined into one table.
+
+Files are written in the Arrow IPC file format (Feather v2) without compression,
+so readers can memory-map them; streams use the IPC stream format and can be
+written to any binary file object, a socket or an HTTP response:
+
+    write_feather("forecasts.arrow", repository.iter_forecasts(query))
+    table = read_feather("forecasts.arrow")  # memory-mapped
+    forecasts = to_weather_data(table)
+"""
+import json
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Union
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from analysis.alignment import naive_utc, to_utc
+from domain.models import (Forecast, ForecastModels, Location, WeatherData,
+                           WeatherParams)
+from domain.schema import CANONICAL_SCHEMA
+
+SCHEMA_VERSION = "1"
+MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+KEY_FIELDS = [
+    pa.field("type", pa.string(), nullable=False),
+    pa.field("location", pa.string(), nullable=False),
+    pa.field("lon", pa.string(), nullable=False),
+    pa.field("lat", pa.string(), nullable=False),
+    pa.field("weather_model", pa.string()),
+    pa.field("created_at", pa.timestamp("us", tz="UTC")),
+    pa.field("valid_at", pa.timestamp("us", tz="UTC")),
+    pa.field("forecast_id", pa.int64()),
+]
+KEY_COLUMNS = [field.name for field in KEY_FIELDS]
+PARAMS = list(CANONICAL_SCHEMA)
+
+SCHEMA = pa.schema(
+    KEY_FIELDS
+    + [pa.field(WeatherParams.TIMESTAMP.value, pa.timestamp("ns", tz="UTC"), nullable=False)]
+    + [
+        pa.field(param.value, pa.float64(), metadata={"unit": CANONICAL_SCHEMA[param].unit.value})
+        for param in PARAMS
+    ],
+    metadata={"find_forecast.schema_version": SCHEMA_VERSION},
+)
+
+Item = Union[Forecast, WeatherData]
+
+
+def _constant(value, length: int, type_: pa.DataType) -> pa.Array:
+    return pa.repeat(pa.scalar(value, type=type_), length)
+
+
+def _timestamp(value) -> Optional[pd.Timestamp]:
+    return None if value is None else to_utc(pd.DatetimeIndex([value]))[0]
+
+
+def to_record_batch(item: Item) -> pa.RecordBatch:
+    """
+    One record batch of SCHEMA holding item; param columns are copied into
+    float64 Arrow arrays.
+    """
+    if isinstance(item.data.index, pd.MultiIndex):
+        raise Exception("Only data indexed by timestamp can be exported.")
+
+    n_rows = len(item.data)
+    is_forecast = isinstance(item, Forecast)
+    keys = {
+        "type": item.TYPE_IDENTIFIER,
+        "location": item.location.name,
+        "lon": item.location.lon,
+        "lat": item.location.lat,
+        "weather_model": item.weather_model.value if is_forecast else None,
+        "created_at": _timestamp(item.created_at) if is_forecast else None,
+        "valid_at": _timestamp(item.valid_at) if is_forecast else None,
+        "forecast_id": item.id if is_forecast else None,
+    }
+    columns = [_constant(keys[field.name], n_rows, field.type) for field in KEY_FIELDS]
+    columns.append(
+        pa.array(to_utc(item.data.index).asi8, type=pa.int64()).view(
+            SCHEMA.field(WeatherParams.TIMESTAMP.value).type
+        )
+    )
+    for param in PARAMS:
+        if param in item.data.columns:
+            values = item.data[param].to_numpy(dtype="float64")
+        else:
+            values = np.full(n_rows, np.nan)
+        columns.append(pa.array(values, type=pa.float64()))
+    return pa.RecordBatch.from_arrays(columns, schema=_schema_for(item))
+
+
+def _schema_for(item: Optional[Item] = None) -> pa.Schema:
+    """
+    SCHEMA, with the metadata of item when a file or stream holds only that item.
+    """
+    if item is None:
+        return SCHEMA
+    metadata = dict(SCHEMA.metadata)
+    metadata[b"location"] = json.dumps(
+        {"name": item.location.name, "lon": item.location.lon, "lat": item.location.lat}
+    ).encode()
+    if isinstance(item, Forecast):
+        metadata[b"weather_model"] = item.weather_model.value.encode()
+        metadata[b"created_at"] = _timestamp(item.created_at).isoformat().encode()
+    return SCHEMA.with_metadata(metadata)
+
+
+def to_table(items: Iterable[Item]) -> pa.Table:
+    return pa.Table.from_batches([to_record_batch(item) for item in items], schema=SCHEMA)
+
+
+def write_feather(path: str, items: Union[Item, Iterable[Item]]) -> None:
+    """
+    Write items to an uncompressed Arrow IPC file, one record batch per item.
+
+    Items are written one by one, so an iterator of any length can be exported.
+    A single item also sets its location, model and created_at in the schema metadata.
+    """
+    single = isinstance(items, WeatherData)
+    batches = (to_record_batch(item) for item in ([items] if single else items))
+    schema = _schema_for(items if single else None)
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+
+
+def read_feather(path: str, memory_map: bool = True) -> pa.Table:
+    """
+    Table of an exported file, memory-mapped by default so that reading is zero-copy.
+    """
+    return feather.read_table(path, memory_map=memory_map)
+
+
+def write_stream(sink: BinaryIO, items: Iterable[Item]) -> int:
+    """
+    Write items to sink in the Arrow IPC stream format as they are produced.
+
+    Returns the number of items written.
+    """
+    count = 0
+    with pa.ipc.new_stream(sink, SCHEMA) as writer:
+        for item in items:
+            writer.write_batch(to_record_batch(item))
+            count += 1
+    return count
+
+
+def read_stream(source: BinaryIO) -> Iterator[Item]:
+    """
+    Items of an Arrow IPC stream, one per record batch, decoded as they arrive.
+    """
+    for batch in pa.ipc.open_stream(source):
+        yield from to_weather_data(batch)
+
+
+def to_weather_data(data: Union[pa.Table, pa.RecordBatch]) -> list[Item]:
+    """
+    Forecast or WeatherData objects of a table or batch, one per distinct key.
+
+    Data is indexed by UTC timestamps, created_at and valid_at are naive UTC.
+    """
+    frame = data.to_pandas(timestamp_as_object=False)
+    if frame.empty:
+        return []
+
+    items: list[Item] = []
+    # Keys are grouped by their integer codes; grouping on several columns with
+    # nulls drops those rows in pandas 1.5 even with dropna=False.
+    codes = [pd.factorize(frame[column].array, use_na_sentinel=False)[0] for column in KEY_COLUMNS]
+    for _, group in frame.groupby(codes, sort=False):
+        keys = group.iloc[0][KEY_COLUMNS].to_dict()
+        values = group[[param.value for param in PARAMS]].dropna(axis=1, how="all")
+        values.columns = [WeatherParams(column) for column in values.columns]
+        values.index = pd.DatetimeIndex(group[WeatherParams.TIMESTAMP.value])
+        values.index.name = WeatherParams.TIMESTAMP
+        location = Location(lon=keys["lon"], lat=keys["lat"], name=keys["location"])
+
+        if keys["type"] == Forecast.TYPE_IDENTIFIER:
+            forecast_id = keys["forecast_id"]
+            items.append(
+                Forecast(
+                    data=values,
+                    location=location,
+                    created_at=naive_utc(keys["created_at"]),
+                    valid_at=naive_utc(keys["valid_at"]),
+                    weather_model=ForecastModels(keys["weather_model"]),
+                    id=None if pd.isna(forecast_id) else int(forecast_id),
+                )
+            )
+        else:
+            items.append(WeatherData(data=values, location=location))
+    return items
+
+
+def send_stream(sock: socket.socket, items: Iterable[Item]) -> int:
+    """
+    Stream items over a connected socket; read them on the other end with
+    `read_stream(sock.makefile("rb"))`.
+    """
+    with sock.makefile("wb") as sink:
+        return write_stream(sink, items)
+
+
+class ArrowStreamHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests with the Arrow stream of the items returned by the
+    server's `get_items` for the parsed query string.
+    """
+
+    server: "ArrowStreamServer"
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        try:
+            items = self.server.get_items(url.path, parse_qs(url.query))
+        except Exception as error:
+            self.send_error(400, str(error))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", MEDIA_TYPE)
+        self.end_headers()
+        # HTTP/1.0 responses end with the connection, no length is needed.
+        write_stream(self.wfile, items)
+
+
+class ArrowStreamServer(ThreadingHTTPServer):
+    def __init__(
+        self,
+        address: tuple[str, int],
+        get_items: Callable[[str, dict[str, list[str]]], Iterable[Item]],
+    ):
+        self.get_items = get_items
+        super().__init__(address, ArrowStreamHandler)
@@ -1 +1,3 @@
 PLOTS_DIR = "./plots"
+LOCATIONS_FILE = "./data/locations.csv"
+PROFILES_DIR = "./profiles"
@@ -0,0 +1,198 @@
+"""
+Wiring of the application components.
+
+The Container builds clients, services, repositories and caches lazily from
+config, once, and hands out the same instances to every caller, so a long
+running process reuses warm connections, caches and indexes:
+
+    with Container(config) as container:
+        container.forecast_service.get_forecast_for_location(...)
+
+Any component can be replaced before first use with `override`, e.g. by a stub
+client in tests.
+"""
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from adapters.openmeteo.client import OpenMeteoClient
+from adapters.windycom.client import WindyComClient
+from analysis.qc import QualityControl
+from constants import LOCATIONS_FILE
+from locations_data import locations as locations_data
+from repositories import (LocationCatalog, LocationRepository,
+                          ObservationStore, PklRepository)
+from services.cache import ForecastCache
+from services.resilience import ResilientForecastService
+from services.weather_services import (ForecastService,
+                                       MeteostatWeatherService,
+                                       OpenMeteoExternalService,
+                                       WeatherService, WindyComExternalService)
+
+
+@dataclass(frozen=True)
+class Provider:
+    factory: Callable[["Container"], Any]
+    #: Called with the instance on shutdown.
+    close: Optional[Callable[[Any], None]] = None
+
+
+def _close_client(client) -> None:
+    client.close()
+
+
+class Container:
+    def __init__(self, config: Optional[dict] = None):
+        self.config = config or {}
+        self._providers: dict[str, Provider] = {}
+        self._instances: dict[str, Any] = {}
+        #: Names of built instances in order of creation, closed in reverse.
+        self._created: list[str] = []
+        self._lock = threading.RLock()
+        self._register_defaults()
+
+    def _register_defaults(self) -> None:
+        self.register(
+            "openmeteo_client",
+            lambda c: OpenMeteoClient(config=c.config.get("openmeteo", {})),
+            close=_close_client,
+        )
+        self.register(
+            "windycom_client",
+            lambda c: WindyComClient(
+                config=c.config.get("windycom")
+                or {
+                    "user": os.environ["METEOMATICS_USER"],
+                    "password": os.environ["METEOMATICS_PASSWORD"],
+                }
+            ),
+            close=_close_client,
+        )
+        self.register(
+            "openmeteo_service",
+            lambda c: OpenMeteoExternalService(client=c.get("openmeteo_client")),
+        )
+        self.register(
+            "windycom_service",
+            lambda c: WindyComExternalService(client=c.get("windycom_client")),
+        )
+        self.register(
+            "forecast_cache",
+            lambda c: ForecastCache(max_size=c.config.get("forecast_cache_size", 10_000)),
+        )
+        for name in ("openmeteo", "windycom"):
+            # Circuit breaking, hedging and stale fallback from the shared forecast cache.
+            self.register(
+                f"resilient_{name}_service",
+                lambda c, name=name: ResilientForecastService(
+                    c.get(f"{name}_service"), cache=c.get("forecast_cache")
+                ),
+                close=lambda service: service.shutdown(),
+            )
+        self.register(
+            "forecast_service",
+            lambda c: ForecastService(
+                external_services=[
+                    c.get(f"resilient_{name}_service")
+                    for name in c.config.get("forecast_services", ("openmeteo",))
+                ],
+                cache=c.get("forecast_cache"),
+            ),
+        )
+        self.register("meteostat_service", lambda c: MeteostatWeatherService())
+        self.register(
+            "observation_store",
+            lambda c: ObservationStore(
+                c.config.get("observation_store_dir", "storage/observations")
+            ),
+        )
+        self.register("quality_control", lambda c: QualityControl())
+        self.register(
+            "weather_service",
+            lambda c: WeatherService(
+                external_service=c.get("meteostat_service"),
+                # Setting quality_control to False returns observations unchecked.
+                qc=c.get("quality_control") if c.config.get("quality_control", True) else None,
+                # Without an observation_store_dir every period is fetched in full.
+                store=(
+                    c.get("observation_store") if c.config.get("observation_store_dir") else None
+                ),
+            ),
+        )
+        self.register(
+            "location_repository",
+            lambda c: LocationRepository(c.config.get("locations", locations_data)),
+        )
+        self.register(
+            "location_catalog",
+            lambda c: LocationCatalog(c.config.get("locations_file", LOCATIONS_FILE)),
+        )
+        self.register(
+            "forecast_repository",
+            lambda c: PklRepository(c.config.get("pkl_repository_dir", "storage/pkl_repo")),
+            close=lambda repository: repository.index.close(),
+        )
+
+    def register(
+        self,
+        name: str,
+        factory: Callable[["Container"], Any],
+        close: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        with self._lock:
+            if name in self._instances:
+                raise Exception(f"Component {name} is already in use.")
+            self._providers[name] = Provider(factory=factory, close=close)
+
+    def override(self, name: str, instance: Any) -> None:
+        """
+        Use instance as the component name. Must be called before the component
+        is first used; the instance is not closed on shutdown.
+        """
+        self.register(name, lambda c: instance)
+
+    def get(self, name: str) -> Any:
+        with self._lock:
+            if name not in self._instances:
+                try:
+                    provider = self._providers[name]
+                except KeyError:
+                    raise Exception(f"Component {name} not found.")
+                self._instances[name] = provider.factory(self)
+                self._created.append(name)
+            return self._instances[name]
+
+    def startup(self, names: Optional[list[str]] = None) -> None:
+        """
+        Build the named components (all by default) ahead of the first request.
+        """
+        for name in names if names is not None else list(self._providers):
+            self.get(name)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for name in reversed(self._created):
+                provider = self._providers[name]
+                if provider.close is not None:
+                    provider.close(self._instances[name])
+            self._instances.clear()
+            self._created.clear()
+
+    def __enter__(self) -> "Container":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+    @property
+    def forecast_service(self) -> ForecastService:
+        return self.get("forecast_service")
+
+    @property
+    def weather_service(self) -> WeatherService:
+        return self.get("weather_service")
+
+    @property
+    def location_repository(self) -> LocationRepository:
+        return self.get("location_repository")
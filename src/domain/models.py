@@ -1,8 +1,10 @@
 import enum
-from dataclasses import dataclass
+import hashlib
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Union
+from typing import Optional, Union
 
+import numpy as np
 import pandas as pd
 
 
@@ -29,6 +31,8 @@ class WeatherParams(str, enum.Enum):
 class ForecastModels(enum.Enum):
     MODEL_ICON = "icon"
     DEFAULT = "default"
+    #: Skill-weighted consensus of several models, see analysis.blending.
+    BLEND = "blend"
 
 
 @dataclass
@@ -75,6 +79,71 @@ class Forecast(WeatherData):
     valid_at: datetime
     weather_model: ForecastModels
     id: Union[int, None] = None
+    #: Set on forecasts served from a cache because the external service failed.
+    stale: bool = False
+
+    #: Content fingerprint, computed when the forecast is built.
+    _fingerprint: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
+    #: Fields the fingerprint is computed from.
+    _CONTENT_FIELDS = ("data", "location", "weather_model")
+
+    def __post_init__(self) -> None:
+        self.refresh_fingerprint()
+
+    def __setattr__(self, name, value) -> None:
+        super().__setattr__(name, value)
+        # Replacing content re-fingerprints; during __init__ __post_init__ does it once.
+        if name in self._CONTENT_FIELDS and "_fingerprint" in self.__dict__:
+            self.refresh_fingerprint()
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Stable hash of the content: data (index, columns and values), location and model.
+
+        Computed once when the forecast is built and again whenever data, location or
+        model are replaced. Data is treated as immutable: after changing it in place,
+        call refresh_fingerprint().
+        """
+        if self._fingerprint is None:
+            self.refresh_fingerprint()
+        return self._fingerprint
+
+    def refresh_fingerprint(self) -> None:
+        self._fingerprint = self._compute_fingerprint()
+
+    def _compute_fingerprint(self) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (
+            self.location.name,
+            self.location.lon,
+            self.location.lat,
+            self.weather_model.value,
+            str(getattr(self.data.index, "tz", None)),
+            repr([str(column) for column in self.data.columns]),
+        ):
+            digest.update(part.encode())
+            digest.update(b"\0")
+
+        index = self.data.index
+        if isinstance(index, pd.DatetimeIndex):
+            digest.update(index.asi8.tobytes())
+        else:
+            digest.update(pd.util.hash_pandas_object(index.to_frame(index=False)).to_numpy())
+        try:
+            values = self.data.to_numpy(dtype="float64")
+        except (TypeError, ValueError):
+            try:
+                values = pd.util.hash_pandas_object(self.data, index=False).to_numpy()
+            except TypeError:
+                # Unhashable objects (nested frames) are hashed by their text.
+                values = pd.util.hash_pandas_object(self.data.astype(str), index=False).to_numpy()
+        else:
+            # One bit pattern for every NaN.
+            values = np.where(np.isnan(values), np.nan, values)
+        digest.update(np.ascontiguousarray(values).tobytes())
+        return digest.hexdigest()
 
     def set_id(self, identifier: int) -> None:
         if self.id:
@@ -83,8 +152,7 @@ class Forecast(WeatherData):
 
     def __eq__(self, other: object) -> bool:
         """
-        data property is a DataFrame object that needs special treatment.
-        TODO: This can be implemented smarter.
+        Data, location and model are compared through their fingerprints.
         """
         if not isinstance(other, Forecast):
             return NotImplemented
@@ -93,6 +161,5 @@ class Forecast(WeatherData):
             self.id == other.id
             and self.created_at == other.created_at
             and self.valid_at == other.valid_at
-            and all(self.data == other.data)
-            and self.location == other.location
+            and self.fingerprint == other.fingerprint
         )
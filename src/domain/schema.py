@@ -0,0 +1,119 @@
+"""
+Canonical schema of weather parameters.
+
+Every provider maps its raw columns onto WeatherParams and converts them to
+the units and dtypes declared here, so data coming from different external
+services can be compared directly.
+"""
+import enum
+from dataclasses import dataclass
+from typing import Mapping
+
+import numpy as np
+import pandas as pd
+
+from domain.models import WeatherParams
+
+
+class Units(str, enum.Enum):
+    CELSIUS = "degC"
+    FAHRENHEIT = "degF"
+    KELVIN = "K"
+
+    KNOTS = "kn"
+    KILOMETERS_PER_HOUR = "km/h"
+    METERS_PER_SECOND = "m/s"
+    MILES_PER_HOUR = "mph"
+
+    DEGREES = "deg"
+
+
+@dataclass(frozen=True)
+class ParamSpec:
+    unit: Units
+    dtype: str = "float64"
+    #: Resolution values are quantized to in compact storage.
+    precision: float = 0.1
+    #: Angular values that wrap around at 360 and need circular statistics.
+    circular: bool = False
+    #: Physically plausible values, in unit.
+    valid_min: float = -np.inf
+    valid_max: float = np.inf
+
+
+CANONICAL_SCHEMA: dict[WeatherParams, ParamSpec] = {
+    WeatherParams.TEMPERATURE: ParamSpec(unit=Units.CELSIUS, valid_min=-70.0, valid_max=60.0),
+    WeatherParams.WIND_SPEED: ParamSpec(unit=Units.KNOTS, valid_min=0.0, valid_max=150.0),
+    WeatherParams.WIND_DIRECTION: ParamSpec(
+        unit=Units.DEGREES, precision=1.0, circular=True, valid_min=0.0, valid_max=360.0
+    ),
+    WeatherParams.WIND_GUSTS: ParamSpec(unit=Units.KNOTS, valid_min=0.0, valid_max=220.0),
+}
+
+#: Linear conversions (scale, offset): canonical = value * scale + offset.
+UNIT_CONVERSIONS: dict[tuple[Units, Units], tuple[float, float]] = {
+    (Units.FAHRENHEIT, Units.CELSIUS): (5 / 9, -32 * 5 / 9),
+    (Units.KELVIN, Units.CELSIUS): (1.0, -273.15),
+    (Units.KILOMETERS_PER_HOUR, Units.KNOTS): (1 / 1.852, 0.0),
+    (Units.METERS_PER_SECOND, Units.KNOTS): (3.6 / 1.852, 0.0),
+    (Units.MILES_PER_HOUR, Units.KNOTS): (1.609344 / 1.852, 0.0),
+}
+
+
+def get_conversion(source: Units, target: Units) -> tuple[float, float]:
+    if source == target:
+        return 1.0, 0.0
+    try:
+        return UNIT_CONVERSIONS[(source, target)]
+    except KeyError:
+        raise Exception(f"Conversion from {source.value} to {target.value} is not supported.")
+
+
+class ConversionPlan:
+    """
+    Conversion of provider columns to the canonical schema.
+
+    The plan is resolved once from the units a provider declares, and applied
+    as a single array operation over all the columns it covers.
+    """
+
+    def __init__(self, source_units: Mapping[WeatherParams, Units]):
+        self.source_units = dict(source_units)
+        self._scales = {}
+        self._offsets = {}
+        for param, unit in self.source_units.items():
+            scale, offset = get_conversion(unit, CANONICAL_SCHEMA[param].unit)
+            self._scales[param] = scale
+            self._offsets[param] = offset
+
+    def apply_to_array(self, values: np.ndarray, params: list[WeatherParams]) -> np.ndarray:
+        """
+        Convert an array holding params along its first axis.
+        """
+        shape = (len(params),) + (1,) * (values.ndim - 1)
+        scales = np.array([self._scales.get(param, 1.0) for param in params]).reshape(shape)
+        offsets = np.array([self._offsets.get(param, 0.0) for param in params]).reshape(shape)
+        return values * scales + offsets
+
+    def apply(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Return a copy of data with the planned columns in canonical units and
+        dtypes. Columns outside the plan are left untouched.
+        """
+        params = [param for param in self.source_units if param in data.columns]
+        data = data.copy()
+        if not params:
+            return data
+
+        scales = np.array([self._scales[param] for param in params])
+        offsets = np.array([self._offsets[param] for param in params])
+        values = data[params].to_numpy(dtype="float64") * scales + offsets
+
+        for position, param in enumerate(params):
+            data[param] = values[:, position].astype(CANONICAL_SCHEMA[param].dtype)
+        return data
+
+
+def is_circular(param) -> bool:
+    spec = CANONICAL_SCHEMA.get(param)
+    return spec is not None and spec.circular
@@ -1,3 +1,4 @@
+import argparse
 import os
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -6,9 +7,10 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from adapters.openmeteo.client import OpenMeteoClient
-from constants import PLOTS_DIR
+from constants import PLOTS_DIR, PROFILES_DIR
 from domain.models import ForecastModels, Location, WeatherData, WeatherParams
 from services.weather_services import OpenMeteoExternalService, WeatherService
+from utils.profiling import Profiler, profiling_requested, stage
 
 
 def plot_weather_data_as_jpg(weather_data: WeatherData, filename: str) -> None:
@@ -20,27 +22,24 @@ def plot_weather_data_as_jpg(weather_data: WeatherData, filename: str) -> None:
     plt.savefig(output_dir, format="jpg", dpi=300)
 
 
-if __name__ == "__main__":
+def main() -> None:
     # bootstrap
 
     Path(PLOTS_DIR).mkdir(parents=True, exist_ok=True)
 
-    windy_com_config: dict = {
-        "user": os.environ["METEOMATICS_USER"],
-        "password": os.environ["METEOMATICS_PASSWORD"],
-    }
     open_meteo_service = OpenMeteoExternalService(client=OpenMeteoClient(config={}))
 
     location = Location(name="My location", lon="53.11", lat="21.37")
     timestamp = datetime.utcnow() + timedelta(days=1)
 
-    forecast = open_meteo_service.get_forecast(
-        location=location,
-        extra_params=(WeatherParams.WIND_SPEED,),
-        model=ForecastModels.MODEL_ICON,
-        target_timestamp=timestamp,
-        end_timestamp=timestamp,
-    )
+    with stage(f"fetch {open_meteo_service.name}"):
+        open_meteo_service.get_forecast(
+            location=location,
+            extra_params=(WeatherParams.WIND_SPEED,),
+            model=ForecastModels.MODEL_ICON,
+            target_timestamp=timestamp,
+            end_timestamp=timestamp,
+        )
 
     ###########
 
@@ -48,10 +47,30 @@ if __name__ == "__main__":
     location = Location(name="Valencia", lon="39.46975", lat="-0.37739")
     timestamp_end = datetime.today()
     timestamp_start = timestamp_end - timedelta(days=2)
-    valencia_weather = weather_service.get_weather_for_location(
-        location, timestamp_start, timestamp_end
+    with stage(f"fetch {weather_service.external_service.name}"):
+        valencia_weather = weather_service.get_weather_for_location(
+            location, timestamp_start, timestamp_end
+        )
+
+    with stage("plot"):
+        plot_weather_data_as_jpg(valencia_weather, "valencia_weather.jpg")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Write timings and profiles to {PROFILES_DIR} (or set FF_PROFILE=1).",
     )
+    args = parser.parse_args()
 
-    plot_weather_data_as_jpg(valencia_weather, "valencia_weather.jpg")
+    if profiling_requested(args.profile):
+        with Profiler() as profiler:
+            main()
+        print(profiler.summary())
+        print(profiler.write(PROFILES_DIR, "main"))
+    else:
+        main()
 
     print("Done.")
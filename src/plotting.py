@@ -1,15 +1,55 @@
 import os
+from typing import Optional
 
+import numpy as np
+import pandas as pd
 from matplotlib import pyplot as plt
 from seaborn import objects as so
 
+from analysis.alignment import to_utc
+from analysis.downsampling import min_max_indices
 from constants import PLOTS_DIR
 from domain.models import WeatherData, WeatherParams
 
+MIN_MAX = "min_max"
+
+
+def downsample_frame(
+    data: pd.DataFrame,
+    x_key: str,
+    y_key: str,
+    n_points: int,
+    method: str = MIN_MAX,
+    series_key: Optional[str] = "type",
+) -> pd.DataFrame:
+    """
+    Rows of data reduced to about n_points per series of series_key.
+
+    `min_max`, the only method, keeps up to 4 points per bucket of n_points / 4
+    time buckets.
+    """
+    timestamps = to_utc(data[x_key])
+    x = np.where(timestamps.isna(), np.nan, timestamps.asi8.astype("float64"))
+    y = data[y_key].to_numpy(dtype="float64")
+    series = data[series_key].to_numpy() if series_key in data.columns else None
+
+    if method == MIN_MAX:
+        positions = min_max_indices(x, y, max(n_points // 4, 1), series)
+    else:
+        raise Exception(f"Unknown downsampling method: {method}.")
+    return data.iloc[positions]
+
 
 def plot_weather_data_as_jpg(
-    weather_data: WeatherData, x_key: WeatherParams, filename: str
+    weather_data: WeatherData,
+    x_key: WeatherParams,
+    filename: str,
+    downsample: Optional[str] = None,
 ) -> None:
+    """
+    downsample (MIN_MAX) reduces every series to the pixel width of the
+    figure first, so long periods render in about constant time.
+    """
     output_dir = os.path.join(PLOTS_DIR, filename)
 
     # sns.set_style("darkgrid", {"axes.facecolor": ".9"})
@@ -22,6 +62,13 @@ def plot_weather_data_as_jpg(
     fig, ax = plt.subplots()
     ax.xaxis.set_tick_params(rotation=90)
 
-    p = so.Plot(data=weather_data.data, x=WeatherParams.TIMESTAMP, y=x_key, color="type")
+    data = weather_data.data
+    if downsample is not None:
+        width = int(fig.get_figwidth() * fig.dpi)
+        data = downsample_frame(
+            data.reset_index(), WeatherParams.TIMESTAMP, x_key, width, downsample
+        )
+
+    p = so.Plot(data=data, x=WeatherParams.TIMESTAMP, y=x_key, color="type")
     p = p.add(so.Line()).on(ax)
     p.save(output_dir, format="jpg")
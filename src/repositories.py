@@ -1,37 +1,375 @@
+import bisect
+import contextlib
 import dataclasses
+import fcntl
+import json
 import os
 import pickle as pkl
 import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Iterator, Optional, Union
 
+import numpy as np
+import pandas as pd
 from pymongo import MongoClient
 
-from domain.models import Forecast, Location
+from analysis.alignment import naive_utc, to_utc
+from domain.models import Forecast, ForecastModels, Location, WeatherParams
+from domain.schema import CANONICAL_SCHEMA
+from utils import GridIndex, delta_codec
+
+
+def _path_part(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", value)
+
+
+def _index_timestamp(timestamp: datetime) -> str:
+    """
+    Fixed width UTC representation, so timestamps compare correctly as strings.
+    """
+    return to_utc([timestamp])[0].strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+@dataclasses.dataclass(frozen=True)
+class ForecastQuery:
+    """
+    Filters of a forecast repository query. Ranges include both ends; unset
+    filters match everything.
+    """
+
+    location: Optional[Location] = None
+    weather_model: Optional[ForecastModels] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    valid_from: Optional[datetime] = None
+    valid_to: Optional[datetime] = None
+
+
+class ForecastIndex:
+    """
+    SQLite index of forecast metadata, maintained next to the stored forecasts.
+
+    Queries are ordered by (created_at, id) and resolved through the indexes
+    below, so they cost O(matches) rather than O(stored forecasts).
+
+    One connection is shared by all threads and serialized by a lock.
+    """
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS forecasts (
+            id INTEGER PRIMARY KEY,
+            location_name TEXT NOT NULL,
+            lon TEXT NOT NULL,
+            lat TEXT NOT NULL,
+            weather_model TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            valid_at TEXT NOT NULL,
+            fingerprint TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_location_model_created"
+        " ON forecasts (location_name, lon, lat, weather_model, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_model_created ON forecasts (weather_model, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_created ON forecasts (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_valid ON forecasts (valid_at)",
+        # Every content is stored once; forecasts without a fingerprint are NULL.
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_fingerprint ON forecasts (fingerprint)",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._connection is None:
+                connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                with connection:
+                    self._migrate(connection)
+                    for statement in self.SCHEMA:
+                        connection.execute(statement)
+                self._connection = connection
+            return self._connection
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection) -> None:
+        """
+        Add the fingerprint column to indexes created before it existed, and
+        make fingerprints unique by clearing them on all but the lowest id.
+        """
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(forecasts)")]
+        if columns and "fingerprint" not in columns:
+            connection.execute("ALTER TABLE forecasts ADD COLUMN fingerprint TEXT")
+        unique = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_fingerprint'"
+        ).fetchone()
+        if columns and unique is None:
+            connection.execute("DROP INDEX IF EXISTS ix_fingerprint")
+            connection.execute(
+                "UPDATE forecasts SET fingerprint = NULL WHERE id NOT IN"
+                " (SELECT MIN(id) FROM forecasts GROUP BY fingerprint)"
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def _row(forecast: Forecast, fingerprint: Optional[str]) -> tuple:
+        return (
+            forecast.id,
+            forecast.location.name,
+            forecast.location.lon,
+            forecast.location.lat,
+            forecast.weather_model.value,
+            _index_timestamp(forecast.created_at),
+            _index_timestamp(forecast.valid_at),
+            fingerprint,
+        )
+
+    def add(self, forecasts: list[Forecast]) -> None:
+        """
+        Index forecasts, replacing rows of the same ids. A fingerprint indexed
+        already, or earlier in forecasts, is left out of the row.
+        """
+        with self._lock:
+            indexed = self.find_fingerprints([forecast.fingerprint for forecast in forecasts])
+            rows = []
+            for forecast in forecasts:
+                fingerprint = forecast.fingerprint
+                owner = indexed.setdefault(fingerprint, forecast.id)
+                rows.append(self._row(forecast, fingerprint if owner == forecast.id else None))
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+
+    def insert(self, forecasts: list[Forecast]) -> dict[str, int]:
+        """
+        Index forecasts whose fingerprint is not indexed yet and return the id
+        indexed under each of their fingerprints, which for the others is the id
+        of the forecast that was stored first.
+        """
+        rows = [self._row(forecast, forecast.fingerprint) for forecast in forecasts]
+        with self._lock:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO forecasts VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+            return self.find_fingerprints([row[-1] for row in rows])
+
+    def clear(self) -> None:
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM forecasts")
+
+    def find_fingerprints(self, fingerprints: list[str]) -> dict[str, int]:
+        """
+        Lowest id stored under each of the fingerprints that are already indexed.
+        """
+        found: dict[str, int] = {}
+        unique = list(set(fingerprints))
+        for start in range(0, len(unique), 500):
+            stop = start + 500
+            batch = unique[start:stop]
+            with self._lock:
+                rows = self.connection.execute(
+                    "SELECT fingerprint, MIN(id) FROM forecasts"
+                    f" WHERE fingerprint IN ({', '.join('?' * len(batch))}) GROUP BY fingerprint",
+                    batch,
+                ).fetchall()
+            found.update(rows)
+        return found
+
+    @staticmethod
+    def _where(query: ForecastQuery) -> tuple[list[str], list]:
+        conditions, params = [], []
+        if query.location is not None:
+            conditions.append("location_name = ? AND lon = ? AND lat = ?")
+            params += [query.location.name, query.location.lon, query.location.lat]
+        if query.weather_model is not None:
+            conditions.append("weather_model = ?")
+            params.append(query.weather_model.value)
+        ranges = (
+            ("created_at >= ?", query.created_from),
+            ("created_at <= ?", query.created_to),
+            ("valid_at >= ?", query.valid_from),
+            ("valid_at <= ?", query.valid_to),
+        )
+        for condition, value in ranges:
+            if value is not None:
+                conditions.append(condition)
+                params.append(_index_timestamp(value))
+        return conditions, params
+
+    def find_ids(
+        self,
+        query: ForecastQuery,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        after: Optional[tuple[str, int]] = None,
+    ) -> list[tuple[str, int]]:
+        """
+        (created_at, id) keys of matching forecasts. `after` continues from a
+        previously returned key, which is cheaper than a large offset.
+        """
+        conditions, params = self._where(query)
+        if after is not None:
+            conditions.append("(created_at, id) > (?, ?)")
+            params += list(after)
+
+        sql = "SELECT created_at, id FROM forecasts"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY created_at, id LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
 
 
 class PklRepository:
     #: Storage directory.
     BASE_DIR: str
+    INDEX_FILE = "forecast_index.sqlite"
+    #: Next free identifier, guarded by an exclusive lock on ID_LOCK_FILE.
+    ID_COUNTER_FILE = "next_forecast_id"
+    ID_LOCK_FILE = "next_forecast_id.lock"
+    SEGMENT_REGEX = re.compile(r"segment_([1-9]\d*)_([1-9]\d*).pkl$")
 
     def __init__(self, base_dir: str = "storage/pkl_repo"):
         self.BASE_DIR = base_dir
+        self.index = ForecastIndex(os.path.join(base_dir, self.INDEX_FILE))
+        #: Sorted (first id, last id) ranges of the known segment files.
+        self._segments: list[tuple[int, int]] = []
 
-    def _save_forecast(self, forecast: Forecast):
-        with open(f"{self.BASE_DIR}/forecast_{forecast.id}.pkl", "wb") as f:
-            pkl.dump(forecast, f)
-        return forecast
+    def _write_atomic(self, path: str, obj) -> None:
+        """
+        Write obj next to path and rename it into place once it is on disk,
+        so readers never see a partially written file.
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pkl.dump(obj, f, protocol=pkl.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._fsync_dir()
+
+    def _fsync_dir(self) -> None:
+        """
+        Flush the directory entry of a renamed file, so the rename survives a crash.
+        """
+        fd = os.open(self.BASE_DIR, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def _writer_lock(self) -> Iterator[None]:
+        """
+        Exclusive lock on ID_LOCK_FILE, held by one writer at a time across
+        threads and processes sharing the storage directory.
+        """
+        with open(os.path.join(self.BASE_DIR, self.ID_LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _next_ids(self, count: int) -> range:
+        """
+        Take count consecutive identifiers from the counter; the writer lock must be held.
+        """
+        counter_path = os.path.join(self.BASE_DIR, self.ID_COUNTER_FILE)
+        try:
+            with open(counter_path) as f:
+                next_id = int(f.read())
+        except FileNotFoundError:
+            next_id = self._get_last_forecast_id() + 1
+
+        tmp_path = f"{counter_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(next_id + count))
+        os.replace(tmp_path, counter_path)
+        return range(next_id, next_id + count)
+
+    def _reserve_ids(self, count: int) -> range:
+        """
+        Reserve count consecutive identifiers. Safe with concurrent writers,
+        in threads or processes, sharing the storage directory.
+        """
+        with self._writer_lock():
+            return self._next_ids(count)
 
     def save_forecast(self, forecast: Forecast) -> Forecast:
         """
         If an object does not have id value, a new value is set,
         and object is saved to storage and returned a new instance
         of a Forecast class with the newly set identifier.
+
+        A forecast with the same content as a stored one is not written again,
+        it gets the identifier of the stored forecast instead.
         """
         if forecast.id:
             raise
 
-        next_id = self._get_last_forecast_id() + 1
-        forecast.set_id(next_id)
-        return self._save_forecast(forecast)
+        fingerprint = forecast.fingerprint
+        with self._writer_lock():
+            existing = self.index.find_fingerprints([fingerprint])
+            if existing:
+                forecast.set_id(existing[fingerprint])
+                return forecast
+
+            forecast.set_id(self._next_ids(1)[0])
+            self._write_atomic(f"{self.BASE_DIR}/forecast_{forecast.id}.pkl", forecast)
+            self.index.insert([forecast])
+        return forecast
+
+    def save_forecasts(self, forecasts: list[Forecast]) -> list[Forecast]:
+        """
+        Save many forecasts without ids into a single segment file.
+
+        A block of ids is reserved at once and the segment is written with one
+        fsync and renamed into place, so the batch is stored entirely or not at all.
+        Forecasts with the content of a stored forecast, or of an earlier one in
+        the batch, are not written and get the identifier of that forecast.
+        Lookup, write and indexing happen under the writer lock, so concurrent
+        writers never store the same content twice.
+        """
+        if not forecasts:
+            return []
+        if any(forecast.id for forecast in forecasts):
+            raise Exception("Forecasts to save can't have ids set.")
+
+        fingerprints = [forecast.fingerprint for forecast in forecasts]
+        with self._writer_lock():
+            existing = self.index.find_fingerprints(fingerprints)
+            new: dict[str, Forecast] = {}
+            for fingerprint, forecast in zip(fingerprints, forecasts):
+                if fingerprint not in existing:
+                    new.setdefault(fingerprint, forecast)
+
+            if new:
+                ids = self._next_ids(len(new))
+                for forecast_id, forecast in zip(ids, new.values()):
+                    forecast.set_id(forecast_id)
+
+                path = os.path.join(self.BASE_DIR, f"segment_{ids[0]}_{ids[-1]}.pkl")
+                self._write_atomic(path, {forecast.id: forecast for forecast in new.values()})
+                existing.update(self.index.insert(list(new.values())))
+
+        for fingerprint, forecast in zip(fingerprints, forecasts):
+            if not forecast.id:
+                forecast.set_id(existing[fingerprint])
+        return forecasts
 
     def _retrieve_forecast(self, forecast_id: int):
         with open(f"{self.BASE_DIR}/forecast_{str(forecast_id)}.pkl", "rb") as f:
@@ -41,9 +379,51 @@ class PklRepository:
                 raise
         return forecast
 
+    def _load_segments(self) -> None:
+        matches = (self.SEGMENT_REGEX.match(file) for file in os.listdir(self.BASE_DIR))
+        self._segments = sorted((int(m.group(1)), int(m.group(2))) for m in matches if m)
+
+    def _find_segment(self, forecast_id: int) -> Optional[tuple[int, int]]:
+        """
+        Segment holding forecast_id, or None if it is stored in a file of its own.
+        """
+        if os.path.exists(f"{self.BASE_DIR}/forecast_{str(forecast_id)}.pkl"):
+            return None
+        for reload in (False, True):
+            if reload:
+                self._load_segments()
+            position = bisect.bisect_right(self._segments, (forecast_id, float("inf"))) - 1
+            if position >= 0 and self._segments[position][1] >= forecast_id:
+                return self._segments[position]
+        return None
+
+    def _retrieve_segment(self, segment: tuple[int, int]) -> dict[int, Forecast]:
+        with open(f"{self.BASE_DIR}/segment_{segment[0]}_{segment[1]}.pkl", "rb") as f:
+            return pkl.load(f)
+
     def retrieve_forecast(self, forecast_id: int) -> Forecast:
+        segment = self._find_segment(forecast_id)
+        if segment is not None:
+            return self._retrieve_segment(segment)[forecast_id]
         return self._retrieve_forecast(forecast_id)
 
+    def retrieve_forecasts(self, forecast_ids: list[int]) -> list[Forecast]:
+        """
+        Retrieve many forecasts in the given order, opening every segment file once.
+        """
+        by_segment: dict[Optional[tuple[int, int]], list[int]] = {}
+        for forecast_id in forecast_ids:
+            by_segment.setdefault(self._find_segment(forecast_id), []).append(forecast_id)
+
+        forecasts = {}
+        for segment, ids in by_segment.items():
+            if segment is None:
+                forecasts.update({fid: self._retrieve_forecast(fid) for fid in ids})
+            else:
+                stored = self._retrieve_segment(segment)
+                forecasts.update({fid: stored[fid] for fid in ids})
+        return [forecasts[forecast_id] for forecast_id in forecast_ids]
+
     def _get_last_forecast_id(self) -> int:
         """
         Search for all records in the storage and return the identifier
@@ -52,11 +432,53 @@ class PklRepository:
         regex = re.compile(r"forecast_[1-9]\d*.pkl$")
 
         forecast_names = [file for file in os.listdir(self.BASE_DIR) if regex.match(file)]
-        if not forecast_names:
-            return 0
         forecast_ids = [int(fname[9:-4]) for fname in forecast_names]
+        self._load_segments()
+        forecast_ids += [last for _, last in self._segments]
+        if not forecast_ids:
+            return 0
         return max(forecast_ids)
 
+    def rebuild_index(self) -> None:
+        """
+        Recreate the index from all stored forecasts, e.g. for storage written
+        before the index existed.
+        """
+        regex = re.compile(r"forecast_([1-9]\d*).pkl$")
+        matches = (regex.match(file) for file in os.listdir(self.BASE_DIR))
+        forecasts = [self._retrieve_forecast(int(match.group(1))) for match in matches if match]
+        self._load_segments()
+        for segment in self._segments:
+            forecasts += self._retrieve_segment(segment).values()
+        self.index.clear()
+        # Of stored forecasts with equal content, the lowest id owns the fingerprint.
+        self.index.add(sorted(forecasts, key=lambda forecast: forecast.id))
+
+    def query_forecast_ids(
+        self, query: ForecastQuery, limit: Optional[int] = None, offset: int = 0
+    ) -> list[int]:
+        return [forecast_id for _, forecast_id in self.index.find_ids(query, limit, offset)]
+
+    def query_forecasts(
+        self, query: ForecastQuery, limit: Optional[int] = None, offset: int = 0
+    ) -> list[Forecast]:
+        """
+        A page of forecasts matching query, ordered by created_at.
+        """
+        return self.retrieve_forecasts(self.query_forecast_ids(query, limit, offset))
+
+    def iter_forecasts(self, query: ForecastQuery, batch_size: int = 100) -> Iterator[Forecast]:
+        """
+        Lazily yield every forecast matching query, ordered by created_at.
+        """
+        after = None
+        while True:
+            keys = self.index.find_ids(query, limit=batch_size, after=after)
+            yield from self.retrieve_forecasts([forecast_id for _, forecast_id in keys])
+            if len(keys) < batch_size:
+                return
+            after = keys[-1]
+
 
 @dataclasses.dataclass(frozen=True)
 class DBConfig:
@@ -85,3 +507,661 @@ class LocationRepository:
             return self.locations_data[location_name]
         except KeyError:
             raise Exception("Location not found.")
+
+
+class LocationCatalog:
+    """
+    Catalog of spots stored in a CSV or Parquet file.
+
+    The file needs `name`, `lat` and `lon` columns and may have a `key` column
+    used for name lookups, otherwise the lowercased name is used. Data is loaded
+    on the first query; coordinates are kept as float arrays behind a GridIndex.
+    """
+
+    def __init__(self, path: str, cell_size: float = 1.0):
+        self.path = path
+        self.cell_size = cell_size
+        self._names: Optional[np.ndarray] = None
+        self._keys: dict[str, int] = {}
+        self._index: Optional[GridIndex] = None
+
+    def _read(self) -> pd.DataFrame:
+        if self.path.endswith(".parquet"):
+            return pd.read_parquet(self.path)
+        return pd.read_csv(self.path)
+
+    def _load(self) -> GridIndex:
+        if self._index is not None:
+            return self._index
+
+        data = self._read()
+        missing = {"name", "lat", "lon"} - set(data.columns)
+        if missing:
+            raise Exception(f"Locations file {self.path} is missing columns: {sorted(missing)}.")
+
+        names = data["name"].astype(str).to_numpy()
+        keys = data["key"].astype(str) if "key" in data.columns else data["name"].astype(str)
+        self._keys = {key.lower(): position for position, key in enumerate(keys)}
+        self._names = names
+        self._index = GridIndex(
+            data["lat"].to_numpy(dtype=float),
+            data["lon"].to_numpy(dtype=float),
+            cell_size=self.cell_size,
+        )
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    @property
+    def lats(self) -> np.ndarray:
+        return self._load().lats
+
+    @property
+    def lons(self) -> np.ndarray:
+        return self._load().lons
+
+    def _to_locations(self, positions) -> list[Location]:
+        index = self._load()
+        return [
+            Location(name=self._names[i], lon=str(index.lons[i]), lat=str(index.lats[i]))
+            for i in positions
+        ]
+
+    def get_location(self, location_name: str) -> Location:
+        self._load()
+        try:
+            position = self._keys[location_name.lower()]
+        except KeyError:
+            raise Exception("Location not found.")
+        return self._to_locations([position])[0]
+
+    def within_bbox(
+        self, min_lat: float, min_lon: float, max_lat: float, max_lon: float
+    ) -> list[Location]:
+        return self._to_locations(self._load().query_bbox(min_lat, min_lon, max_lat, max_lon))
+
+    def within_radius(self, lat: float, lon: float, radius_km: float) -> list[Location]:
+        positions, _ = self._load().query_radius(lat, lon, radius_km)
+        return self._to_locations(positions)
+
+    def nearest(self, lat: float, lon: float, k: int = 1) -> list[Location]:
+        positions, _ = self._load().query_nearest(lat, lon, k)
+        return self._to_locations(positions)
+
+
+class ForecastCube:
+    """
+    Dense issue time x lead time array of a single forecast parameter.
+
+    Values live in a raw float32 file memory-mapped on read. Row i holds the run
+    issued at origin + i * issue_step and column j its value at lead j * lead_step.
+    Missing values are NaN. New runs are appended at the end of the file, so
+    stored rows are never rewritten.
+    """
+
+    META_FILE = "meta.json"
+    VALUES_FILE = "values.f4"
+    DTYPE = np.dtype("<f4")
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, self.META_FILE)) as f:
+            meta = json.load(f)
+        self.origin = pd.Timestamp(meta["origin"])
+        self.issue_step = pd.Timedelta(seconds=meta["issue_step"])
+        self.lead_step = pd.Timedelta(seconds=meta["lead_step"])
+        self.n_leads: int = meta["n_leads"]
+
+    @classmethod
+    def create(
+        cls,
+        path: str,
+        origin: datetime,
+        issue_step: timedelta,
+        lead_step: timedelta,
+        n_leads: int,
+    ) -> "ForecastCube":
+        os.makedirs(path, exist_ok=True)
+        meta = {
+            "origin": to_utc([origin])[0].isoformat(),
+            "issue_step": pd.Timedelta(issue_step).total_seconds(),
+            "lead_step": pd.Timedelta(lead_step).total_seconds(),
+            "n_leads": n_leads,
+        }
+        with open(os.path.join(path, cls.META_FILE), "w") as f:
+            json.dump(meta, f)
+        open(os.path.join(path, cls.VALUES_FILE), "ab").close()
+        return cls(path)
+
+    @property
+    def _values_path(self) -> str:
+        return os.path.join(self.path, self.VALUES_FILE)
+
+    @property
+    def n_issues(self) -> int:
+        return os.path.getsize(self._values_path) // (self.n_leads * self.DTYPE.itemsize)
+
+    @property
+    def issue_times(self) -> pd.DatetimeIndex:
+        return self.origin + self.issue_step * np.arange(self.n_issues)
+
+    @property
+    def leads(self) -> pd.TimedeltaIndex:
+        return pd.TimedeltaIndex(self.lead_step * np.arange(self.n_leads))
+
+    @property
+    def values(self) -> np.ndarray:
+        """
+        Read-only memory map of the whole cube.
+        """
+        if self.n_issues == 0:
+            return np.empty((0, self.n_leads), dtype=self.DTYPE)
+        return np.memmap(
+            self._values_path, dtype=self.DTYPE, mode="r", shape=(self.n_issues, self.n_leads)
+        )
+
+    def _steps(self, delta: pd.TimedeltaIndex, step: pd.Timedelta) -> np.ndarray:
+        steps, remainder = np.divmod(delta.asi8, step.value)
+        if remainder.any():
+            raise Exception(f"Timestamps are not aligned to the {step} step of the cube.")
+        return steps
+
+    def _row(self, issue_time: datetime) -> int:
+        delta = pd.TimedeltaIndex([to_utc([issue_time])[0] - self.origin])
+        return int(self._steps(delta, self.issue_step)[0])
+
+    def append_run(self, issue_time: datetime, data: pd.Series) -> None:
+        """
+        Store a run given as a series of values indexed by valid time.
+
+        Runs newer than the last row are appended (gaps are NaN rows); an
+        older run may only fill a row that is still empty.
+        """
+        row = self._row(issue_time)
+        if row < 0:
+            raise Exception("Run issued before the origin of the cube.")
+
+        issue_time = self.origin + row * self.issue_step
+        leads = self._steps(to_utc(data.index) - issue_time, self.lead_step)
+        inside = (leads >= 0) & (leads < self.n_leads)
+        run = np.full(self.n_leads, np.nan, dtype=self.DTYPE)
+        run[leads[inside]] = data.to_numpy(dtype=self.DTYPE)[inside]
+
+        n_issues = self.n_issues
+        if row >= n_issues:
+            padding = np.full((row - n_issues, self.n_leads), np.nan, dtype=self.DTYPE)
+            with open(self._values_path, "ab") as f:
+                f.write(padding.tobytes())
+                f.write(run.tobytes())
+            return
+
+        stored = np.memmap(
+            self._values_path, dtype=self.DTYPE, mode="r+", shape=(n_issues, self.n_leads)
+        )
+        if not np.isnan(stored[row]).all():
+            raise Exception(f"Run issued at {issue_time} is already stored.")
+        stored[row] = run
+        stored.flush()
+
+    def by_issue(self, issue_time: datetime) -> pd.Series:
+        """
+        Run issued at issue_time, indexed by valid time.
+        """
+        row = self._row(issue_time)
+        issue_time = self.origin + row * self.issue_step
+        if not 0 <= row < self.n_issues:
+            raise Exception(f"Run issued at {issue_time} not found.")
+        return pd.Series(
+            np.array(self.values[row]),
+            index=pd.DatetimeIndex(issue_time + self.leads, name=WeatherParams.TIMESTAMP),
+        )
+
+    def by_lead(self, lead: timedelta) -> pd.Series:
+        """
+        Values at a fixed lead time from every run, indexed by issue time.
+        """
+        column = int(self._steps(pd.TimedeltaIndex([lead]), self.lead_step)[0])
+        if not 0 <= column < self.n_leads:
+            raise Exception(f"Lead time {lead} is outside of the cube.")
+        return pd.Series(np.array(self.values[:, column]), index=self.issue_times)
+
+    def valid_at(self, valid_time: datetime) -> pd.Series:
+        """
+        Every forecast for valid_time across runs (a diagonal of the cube), indexed
+        by issue time. Runs that do not cover valid_time are left out.
+        """
+        rows = np.arange(self.n_issues)
+        delta = to_utc([valid_time])[0] - self.origin - rows * self.issue_step
+        columns, remainder = np.divmod(pd.TimedeltaIndex(delta).asi8, self.lead_step.value)
+        inside = (remainder == 0) & (columns >= 0) & (columns < self.n_leads)
+        rows, columns = rows[inside], columns[inside]
+        return pd.Series(
+            np.array(self.values[rows, columns]), index=self.issue_times[rows]
+        ).dropna()
+
+
+class ForecastCubeRepository:
+    """
+    Keeps one ForecastCube per (location, model, parameter).
+
+    Runs are indexed by the forecast created_at time floored to issue_step.
+    """
+
+    def __init__(
+        self,
+        base_dir: str = "storage/cubes",
+        issue_step: timedelta = timedelta(hours=1),
+        lead_step: timedelta = timedelta(hours=1),
+        n_leads: int = 24 * 16,
+    ):
+        self.BASE_DIR = base_dir
+        self.issue_step = issue_step
+        self.lead_step = lead_step
+        self.n_leads = n_leads
+
+    def _path(
+        self, location: Location, model: ForecastModels, param: Union[WeatherParams, str]
+    ) -> str:
+        return os.path.join(
+            self.BASE_DIR,
+            _path_part(location.name),
+            _path_part(model.value),
+            WeatherParams(param).value,
+        )
+
+    def get_cube(
+        self, location: Location, model: ForecastModels, param: WeatherParams
+    ) -> ForecastCube:
+        path = self._path(location, model, param)
+        if not os.path.exists(path):
+            raise Exception(f"No forecasts stored for {location.name}, {model.value}, {param}.")
+        return ForecastCube(path)
+
+    def save_forecast(self, forecast: Forecast) -> None:
+        issue_time = to_utc([forecast.created_at])[0].floor(pd.Timedelta(self.issue_step))
+        for param in forecast.data.columns:
+            path = self._path(forecast.location, forecast.weather_model, param)
+            if os.path.exists(path):
+                cube = ForecastCube(path)
+            else:
+                cube = ForecastCube.create(
+                    path, issue_time, self.issue_step, self.lead_step, self.n_leads
+                )
+            cube.append_run(issue_time, forecast.data[param])
+
+    def get_valid_at(
+        self,
+        location: Location,
+        model: ForecastModels,
+        param: WeatherParams,
+        valid_time: datetime,
+    ) -> pd.Series:
+        return self.get_cube(location, model, param).valid_at(valid_time)
+
+
+class DeltaForecastRepository:
+    """
+    Stores successive forecast runs of every (location, model) as deltas.
+
+    Each run is quantized to the precision of its params in CANONICAL_SCHEMA,
+    encoded against the previous run of the same location and model and
+    compressed. Every `keyframe_interval`-th run is stored in full, so reading
+    any run decodes at most that many files.
+    """
+
+    RUN_FILE_REGEX = re.compile(r"run_(\d+).bin$")
+    #: Held while a run is appended to a chain, so writers see each other's runs.
+    CHAIN_LOCK_FILE = "chain.lock"
+
+    def __init__(self, base_dir: str = "storage/delta_repo", keyframe_interval: int = 12):
+        self.BASE_DIR = base_dir
+        self.keyframe_interval = keyframe_interval
+        #: Last run decoded or written per chain directory, to encode the next delta.
+        self._last_runs: dict[str, tuple[int, delta_codec.Run]] = {}
+
+    def _chain_dir(self, location: Location, model: ForecastModels) -> str:
+        return os.path.join(self.BASE_DIR, _path_part(location.name), _path_part(model.value))
+
+    @staticmethod
+    def _run_path(chain_dir: str, seq: int) -> str:
+        return os.path.join(chain_dir, f"run_{seq:08d}.bin")
+
+    def list_runs(self, location: Location, model: ForecastModels) -> list[int]:
+        chain_dir = self._chain_dir(location, model)
+        if not os.path.isdir(chain_dir):
+            return []
+        matches = (self.RUN_FILE_REGEX.match(name) for name in os.listdir(chain_dir))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    @staticmethod
+    def _precisions(columns) -> np.ndarray:
+        try:
+            return np.array(
+                [CANONICAL_SCHEMA[WeatherParams(column)].precision for column in columns]
+            )
+        except (KeyError, ValueError) as error:
+            raise Exception(f"Column {error.args[0]} is not a canonical weather param.")
+
+    def _to_run(self, forecast: Forecast) -> delta_codec.Run:
+        data = forecast.data.sort_index()
+        columns = [WeatherParams(column).value for column in data.columns]
+        values, missing = delta_codec.quantize(
+            data.to_numpy(dtype="float64"), self._precisions(columns)
+        )
+        meta = {
+            "created_at": forecast.created_at.isoformat(),
+            "valid_at": forecast.valid_at.isoformat(),
+            "columns": columns,
+            "location": dataclasses.asdict(forecast.location),
+            "weather_model": forecast.weather_model.value,
+            "fingerprint": forecast.fingerprint,
+        }
+        return delta_codec.Run(
+            timestamps=to_utc(data.index).asi8, values=values, missing=missing, meta=meta
+        )
+
+    def _to_forecast(self, run: delta_codec.Run, seq: int) -> Forecast:
+        columns = [WeatherParams(column) for column in run.meta["columns"]]
+        data = pd.DataFrame(
+            delta_codec.dequantize(run, self._precisions(columns)),
+            index=pd.DatetimeIndex(pd.to_datetime(run.timestamps, utc=True)),
+            columns=columns,
+        )
+        data.index.name = WeatherParams.TIMESTAMP
+        return Forecast(
+            id=seq,
+            created_at=datetime.fromisoformat(run.meta["created_at"]),
+            valid_at=datetime.fromisoformat(run.meta["valid_at"]),
+            data=data,
+            location=Location(**run.meta["location"]),
+            weather_model=ForecastModels(run.meta["weather_model"]),
+        )
+
+    def _load_run(self, chain_dir: str, seq: int) -> delta_codec.Run:
+        """
+        Decode run seq starting from the closest keyframe or cached run before it.
+        """
+        cached_seq, cached_run = self._last_runs.get(chain_dir, (-1, None))
+        if cached_seq == seq:
+            return cached_run
+
+        payloads = []
+        for position in range(seq, -1, -1):
+            if position == cached_seq:
+                break
+            with open(self._run_path(chain_dir, position), "rb") as f:
+                payloads.append(f.read())
+            if delta_codec.is_keyframe(payloads[-1]):
+                cached_run = None
+                break
+
+        run = cached_run
+        for payload in reversed(payloads):
+            run = delta_codec.decode(payload, run)
+        self._last_runs[chain_dir] = (seq, run)
+        return run
+
+    def save_forecast(self, forecast: Forecast) -> int:
+        """
+        Store forecast as the next run of its location and model and return its sequence number.
+
+        A forecast with the same content as the latest run is not stored again,
+        the sequence number of that run is returned instead. Concurrent writers
+        of a chain take turns on its lock file.
+        """
+        chain_dir = self._chain_dir(forecast.location, forecast.weather_model)
+        os.makedirs(chain_dir, exist_ok=True)
+        run = self._to_run(forecast)
+        with open(os.path.join(chain_dir, self.CHAIN_LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                runs = self.list_runs(forecast.location, forecast.weather_model)
+                if runs:
+                    latest = self._load_run(chain_dir, runs[-1])
+                    if latest.meta.get("fingerprint") == run.meta["fingerprint"]:
+                        return runs[-1]
+                seq = runs[-1] + 1 if runs else 0
+
+                if seq % self.keyframe_interval == 0:
+                    payload = delta_codec.encode(run)
+                else:
+                    payload = delta_codec.encode(run, self._load_run(chain_dir, seq - 1))
+
+                path = self._run_path(chain_dir, seq)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._last_runs[chain_dir] = (seq, run)
+        return seq
+
+    def retrieve_forecast(self, location: Location, model: ForecastModels, seq: int) -> Forecast:
+        chain_dir = self._chain_dir(location, model)
+        if not os.path.isfile(self._run_path(chain_dir, seq)):
+            raise FileNotFoundError(f"Run {seq} of {location.name}, {model.value} not found.")
+        return self._to_forecast(self._load_run(chain_dir, seq), seq)
+
+
+class ObservationStore:
+    """
+    Append-friendly columnar store of hourly observations per weather station.
+
+    Every station directory holds one raw int64 file of UTC timestamps, one raw
+    float64 file per column and meta.json with the columns, the row count and the
+    synced period. meta.json is replaced last and is the commit point: readers only
+    use its first `rows` entries of every file, so bytes left after them by an
+    interrupted append are ignored and truncated by the next writer. Writers hold
+    an exclusive lock on the station, readers a shared one.
+
+    New hours are appended to the end of the files. Only when a write changes rows
+    that are already stored, e.g. late corrections, are the files written aside and
+    renamed into place. Reads only touch the rows of the requested period.
+    """
+
+    META_FILE = "meta.json"
+    TIMESTAMPS_FILE = "timestamps.i8"
+    LOCK_FILE = "station.lock"
+
+    def __init__(self, base_dir: str = "storage/observations"):
+        self.BASE_DIR = base_dir
+
+    def _station_dir(self, station_id: str) -> str:
+        return os.path.join(self.BASE_DIR, _path_part(station_id))
+
+    def _column_path(self, station_id: str, column: str) -> str:
+        return os.path.join(self._station_dir(station_id), f"{_path_part(column)}.f8")
+
+    def _timestamps_path(self, station_id: str) -> str:
+        return os.path.join(self._station_dir(station_id), self.TIMESTAMPS_FILE)
+
+    @contextlib.contextmanager
+    def _locked(self, station_id: str, operation: int) -> Iterator[None]:
+        station_dir = self._station_dir(station_id)
+        os.makedirs(station_dir, exist_ok=True)
+        with open(os.path.join(station_dir, self.LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_meta(self, station_id: str) -> Optional[dict]:
+        """
+        Meta of the station, or None if nothing consistent is stored.
+        """
+        try:
+            with open(os.path.join(self._station_dir(station_id), self.META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        paths = [self._timestamps_path(station_id)]
+        paths += [self._column_path(station_id, column) for column in meta["columns"]]
+        try:
+            sizes = {os.path.getsize(path) for path in paths}
+        except FileNotFoundError:
+            return None
+        if meta.get("rows") is None:
+            # Stores written before the row count: only files of one length are usable.
+            if len(sizes) != 1:
+                return None
+            meta["rows"] = sizes.pop() // 8
+        if min(sizes) < meta["rows"] * 8:
+            return None
+        return meta
+
+    def get_meta(self, station_id: str) -> Optional[dict]:
+        if not os.path.isdir(self._station_dir(station_id)):
+            return None
+        with self._locked(station_id, fcntl.LOCK_SH):
+            return self._read_meta(station_id)
+
+    def synced_period(self, station_id: str) -> Optional[tuple[datetime, datetime]]:
+        """
+        Period [first, last] whose observations are in the store.
+        """
+        return self._period(self.get_meta(station_id))
+
+    @staticmethod
+    def _period(meta: Optional[dict]) -> Optional[tuple[datetime, datetime]]:
+        if meta is None or meta.get("synced_from") is None:
+            return None
+        return (
+            datetime.fromisoformat(meta["synced_from"]),
+            datetime.fromisoformat(meta["synced_to"]),
+        )
+
+    @staticmethod
+    def _replace(path: str, write) -> None:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _timestamps(self, station_id: str, meta: Optional[dict]) -> np.ndarray:
+        if meta is None:
+            return np.empty(0, dtype=np.int64)
+        return np.fromfile(self._timestamps_path(station_id), dtype=np.int64, count=meta["rows"])
+
+    def _append(self, path: str, rows: int, array: np.ndarray) -> None:
+        """
+        Cut the file at rows entries, dropping uncommitted bytes, and append array.
+        """
+        with open(path, "ab") as f:
+            f.truncate(rows * 8)
+            f.write(np.ascontiguousarray(array).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_rows(self, station_id: str, columns: list[str], start: int, stop: int) -> np.ndarray:
+        values = np.empty((max(stop - start, 0), len(columns)))
+        if len(values) == 0:
+            return values
+        for position, column in enumerate(columns):
+            with open(self._column_path(station_id, column), "rb") as f:
+                f.seek(start * 8)
+                values[:, position] = np.fromfile(f, dtype=np.float64, count=stop - start)
+        return values
+
+    def read(self, station_id: str, start: datetime, end: datetime) -> pd.DataFrame:
+        """
+        Stored observations in [start, end] with a naive UTC index.
+        """
+        empty = pd.DataFrame(index=pd.DatetimeIndex([], name=WeatherParams.TIMESTAMP))
+        if not os.path.isdir(self._station_dir(station_id)):
+            return empty
+        with self._locked(station_id, fcntl.LOCK_SH):
+            meta = self._read_meta(station_id)
+            if meta is None:
+                return empty
+            columns = meta["columns"]
+            timestamps = self._timestamps(station_id, meta)
+            bounds = to_utc(pd.DatetimeIndex([start, end])).asi8
+            first = np.searchsorted(timestamps, bounds[0])
+            stop = np.searchsorted(timestamps, bounds[1], side="right")
+            values = self._read_rows(station_id, columns, first, stop)
+
+        index = pd.DatetimeIndex(timestamps[first:stop], name=WeatherParams.TIMESTAMP)
+        return pd.DataFrame(values, index=index, columns=[WeatherParams(c) for c in columns])
+
+    def write(
+        self,
+        station_id: str,
+        data: pd.DataFrame,
+        start: datetime,
+        end: datetime,
+    ) -> None:
+        """
+        Replace the stored observations in [start, end] by data and extend the
+        synced period by it. Rows outside the period are kept.
+
+        Writing at the end of the store costs only the new rows, as long as the
+        stored rows it replaces are unchanged; otherwise the files are rewritten.
+        """
+        with self._locked(station_id, fcntl.LOCK_EX):
+            stored = self._read_meta(station_id)
+            meta = stored or {"columns": [column.value for column in data.columns], "rows": 0}
+            columns, rows = meta["columns"], meta["rows"]
+
+            timestamps = self._timestamps(station_id, stored)
+            bounds = to_utc(pd.DatetimeIndex([start, end])).asi8
+            first = int(np.searchsorted(timestamps, bounds[0]))
+            after = int(np.searchsorted(timestamps, bounds[1], side="right"))
+
+            data = data.sort_index()
+            new_timestamps = to_utc(data.index).asi8
+            inside = (new_timestamps >= bounds[0]) & (new_timestamps <= bounds[1])
+            new_timestamps = new_timestamps[inside].astype(np.int64)
+            new_values = data.reindex(columns=columns).to_numpy(dtype="float64")[inside]
+
+            # Stored rows stay as they are if the window rewrites them unchanged and
+            # new rows only come after the last stored one.
+            replaced = after - first
+            if (
+                len(new_timestamps) >= replaced
+                and (after == rows or len(new_timestamps) == replaced)
+                and np.array_equal(timestamps[first:after], new_timestamps[:replaced])
+                and np.array_equal(
+                    self._read_rows(station_id, columns, first, after),
+                    new_values[:replaced],
+                    equal_nan=True,
+                )
+            ):
+                self._append(self._timestamps_path(station_id), rows, new_timestamps[replaced:])
+                for position, column in enumerate(columns):
+                    self._append(
+                        self._column_path(station_id, column),
+                        rows,
+                        new_values[replaced:, position],
+                    )
+                rows += len(new_timestamps) - replaced
+            else:
+                values = self._read_rows(station_id, columns, 0, rows)
+                timestamps = np.concatenate(
+                    [timestamps[:first], new_timestamps, timestamps[after:]]
+                ).astype(np.int64)
+                values = np.concatenate([values[:first], new_values, values[after:]])
+                self._replace(self._timestamps_path(station_id), timestamps.tofile)
+                for position, column in enumerate(columns):
+                    self._replace(
+                        self._column_path(station_id, column),
+                        np.ascontiguousarray(values[:, position]).tofile,
+                    )
+                rows = len(timestamps)
+
+            period = self._period(stored)
+            start, end = naive_utc(start), naive_utc(end)
+            synced_from, synced_to = start, end
+            if period is not None:
+                synced_from, synced_to = min(period[0], start), max(period[1], end)
+            meta.update(
+                rows=rows,
+                synced_from=synced_from.isoformat(),
+                synced_to=synced_to.isoformat(),
+            )
+            meta_path = os.path.join(self._station_dir(station_id), self.META_FILE)
+            self._replace(meta_path, lambda f: f.write(json.dumps(meta).encode()))
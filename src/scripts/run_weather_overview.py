@@ -1,14 +1,13 @@
+import argparse
 import datetime
 from pathlib import Path
-from typing import Sequence
+from typing import Optional, Sequence
 
-from adapters.openmeteo.client import OpenMeteoClient
-from constants import PLOTS_DIR
+from constants import PLOTS_DIR, PROFILES_DIR
+from container import Container
 from domain.models import ForecastModels, WeatherParams
-from locations_data import locations as locations_data
-from plotting import plot_weather_data_as_jpg
-from repositories import LocationRepository
-from services.weather_services import OpenMeteoExternalService, WeatherService
+from plotting import MIN_MAX, plot_weather_data_as_jpg
+from utils.profiling import Profiler, profiling_requested, stage
 
 
 def run_weather_overview(
@@ -17,7 +16,11 @@ def run_weather_overview(
     end_date: datetime.datetime,
     weather_params: Sequence[WeatherParams],
     forecast_models: Sequence[ForecastModels],
+    container: Optional[Container] = None,
 ) -> None:
+    """
+    Pass a long-lived container to reuse its clients and caches across calls.
+    """
     if len(weather_params) == 0:
         raise Exception("Weather params sequence can't be empty.")
 
@@ -26,27 +29,48 @@ def run_weather_overview(
 
     Path(PLOTS_DIR).mkdir(parents=True, exist_ok=True)
 
-    locations_repository = LocationRepository(locations_data)
-    weather_service = WeatherService()
-    open_meteo_service = OpenMeteoExternalService(client=OpenMeteoClient(config={}))
+    if container is None:
+        with Container() as container:
+            return run_weather_overview(
+                location_name, start_date, end_date, weather_params, forecast_models, container
+            )
 
-    location = locations_repository.get_location(location_name)
+    locations_repository = container.location_repository
+    weather_service = container.weather_service
+    open_meteo_service = container.get("openmeteo_service")
+
+    with stage("location lookup"):
+        location = locations_repository.get_location(location_name)
     now = datetime.datetime.utcnow()
 
-    weather = weather_service.get_weather_for_location(location, start_date, now)
+    with stage(f"fetch {weather_service.external_service.name}"):
+        weather = weather_service.get_weather_for_location(location, start_date, now)
     forecasts = []
     for forecast_model in forecast_models:
-        forecast = open_meteo_service.get_forecast(
-            location, now, end_date, weather_params, forecast_model
-        )
+        with stage(f"fetch {open_meteo_service.name} {forecast_model.value}"):
+            forecast = open_meteo_service.get_forecast(
+                location, now, end_date, weather_params, forecast_model
+            )
         forecasts.append(forecast)
 
-    composite_data = weather + forecasts[0]
+    with stage("combine"):
+        composite_data = weather + forecasts[0]
 
-    plot_weather_data_as_jpg(composite_data, weather_params[0], "weather_and_forecast.jpg")
+    with stage("plot"):
+        plot_weather_data_as_jpg(
+            composite_data, weather_params[0], "weather_and_forecast.jpg", downsample=MIN_MAX
+        )
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot weather and forecast for a location.")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Write timings and profiles to {PROFILES_DIR} (or set FF_PROFILE=1).",
+    )
+    args = parser.parse_args()
+
     print("Starting weather overview script.")
 
     target_location_name = "valencia"
@@ -56,12 +80,21 @@ if __name__ == "__main__":
     forecast_models = (ForecastModels.MODEL_ICON, ForecastModels.DEFAULT)
     weather_params = (WeatherParams.TEMPERATURE,)
 
-    run_weather_overview(
-        location_name=target_location_name,
-        start_date=start_date,
-        end_date=end_date,
-        weather_params=weather_params,
-        forecast_models=forecast_models,
-    )
+    def run():
+        run_weather_overview(
+            location_name=target_location_name,
+            start_date=start_date,
+            end_date=end_date,
+            weather_params=weather_params,
+            forecast_models=forecast_models,
+        )
+
+    if profiling_requested(args.profile):
+        with Profiler() as profiler:
+            run()
+        print(profiler.summary())
+        print(profiler.write(PROFILES_DIR, "run_weather_overview"))
+    else:
+        run()
 
     print("Weather overview script finished.")
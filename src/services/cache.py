@@ -0,0 +1,101 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, Iterable, Optional
+
+from domain.models import Forecast, ForecastModels, Location
+
+
+@dataclass(frozen=True)
+class ModelRunSchedule:
+    #: UTC hours at which runs start.
+    run_hours: tuple[int, ...] = (0, 6, 12, 18)
+    #: Time from the start of a run until its data is served by providers.
+    availability_delay: datetime.timedelta = datetime.timedelta(hours=4)
+
+    def latest_run(self, now: datetime.datetime) -> datetime.datetime:
+        """
+        Start time of the newest run available at now (naive UTC).
+        """
+        available_runs_of = now - self.availability_delay
+        day = datetime.datetime.combine(available_runs_of.date(), datetime.time())
+        for days_back in range(2):
+            for hour in sorted(self.run_hours, reverse=True):
+                run = day - datetime.timedelta(days=days_back) + datetime.timedelta(hours=hour)
+                if run <= available_runs_of:
+                    return run
+        raise Exception("Schedule has no run hours.")
+
+
+DEFAULT_SCHEDULES = {
+    ForecastModels.MODEL_ICON: ModelRunSchedule(availability_delay=datetime.timedelta(hours=4)),
+    ForecastModels.DEFAULT: ModelRunSchedule(availability_delay=datetime.timedelta(hours=5)),
+}
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    forecast: Forecast
+    stored_at: float
+
+
+def forecast_request_key(
+    service_name: str, location: Location, model: ForecastModels, params: Iterable
+) -> tuple:
+    """
+    Identifies what is requested, regardless of the target time.
+    """
+    return service_name, location, model, tuple(params)
+
+
+def forecast_cache_key(
+    service_name: str,
+    location: Location,
+    model: ForecastModels,
+    params: Iterable,
+    target_timestamp: datetime.datetime,
+) -> tuple:
+    """
+    Request key plus the day of target_timestamp; providers are queried per day
+    of the target, so forecasts of different days are cached apart.
+    """
+    return forecast_request_key(service_name, location, model, params) + (
+        target_timestamp.date(),
+    )
+
+
+class ForecastCache:
+    """
+    Thread-safe in-memory LRU cache of forecasts.
+    """
+
+    def __init__(self, max_size: int = 10_000, clock: Callable[[], float] = time.time):
+        self.max_size = max_size
+        self._clock = clock
+        self._entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, max_age: Optional[float] = None) -> Optional[CacheEntry]:
+        """
+        Entry stored under key, unless it is older than max_age seconds.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if max_age is not None and self._clock() - entry.stored_at > max_age:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, forecast: Forecast) -> None:
+        with self._lock:
+            self._entries[key] = CacheEntry(forecast=forecast, stored_at=self._clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
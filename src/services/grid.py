@@ -0,0 +1,401 @@
+"""
+Gridded forecasts of whole regions.
+
+A regular lat/lon grid over a region is fetched once per model run with a
+multi-point request, kept as a compact (params, time, lat, lon) float32 array,
+optionally memory-mapped from disk, and forecasts for any point inside the
+region are interpolated bilinearly from it without further API calls.
+"""
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from adapters.openmeteo.client import OpenMeteoClient
+from adapters.windycom.client import WindyComClient
+from domain.models import Forecast, ForecastModels, Location, WeatherParams
+from domain.schema import is_circular
+from services.weather_services import (ExternalForecastBaseService,
+                                       OpenMeteoExternalService,
+                                       WindyComExternalService)
+
+
+def _tmp_path(path: str) -> str:
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _read_pointer(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+@dataclass(frozen=True)
+class GridSpec:
+    lat_min: float
+    lat_max: float
+    lon_min: float
+    lon_max: float
+    #: Grid spacing in degrees.
+    step: float = 0.25
+
+    @property
+    def lats(self) -> np.ndarray:
+        return np.round(np.arange(self.lat_min, self.lat_max + self.step / 2, self.step), 6)
+
+    @property
+    def lons(self) -> np.ndarray:
+        return np.round(np.arange(self.lon_min, self.lon_max + self.step / 2, self.step), 6)
+
+    def contains(self, lat: float, lon: float) -> bool:
+        return self.lat_min <= lat <= self.lat_max and self.lon_min <= lon <= self.lon_max
+
+
+class GriddedForecast:
+    def __init__(
+        self,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        times: pd.DatetimeIndex,
+        params: Sequence[WeatherParams],
+        values: np.ndarray,
+        weather_model: ForecastModels,
+        created_at: datetime.datetime,
+    ):
+        """
+        values has shape (len(params), len(times), len(lats), len(lons)), lats
+        and lons are ascending.
+        """
+        if values.shape != (len(params), len(times), len(lats), len(lons)):
+            raise Exception(f"Unexpected shape of grid values: {values.shape}.")
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.times = pd.DatetimeIndex(times, name=WeatherParams.TIMESTAMP)
+        self.params = [WeatherParams(param) for param in params]
+        self.values = values
+        self.weather_model = weather_model
+        self.created_at = created_at
+
+    def contains(self, lat: float, lon: float) -> bool:
+        return self.lats[0] <= lat <= self.lats[-1] and self.lons[0] <= lon <= self.lons[-1]
+
+    @staticmethod
+    def _cell(axis: np.ndarray, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Index of the lower grid line of every point and its relative offset from it.
+        """
+        if len(axis) == 1:
+            return np.zeros(len(points), dtype=int), np.zeros(len(points))
+        lower = np.clip(np.searchsorted(axis, points, side="right") - 1, 0, len(axis) - 2)
+        offset = (points - axis[lower]) / (axis[lower + 1] - axis[lower])
+        return lower, offset
+
+    def interpolate(self, lats: Iterable[float], lons: Iterable[float]) -> np.ndarray:
+        """
+        Bilinear interpolation at many points, shape (points, params, time).
+
+        Points outside the grid are NaN, circular params are interpolated through
+        their sin/cos components. Missing corner values are skipped.
+        """
+        lats, lons = np.asarray(list(lats), dtype=float), np.asarray(list(lons), dtype=float)
+        i, dy = self._cell(self.lats, lats)
+        j, dx = self._cell(self.lons, lons)
+        i1, j1 = np.minimum(i + 1, len(self.lats) - 1), np.minimum(j + 1, len(self.lons) - 1)
+
+        circular = np.array([is_circular(param) for param in self.params], dtype=bool)
+        values = np.asarray(self.values, dtype="float64")
+        if circular.any():
+            radians = np.radians(values[circular])
+            values = np.concatenate([values[~circular], np.sin(radians), np.cos(radians)])
+
+        # Corner values have shape (params, time, points). Non-finite corners are left
+        # out and the weights of the others renormalised, so a point on a grid line or
+        # node only depends on the corners it lies between.
+        total = np.zeros(values.shape[:2] + (len(lats),))
+        weights = np.zeros_like(total)
+        for rows, columns, weight in (
+            (i, j, (1 - dy) * (1 - dx)),
+            (i, j1, (1 - dy) * dx),
+            (i1, j, dy * (1 - dx)),
+            (i1, j1, dy * dx),
+        ):
+            corner = values[:, :, rows, columns]
+            finite = np.isfinite(corner)
+            total += np.where(finite, corner, 0.0) * weight
+            weights += finite * weight
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = np.where(weights > 0, total / weights, np.nan)
+
+        if circular.any():
+            n_linear, n_circular = int((~circular).sum()), int(circular.sum())
+            split = n_linear + n_circular
+            directions = np.degrees(np.arctan2(result[n_linear:split], result[split:])) % 360
+            merged = np.empty((len(self.params),) + result.shape[1:])
+            merged[~circular] = result[:n_linear]
+            merged[circular] = directions
+            result = merged
+
+        outside = (
+            (lats < self.lats[0])
+            | (lats > self.lats[-1])
+            | (lons < self.lons[0])
+            | (lons > self.lons[-1])
+        )
+        result[:, :, outside] = np.nan
+        return result.transpose(2, 0, 1)
+
+    def to_forecast(self, location: Location) -> Forecast:
+        values = self.interpolate([float(location.lat)], [float(location.lon)])[0]
+        data = pd.DataFrame(values.T, index=self.times, columns=self.params)
+        return Forecast(
+            created_at=self.created_at,
+            valid_at=self.created_at,
+            data=data,
+            location=location,
+            weather_model=self.weather_model,
+        )
+
+    #: File in a saved grid directory naming the version directory to load.
+    CURRENT_FILE = "current"
+
+    def save(self, path: str) -> None:
+        """
+        Values and meta are written into a new version directory, then the
+        `current` pointer is renamed into place, so a concurrent load always sees
+        a matching pair. The previous version is removed afterwards; grids loaded
+        from it keep memory-mapping its values file.
+        """
+        os.makedirs(path, exist_ok=True)
+        version = f"v{time.time_ns()}_{os.getpid()}_{threading.get_ident()}"
+        version_dir = os.path.join(path, version)
+        os.makedirs(version_dir)
+        with open(os.path.join(version_dir, "values.npy"), "wb") as f:
+            np.save(f, np.asarray(self.values, dtype=np.float32))
+        meta = {
+            "lats": self.lats.tolist(),
+            "lons": self.lons.tolist(),
+            "times": [timestamp.isoformat() for timestamp in self.times],
+            "params": [param.value for param in self.params],
+            "weather_model": self.weather_model.value,
+            "created_at": self.created_at.isoformat(),
+        }
+        with open(os.path.join(version_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        pointer = os.path.join(path, self.CURRENT_FILE)
+        previous = _read_pointer(pointer)
+        with open(_tmp_path(pointer), "w") as f:
+            f.write(version)
+        os.replace(_tmp_path(pointer), pointer)
+        if previous is not None:
+            shutil.rmtree(os.path.join(path, previous), ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, attempts: int = 3) -> "GriddedForecast":
+        """
+        Load the current version saved at path. A version removed by a concurrent
+        save between reading the pointer and opening its files is retried.
+        """
+        for attempt in range(attempts):
+            version = _read_pointer(os.path.join(path, cls.CURRENT_FILE))
+            try:
+                # Grids saved before versioning keep their files directly in path.
+                return cls._load_files(os.path.join(path, version or ""), mmap)
+            except FileNotFoundError:
+                if version is None or attempt == attempts - 1:
+                    raise
+
+    @classmethod
+    def _load_files(cls, path: str, mmap: bool) -> "GriddedForecast":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode="r" if mmap else None)
+        return cls(
+            lats=np.array(meta["lats"]),
+            lons=np.array(meta["lons"]),
+            times=pd.DatetimeIndex([pd.Timestamp(ts) for ts in meta["times"]]),
+            params=meta["params"],
+            values=values,
+            weather_model=ForecastModels(meta["weather_model"]),
+            created_at=datetime.datetime.fromisoformat(meta["created_at"]),
+        )
+
+
+class OpenMeteoGridSource:
+    """
+    Fetches grids as one multi-point Open-Meteo request per batch of points.
+    """
+
+    def __init__(self, client: OpenMeteoClient):
+        self.client = client
+        self.service = OpenMeteoExternalService(client=client)
+
+    def fetch(
+        self, spec: GridSpec, params: Sequence[WeatherParams], model: ForecastModels
+    ) -> GriddedForecast:
+        lats, lons = spec.lats, spec.lons
+        grid_lats, grid_lons = np.meshgrid(lats, lons, indexing="ij")
+        query_params = self.service.translate_to_query_params(params)
+        points = self.client.get_forecast_points_data(
+            lons=grid_lons.ravel().tolist(),
+            lats=grid_lats.ravel().tolist(),
+            params=query_params,
+            model=self.service.translate_to_query_models([model])[0],
+        )
+
+        times = pd.DatetimeIndex([pd.Timestamp(ts) for ts in points[0]["time"]])
+        values = np.array(
+            [[point[query_param] for point in points] for query_param in query_params],
+            dtype="float64",
+        )
+        values = values.reshape(len(params), len(lats), len(lons), len(times))
+        values = self.service.CONVERSION_PLAN.apply_to_array(values, list(params))
+        return GriddedForecast(
+            lats,
+            lons,
+            times,
+            params,
+            values.transpose(0, 3, 1, 2).astype(np.float32),
+            weather_model=model,
+            created_at=datetime.datetime.utcnow(),
+        )
+
+
+class MeteomaticsGridSource:
+    """
+    Fetches grids with the Meteomatics grid query of WindyComClient.
+    """
+
+    def __init__(
+        self, client: WindyComClient, horizon: datetime.timedelta = datetime.timedelta(days=7)
+    ):
+        self.client = client
+        self.service = WindyComExternalService(client=client)
+        self.horizon = horizon
+
+    def fetch(
+        self, spec: GridSpec, params: Sequence[WeatherParams], model: ForecastModels
+    ) -> GriddedForecast:
+        lats, lons = spec.lats, spec.lons
+        start = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        query_params = self.service.translate_to_query_params(params)
+        data = self.client.get_forecast_grid_data(
+            lat_min=spec.lat_min,
+            lat_max=spec.lat_max,
+            lon_min=spec.lon_min,
+            lon_max=spec.lon_max,
+            n_lats=len(lats),
+            n_lons=len(lons),
+            start=start,
+            end=start + self.horizon,
+            params=query_params,
+            model=self.service.translate_to_query_models([model])[0],
+        )
+
+        by_param = {entry["parameter"]: entry["coordinates"] for entry in data}
+        first = by_param[query_params[0]][0]["dates"]
+        times = pd.DatetimeIndex([pd.Timestamp(date["date"]) for date in first])
+        values = np.full((len(params), len(times), len(lats), len(lons)), np.nan)
+        for position, query_param in enumerate(query_params):
+            coordinates = by_param[query_param]
+            i = np.abs(lats[:, None] - [point["lat"] for point in coordinates]).argmin(axis=0)
+            j = np.abs(lons[:, None] - [point["lon"] for point in coordinates]).argmin(axis=0)
+            series = np.array(
+                [[date["value"] for date in point["dates"]] for point in coordinates], dtype=float
+            )
+            values[position][:, i, j] = series.T
+        values = self.service.CONVERSION_PLAN.apply_to_array(values, list(params))
+        return GriddedForecast(
+            lats,
+            lons,
+            times,
+            params,
+            values.astype(np.float32),
+            weather_model=model,
+            created_at=datetime.datetime.utcnow(),
+        )
+
+
+class GridForecastService(ExternalForecastBaseService):
+    """
+    Serves point forecasts from cached region grids, fetching a grid again when
+    it is older than max_age seconds. Grids are kept in memory, or memory-mapped
+    from cache_dir when it is set.
+    """
+
+    def __init__(
+        self,
+        source,
+        regions: Sequence[GridSpec],
+        max_age: float = 3 * 3600,
+        cache_dir: Optional[str] = None,
+        clock=time.time,
+    ):
+        self.source = source
+        self.name = f"Grid{source.service.name}"
+        self.DOMAIN_TO_QUERY_PARAMS_MAP = source.service.DOMAIN_TO_QUERY_PARAMS_MAP
+        self.DOMAIN_TO_QUERY_MODELS_MAP = source.service.DOMAIN_TO_QUERY_MODELS_MAP
+        self.CONVERSION_PLAN = source.service.CONVERSION_PLAN
+        self.regions = list(regions)
+        self.max_age = max_age
+        self.cache_dir = cache_dir
+        self._clock = clock
+        self._grids: dict[tuple, tuple[float, GriddedForecast]] = {}
+        self._key_locks: dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _region(self, location: Location) -> GridSpec:
+        lat, lon = float(location.lat), float(location.lon)
+        for region in self.regions:
+            if region.contains(lat, lon):
+                return region
+        raise Exception(f"{self.name}: location {location.name} is not covered by any region.")
+
+    def get_grid(
+        self, region: GridSpec, params: Sequence[WeatherParams], model: ForecastModels
+    ) -> GriddedForecast:
+        key = (region, model, tuple(params))
+        # self._lock only guards the dicts; fetches are serialized per key.
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                cached = self._grids.get(key)
+            if cached is not None and self._clock() - cached[0] <= self.max_age:
+                return cached[1]
+
+            grid = self.source.fetch(region, list(params), model)
+            if self.cache_dir is not None:
+                name = "_".join(
+                    [f"{region.lat_min}_{region.lat_max}_{region.lon_min}_{region.lon_max}"]
+                    + [model.value]
+                    + [param.value for param in params]
+                )
+                path = os.path.join(self.cache_dir, f"grid_{name}")
+                grid.save(path)
+                grid = GriddedForecast.load(path)
+            with self._lock:
+                self._grids[key] = (self._clock(), grid)
+            return grid
+
+    def get_forecast(
+        self,
+        location: Location,
+        target_timestamp: datetime.datetime,
+        end_timestamp: datetime.datetime,
+        extra_params: Iterable,
+        model: ForecastModels,
+    ) -> Forecast:
+        grid = self.get_grid(self._region(location), list(extra_params), model)
+        forecast = grid.to_forecast(location)
+        forecast.data = forecast.data[:end_timestamp]  # type: ignore
+        return forecast
@@ -0,0 +1,179 @@
+"""
+Warming of the forecast cache ahead of user requests.
+
+Forecast models publish new runs on a fixed schedule, and the same spots are
+requested soon after every release. The Prefetcher tracks the hot request keys
+(service, location, model, params) and fetches a key again as soon as a run
+newer than the one it cached is available, or a new day has begun, within a
+request rate limit. Fetched forecasts are cached under the key of the current day.
+"""
+import datetime
+import json
+import threading
+import time
+from collections import Counter
+from typing import Callable, Iterable, Optional
+
+from domain.models import ForecastModels, Location
+from repositories import LocationRepository
+from services.cache import (DEFAULT_SCHEDULES, ForecastCache, ModelRunSchedule,
+                            forecast_cache_key, forecast_request_key)
+from services.weather_services import ForecastService
+
+
+class HotKeyTracker:
+    """
+    Counts requests per forecast request key; pass it as ForecastService.access_tracker.
+    """
+
+    def __init__(self, keys: Iterable[tuple] = ()):
+        self._counts: Counter = Counter()
+        self._pinned = set(keys)
+        self._lock = threading.Lock()
+
+    def record(self, key: tuple) -> None:
+        with self._lock:
+            self._counts[key] += 1
+
+    def pin(self, key: tuple) -> None:
+        """
+        Mark key as hot regardless of its request count.
+        """
+        with self._lock:
+            self._pinned.add(key)
+
+    def hot_keys(self, min_count: int = 2, limit: Optional[int] = None) -> list[tuple]:
+        with self._lock:
+            counted = [key for key, count in self._counts.most_common() if count >= min_count]
+            pinned = [key for key in self._pinned if key not in self._counts]
+        keys = counted + pinned
+        return keys if limit is None else keys[:limit]
+
+    @classmethod
+    def from_access_log(cls, path: str) -> "HotKeyTracker":
+        """
+        Build from a JSON lines log with service, location (name, lon, lat),
+        model and params fields per request.
+        """
+        tracker = cls()
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                tracker.record(
+                    forecast_request_key(
+                        entry["service"],
+                        Location(**entry["location"]),
+                        ForecastModels(entry["model"]),
+                        entry["params"],
+                    )
+                )
+        return tracker
+
+    @classmethod
+    def from_location_repository(
+        cls,
+        repository: LocationRepository,
+        location_names: Iterable[str],
+        service_name: str,
+        models: Iterable[ForecastModels],
+        params: Iterable,
+    ) -> "HotKeyTracker":
+        params = list(params)
+        return cls(
+            forecast_request_key(service_name, repository.get_location(name), model, params)
+            for name in location_names
+            for model in models
+        )
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` calls per second with bursts up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        forecast_service: ForecastService,
+        cache: ForecastCache,
+        tracker: HotKeyTracker,
+        rate_limiter: Optional[RateLimiter] = None,
+        schedules: Optional[dict[ForecastModels, ModelRunSchedule]] = None,
+        forecast_horizon: datetime.timedelta = datetime.timedelta(days=7),
+        max_keys: Optional[int] = None,
+    ):
+        self.forecast_service = forecast_service
+        self.cache = cache
+        self.tracker = tracker
+        self.rate_limiter = rate_limiter or RateLimiter(rate=1.0, burst=10)
+        self.schedules = schedules or DEFAULT_SCHEDULES
+        self.forecast_horizon = forecast_horizon
+        self.max_keys = max_keys
+        #: Run start time and target day last fetched per request key.
+        self._fetched_runs: dict[tuple, tuple[datetime.datetime, datetime.date]] = {}
+
+    def pending_keys(self, now: datetime.datetime) -> list[tuple[tuple, datetime.datetime]]:
+        """
+        Hot request keys with a newer run available than the cached one, or not yet
+        cached for the day of now, with the latest run.
+        """
+        pending = []
+        for key in self.tracker.hot_keys(limit=self.max_keys):
+            model = key[2]
+            latest_run = self.schedules.get(model, ModelRunSchedule()).latest_run(now)
+            if self._fetched_runs.get(key) != (latest_run, now.date()):
+                pending.append((key, latest_run))
+        return pending
+
+    def run_pending(self, now: Optional[datetime.datetime] = None) -> list[tuple]:
+        """
+        Fetch pending keys while the rate limit allows and return the fetched ones.
+        Keys left over are fetched on a later call.
+        """
+        now = now or datetime.datetime.utcnow()
+        fetched = []
+        for key, run in self.pending_keys(now):
+            if not self.rate_limiter.try_acquire():
+                break
+            service_name, location, model, params = key
+            try:
+                forecast = self.forecast_service.get_external_service(service_name).get_forecast(
+                    location=location,
+                    target_timestamp=now,
+                    end_timestamp=now + self.forecast_horizon,
+                    extra_params=params,
+                    model=model,
+                )
+            except Exception:
+                # The key stays pending and is retried on the next call.
+                continue
+            self.cache.put(forecast_cache_key(*key, target_timestamp=now), forecast)
+            self._fetched_runs[key] = run, now.date()
+            fetched.append(key)
+        return fetched
+
+    def run_forever(self, stop: threading.Event, interval: float = 60.0) -> None:
+        while not stop.is_set():
+            self.run_pending()
+            stop.wait(interval)
@@ -0,0 +1,217 @@
+"""
+Protection of forecast calls against slow or failing external services.
+
+ResilientForecastService wraps an ExternalForecastBaseService with:
+    1. a circuit breaker that stops calling a failing service for a while,
+    2. hedged requests: a duplicate call is sent when the first one is slower
+       than the p95 latency observed so far, and the first answer wins,
+    3. a fallback to the last cached forecast, marked as stale.
+"""
+import dataclasses
+import datetime
+import enum
+import threading
+import time
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from domain.models import Forecast, ForecastModels, Location
+from services.cache import ForecastCache, forecast_cache_key
+from services.weather_services import ExternalForecastBaseService
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for
+    recovery_timeout seconds. Then a single trial call is let through
+    (half-open): its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            if (
+                self._state == CircuitState.OPEN
+                and self._clock() - self._opened_at >= self.recovery_timeout
+            ):
+                self._state = CircuitState.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        state = self.state
+        with self._lock:
+            if state == CircuitState.CLOSED:
+                return True
+            if state == CircuitState.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CircuitState.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == CircuitState.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = CircuitState.OPEN
+                self._opened_at = self._clock()
+            self._trial_running = False
+
+
+class LatencyTracker:
+    """
+    Latencies of the last `window` successful calls.
+    """
+
+    def __init__(self, window: int = 200):
+        self._latencies: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        with self._lock:
+            if not self._latencies:
+                return None
+            return float(np.percentile(np.fromiter(self._latencies, float), percentile))
+
+
+class ResilientForecastService(ExternalForecastBaseService):
+    """
+    Drop-in wrapper of an external forecast service, registered under the same name.
+    """
+
+    def __init__(
+        self,
+        service: ExternalForecastBaseService,
+        breaker: Optional[CircuitBreaker] = None,
+        cache: Optional[ForecastCache] = None,
+        hedge_percentile: float = 95,
+        hedge_min_samples: int = 20,
+        timeout: Optional[float] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.service = service
+        self.name = service.name
+        self.DOMAIN_TO_QUERY_PARAMS_MAP = service.DOMAIN_TO_QUERY_PARAMS_MAP
+        self.DOMAIN_TO_QUERY_MODELS_MAP = service.DOMAIN_TO_QUERY_MODELS_MAP
+        self.CONVERSION_PLAN = service.CONVERSION_PLAN
+        self.breaker = breaker or CircuitBreaker()
+        self.cache = cache
+        self.latencies = LatencyTracker()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.timeout = timeout
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix=f"{self.name}-calls"
+        )
+
+    def _hedge_delay(self) -> Optional[float]:
+        if len(self.latencies) < self.hedge_min_samples:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    def _timed_call(self, **kwargs) -> Forecast:
+        started = time.monotonic()
+        forecast = self.service.get_forecast(**kwargs)
+        self.latencies.record(time.monotonic() - started)
+        return forecast
+
+    def _hedged_call(self, **kwargs) -> Forecast:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        pending: set[Future] = {self._executor.submit(self._timed_call, **kwargs)}
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is not None:
+            done, pending = wait(pending, timeout=hedge_delay)
+            if not done:
+                pending.add(self._executor.submit(self._timed_call, **kwargs))
+            pending |= done
+
+        error: BaseException = Exception(f"{self.name}: no call was made.")
+        while pending:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"{self.name}: no answer within {self.timeout} s.")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _fallback(self, key: tuple, error: BaseException) -> Forecast:
+        entry = self.cache.get(key) if self.cache is not None else None
+        if entry is None:
+            raise error
+        return dataclasses.replace(entry.forecast, stale=True)
+
+    def get_forecast(
+        self,
+        location: Location,
+        target_timestamp: datetime.datetime,
+        end_timestamp: datetime.datetime,
+        extra_params: Iterable,
+        model: ForecastModels,
+    ) -> Forecast:
+        extra_params = list(extra_params)
+        key = forecast_cache_key(self.name, location, model, extra_params, target_timestamp)
+        if not self.breaker.allow_request():
+            return self._fallback(key, CircuitOpenError(f"{self.name}: circuit is open."))
+
+        try:
+            forecast = self._hedged_call(
+                location=location,
+                target_timestamp=target_timestamp,
+                end_timestamp=end_timestamp,
+                extra_params=extra_params,
+                model=model,
+            )
+        except Exception as error:
+            self.breaker.record_failure()
+            return self._fallback(key, error)
+
+        self.breaker.record_success()
+        if self.cache is not None:
+            self.cache.put(key, forecast)
+        return forecast
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
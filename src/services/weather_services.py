@@ -1,15 +1,23 @@
 import abc
 import datetime
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Iterable, Iterator, Optional
 
 import meteostat
 import pandas as pd
 
 from adapters.models import ForecastBaseClient
+from analysis.alignment import naive_utc
+from analysis.qc import QualityControl
 from domain.models import (Forecast, ForecastModels, Location, WeatherData,
                            WeatherParams)
+from domain.schema import ConversionPlan, Units
+from repositories import ObservationStore
+from services.cache import (DEFAULT_SCHEDULES, CacheEntry, ForecastCache,
+                            ModelRunSchedule, forecast_cache_key,
+                            forecast_request_key)
 from utils import InjectionDict, create_bijection_dict
+from utils.profiling import stage
 
 
 @dataclass(frozen=True)
@@ -21,6 +29,8 @@ class ExternalBaseService:
     name: str
     DOMAIN_TO_QUERY_PARAMS_MAP: InjectionDict
     DOMAIN_TO_QUERY_MODELS_MAP: InjectionDict
+    #: Units of the domain params as returned by the external service.
+    CONVERSION_PLAN: ConversionPlan
 
     @classmethod
     def _translate(cls, mapper, params):
@@ -43,6 +53,12 @@ class ExternalBaseService:
     def translate_to_domain_models(self, models: Iterable) -> list:
         return self._translate(self.DOMAIN_TO_QUERY_MODELS_MAP.backward, models)
 
+    def normalize(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convert data with domain column names to the canonical units and dtypes.
+        """
+        return self.CONVERSION_PLAN.apply(data)
+
 
 class ExternalWeatherBaseService(ExternalBaseService):
     @abc.abstractmethod
@@ -70,7 +86,22 @@ class ExternalForecastBaseService(ExternalBaseService):
 
 class MeteostatWeatherService(ExternalBaseService):
     name = "MeteostatsWeatherExternalService"
-    DOMAIN_TO_QUERY_PARAMS_MAP = create_bijection_dict({WeatherParams.TEMPERATURE: "temp"})
+    DOMAIN_TO_QUERY_PARAMS_MAP = create_bijection_dict(
+        {
+            WeatherParams.TEMPERATURE: "temp",
+            WeatherParams.WIND_SPEED: "wspd",
+            WeatherParams.WIND_DIRECTION: "wdir",
+            WeatherParams.WIND_GUSTS: "wpgt",
+        }
+    )
+    CONVERSION_PLAN = ConversionPlan(
+        {
+            WeatherParams.TEMPERATURE: Units.CELSIUS,
+            WeatherParams.WIND_SPEED: Units.KILOMETERS_PER_HOUR,
+            WeatherParams.WIND_DIRECTION: Units.DEGREES,
+            WeatherParams.WIND_GUSTS: Units.KILOMETERS_PER_HOUR,
+        }
+    )
 
     def _to_obj(self, data) -> pd.DataFrame:
         if data.index.name != "time":
@@ -78,7 +109,7 @@ class MeteostatWeatherService(ExternalBaseService):
 
         data.index.name = WeatherParams.TIMESTAMP.value
         data.rename(columns=self.DOMAIN_TO_QUERY_PARAMS_MAP.backward, inplace=True)
-        return data[self.DOMAIN_TO_QUERY_PARAMS_MAP.backward.values()]
+        return self.normalize(data[self.DOMAIN_TO_QUERY_PARAMS_MAP.backward.values()])
 
     @staticmethod
     def _to_locations(data: pd.DataFrame) -> list[Location]:
@@ -92,17 +123,71 @@ class MeteostatWeatherService(ExternalBaseService):
             for station_dict in stations_by_id.values()
         ]
 
+    @staticmethod
+    def _find_station(location: Location) -> pd.DataFrame:
+        stations = meteostat.Stations()
+        stations = stations.nearby(lat=float(location.lat), lon=float(location.lon))
+        return stations.fetch(1)
+
     def get_weather(
         self,
         location: Location,
         timestamp_start: datetime.datetime,
         timestamp_end: datetime.datetime,
     ):
-        stations = meteostat.Stations()
-        stations = stations.nearby(lat=float(location.lat), lon=float(location.lon))
-        station = stations.fetch(1)
+        with stage("meteostat station lookup"):
+            station = self._find_station(location)
         data = meteostat.Hourly(station, timestamp_start, timestamp_end).fetch()
-        return self._to_obj(data)
+        with stage("meteostat parse"):
+            return self._to_obj(data)
+
+    def find_station_id(self, location: Location) -> str:
+        with stage("meteostat station lookup"):
+            return str(self._find_station(location).index[0])
+
+    def get_station_weather(
+        self,
+        station_id: str,
+        timestamp_start: datetime.datetime,
+        timestamp_end: datetime.datetime,
+    ) -> pd.DataFrame:
+        data = meteostat.Hourly(station_id, timestamp_start, timestamp_end).fetch()
+        if data.empty:
+            return pd.DataFrame(
+                columns=list(self.DOMAIN_TO_QUERY_PARAMS_MAP.keys()),
+                index=pd.DatetimeIndex([], name=WeatherParams.TIMESTAMP.value),
+                dtype="float64",
+            )
+        with stage("meteostat parse"):
+            return self._to_obj(data)
+
+    def iter_weather(
+        self,
+        location: Location,
+        timestamp_start: datetime.datetime,
+        timestamp_end: datetime.datetime,
+        chunk_size: datetime.timedelta = datetime.timedelta(days=30),
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Yield the weather of [timestamp_start, timestamp_end] in consecutive time chunks,
+        fetching each chunk only when it is requested, so memory use does not depend
+        on the length of the period.
+        """
+        if chunk_size <= datetime.timedelta(0):
+            raise Exception(f"Chunk size must be positive, got {chunk_size}.")
+        station = self._find_station(location)
+        chunk_start = timestamp_start
+        while chunk_start <= timestamp_end:
+            chunk_end = min(chunk_start + chunk_size, timestamp_end)
+            data = meteostat.Hourly(station, chunk_start, chunk_end).fetch()
+            if chunk_end < timestamp_end:
+                # Both ends are inclusive, the next chunk starts at chunk_end.
+                data = data[data.index < chunk_end]
+            if not data.empty:
+                yield self._to_obj(data)
+            if chunk_end == timestamp_end:
+                return
+            chunk_start = chunk_end
 
     def find_stations_for_location(self, location: Location, n: int = 5) -> list[Location]:
         stations = meteostat.Stations()
@@ -115,6 +200,7 @@ class WindyComExternalService(ExternalForecastBaseService):
     name = "WindyComExternalService"
     DOMAIN_TO_QUERY_PARAMS_MAP = create_bijection_dict({WeatherParams.TEMPERATURE: "t_2m:C"})
     DOMAIN_TO_QUERY_MODELS_MAP = create_bijection_dict({ForecastModels.DEFAULT: "mix"})
+    CONVERSION_PLAN = ConversionPlan({WeatherParams.TEMPERATURE: Units.CELSIUS})
 
     def __init__(self, client: ForecastBaseClient):
         self.client = client
@@ -127,6 +213,9 @@ class WindyComExternalService(ExternalForecastBaseService):
         extra_params: Iterable,
         model: ForecastModels,
     ) -> Forecast:
+        extra_params = list(extra_params)
+        if not extra_params:
+            raise Exception(f"{self.name} needs at least one param to request.")
         forecast_raw = self.client.get_forecast_data(
             lon=location.lon,
             lat=location.lat,
@@ -134,7 +223,8 @@ class WindyComExternalService(ExternalForecastBaseService):
             params=self.translate_to_query_params(extra_params),
             model=self.translate_to_query_models([model])[0],
         )
-        data = pd.DataFrame.from_dict({"value": [forecast_raw]})
+        # The client returns the value of the first requested param only.
+        data = self.normalize(pd.DataFrame.from_dict({extra_params[0]: [forecast_raw]}))
         forecast = Forecast(
             created_at=datetime.datetime.now(),
             valid_at=datetime.datetime.now(),
@@ -162,6 +252,15 @@ class OpenMeteoExternalService(ExternalForecastBaseService):
             ForecastModels.MODEL_ICON: "icon_seamless",
         }
     )
+    # Wind speeds are requested in knots, see OpenMeteoClient.
+    CONVERSION_PLAN = ConversionPlan(
+        {
+            WeatherParams.TEMPERATURE: Units.CELSIUS,
+            WeatherParams.WIND_SPEED: Units.KNOTS,
+            WeatherParams.WIND_DIRECTION: Units.DEGREES,
+            WeatherParams.WIND_GUSTS: Units.KNOTS,
+        }
+    )
 
     def __init__(self, client: ForecastBaseClient):
         self.client = client
@@ -182,16 +281,18 @@ class OpenMeteoExternalService(ExternalForecastBaseService):
             model=self.translate_to_query_models([model])[0],
         )
 
-        forecast_raw["time"] = [
-            datetime.datetime.fromisoformat(timestamp_str) for timestamp_str in forecast_raw["time"]
-        ]
-        data = pd.DataFrame.from_dict(forecast_raw)
+        with stage("openmeteo parse"):
+            forecast_raw["time"] = [
+                datetime.datetime.fromisoformat(timestamp_str)
+                for timestamp_str in forecast_raw["time"]
+            ]
+            data = pd.DataFrame.from_dict(forecast_raw)
 
-        data.rename(columns=self.DOMAIN_TO_QUERY_PARAMS_MAP.backward, inplace=True)
-        data.rename(columns={"time": WeatherParams.TIMESTAMP}, inplace=True)
-        data.set_index(WeatherParams.TIMESTAMP, inplace=True)
+            data.rename(columns=self.DOMAIN_TO_QUERY_PARAMS_MAP.backward, inplace=True)
+            data.rename(columns={"time": WeatherParams.TIMESTAMP}, inplace=True)
+            data.set_index(WeatherParams.TIMESTAMP, inplace=True)
 
-        data = data[:end_timestamp]  # type: ignore
+            data = self.normalize(data[:end_timestamp])  # type: ignore
 
         forecast = Forecast(
             created_at=datetime.datetime.now(),
@@ -205,8 +306,79 @@ class OpenMeteoExternalService(ExternalForecastBaseService):
 
 
 class WeatherService:
-    def __init__(self):
-        self.external_service = MeteostatWeatherService()
+    def __init__(
+        self,
+        external_service: Optional[MeteostatWeatherService] = None,
+        store: Optional[ObservationStore] = None,
+        revision_window: datetime.timedelta = datetime.timedelta(hours=24),
+        clock=datetime.datetime.utcnow,
+        qc: Optional[QualityControl] = None,
+    ):
+        """
+        With a store, observations are served from it and only the hours it lacks
+        are fetched, plus the last revision_window of the synced period, which the
+        provider may still correct or complete.
+
+        With qc, returned observations are quality controlled and gap filled.
+        """
+        self.external_service = external_service or MeteostatWeatherService()
+        self.store = store
+        self.qc = qc
+        self.revision_window = revision_window
+        self._clock = clock
+        self._station_ids: dict[Location, str] = {}
+
+    def _station_id(self, location: Location) -> str:
+        if location not in self._station_ids:
+            self._station_ids[location] = self.external_service.find_station_id(location)
+        return self._station_ids[location]
+
+    def _fetch_into_store(
+        self, station_id: str, timestamp_start: datetime.datetime, timestamp_end: datetime.datetime
+    ) -> None:
+        data = self.external_service.get_station_weather(station_id, timestamp_start, timestamp_end)
+        self.store.write(station_id, data, timestamp_start, timestamp_end)
+
+    def sync(
+        self,
+        location: Location,
+        timestamp_start: datetime.datetime,
+        timestamp_end: datetime.datetime,
+    ) -> str:
+        """
+        Bring the store up to date for [timestamp_start, timestamp_end] and return the station id.
+        """
+        station_id = self._station_id(location)
+        start = naive_utc(timestamp_start)
+        end = min(naive_utc(timestamp_end), self._clock())
+        if end < start:
+            return station_id
+
+        period = self.store.synced_period(station_id)
+        if period is None:
+            self._fetch_into_store(station_id, start, end)
+            return station_id
+
+        synced_from, synced_to = period
+        if start < synced_from:
+            self._fetch_into_store(station_id, start, synced_from)
+        revision_start = max(synced_from, synced_to - self.revision_window)
+        if end > revision_start:
+            self._fetch_into_store(station_id, revision_start, end)
+        return station_id
+
+    def _get_weather(
+        self,
+        location: Location,
+        timestamp_start: datetime.datetime,
+        timestamp_end: datetime.datetime,
+    ) -> WeatherData:
+        if self.store is None:
+            data = self.external_service.get_weather(location, timestamp_start, timestamp_end)
+        else:
+            station_id = self.sync(location, timestamp_start, timestamp_end)
+            data = self.store.read(station_id, timestamp_start, timestamp_end)
+        return WeatherData(data=data, location=location)
 
     def get_weather_for_location(
         self,
@@ -214,17 +386,62 @@ class WeatherService:
         timestamp_start: datetime.datetime,
         timestamp_end: datetime.datetime,
     ) -> WeatherData:
-        data = self.external_service.get_weather(location, timestamp_start, timestamp_end)
-        data = WeatherData(data=data, location=location)
+        data = self._get_weather(location, timestamp_start, timestamp_end)
+        if self.qc is not None:
+            data, _ = self.qc.check_weather_data(data)
         return data
 
+    def get_checked_weather_for_location(
+        self,
+        location: Location,
+        timestamp_start: datetime.datetime,
+        timestamp_end: datetime.datetime,
+    ) -> tuple[WeatherData, pd.DataFrame]:
+        """
+        Quality controlled weather and the QCFlags of its values.
+        """
+        data = self._get_weather(location, timestamp_start, timestamp_end)
+        return (self.qc or QualityControl()).check_weather_data(data)
+
+    def stream_weather_for_location(
+        self,
+        location: Location,
+        timestamp_start: datetime.datetime,
+        timestamp_end: datetime.datetime,
+        chunk_size: datetime.timedelta = datetime.timedelta(days=30),
+    ) -> Iterator[WeatherData]:
+        chunks = self.external_service.iter_weather(
+            location, timestamp_start, timestamp_end, chunk_size
+        )
+        for data in chunks:
+            yield WeatherData(data=data, location=location)
+
     def get_nearest_station_location(self, location: Location) -> Location:
         return self.external_service.find_stations_for_location(location, 1)[0]
 
 
 class ForecastService:
-    def __init__(self, external_services: list[ExternalForecastBaseService]):
+    def __init__(
+        self,
+        external_services: list[ExternalForecastBaseService],
+        cache: Optional[ForecastCache] = None,
+        cache_max_age: Optional[float] = 6 * 3600,
+        access_tracker=None,
+        schedules: Optional[dict[ForecastModels, ModelRunSchedule]] = None,
+        clock=datetime.datetime.utcnow,
+    ):
+        """
+        Forecasts found in cache, e.g. put there by the Prefetcher, are served
+        without calling the external service while younger than cache_max_age
+        seconds and stored after the latest run of their model, by schedules,
+        became available. Every request key is reported to access_tracker.record if set.
+        """
         self._external_services = {service.name: service for service in external_services}
+        self.cache = cache
+        self.cache_max_age = cache_max_age
+        self.access_tracker = access_tracker
+        self.schedules = schedules or DEFAULT_SCHEDULES
+        self._clock = clock
 
     def get_external_service(self, service_name: str) -> ExternalForecastBaseService:
         try:
@@ -236,6 +453,15 @@ class ForecastService:
     def _external_services_names(self) -> list[str]:
         return list(self._external_services.keys())
 
+    def _superseded(self, entry: CacheEntry, model: ForecastModels) -> bool:
+        """
+        Whether a newer run of model became available after entry was cached.
+        """
+        schedule = self.schedules.get(model, ModelRunSchedule())
+        latest_run = schedule.latest_run(self._clock())
+        available_at = latest_run + schedule.availability_delay
+        return entry.stored_at < available_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+
     def get_forecast_for_location(
         self,
         location: Location,
@@ -245,14 +471,29 @@ class ForecastService:
         external_service_name: str,
     ) -> Forecast:
         external_service = self.get_external_service(external_service_name)
-
-        cdp = external_service.get_forecast(
-            location=location,
-            target_timestamp=target_timestamp,
-            end_timestamp=target_timestamp + datetime.timedelta(days=7),  # TODO
-            extra_params=extra_params,
-            model=model,
+        extra_params = list(extra_params)
+        key = forecast_cache_key(
+            external_service_name, location, model, extra_params, target_timestamp
         )
+        if self.access_tracker is not None:
+            self.access_tracker.record(
+                forecast_request_key(external_service_name, location, model, extra_params)
+            )
+
+        entry = self.cache.get(key, self.cache_max_age) if self.cache is not None else None
+        if entry is not None and not self._superseded(entry, model):
+            cdp = entry.forecast
+        else:
+            cdp = external_service.get_forecast(
+                location=location,
+                target_timestamp=target_timestamp,
+                end_timestamp=target_timestamp + datetime.timedelta(days=7),  # TODO
+                extra_params=extra_params,
+                model=model,
+            )
+            # Stale fallbacks of a ResilientForecastService must not pass for fresh.
+            if self.cache is not None and not cdp.stale:
+                self.cache.put(key, cdp)
 
         return Forecast(
             created_at=datetime.datetime.now(),
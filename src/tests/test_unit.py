@@ -1,19 +1,56 @@
+import dataclasses
+import json
+import multiprocessing
 import os
 import pickle as pkl
 import shutil
-from datetime import date, datetime, timedelta
+import socket
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from random import randint
 
+import numpy as np
 import pandas as pd
 import pytest
 
+import arrow_io
 from adapters.openmeteo.client import OpenMeteoClient
 from adapters.windycom.client import WindyComClient
-from domain.models import Forecast, ForecastModels, Location, WeatherParams
+from analysis.alignment import align, align_frame, align_many, make_grid
+from analysis.blending import BlendWeights, EnsembleBlender, blend_arrays
+from analysis.downsampling import min_max_indices
+from analysis.evaluation import evaluate_models, score_arrays
+from analysis.qc import QCFlags, QualityControl
+from analysis.windows import (RideRules, find_forecast_windows, find_runs,
+                              sector_mask)
+from arrow_io import (ArrowStreamServer, read_feather, read_stream,
+                      send_stream, to_weather_data, write_feather)
+from container import Container
+from domain.models import (Forecast, ForecastModels, Location, WeatherData,
+                           WeatherParams)
+from domain.schema import CANONICAL_SCHEMA, ConversionPlan, Units
+from plotting import MIN_MAX, downsample_frame, plot_weather_data_as_jpg
 from repositories import (CompositeRepositoryImplementation, DBConfig,
+                          DeltaForecastRepository, ForecastCubeRepository,
+                          ForecastQuery, LocationCatalog, ObservationStore,
                           PklRepository)
-from services.weather_services import (OpenMeteoExternalService,
-                                       WindyComExternalService)
+from services.cache import (ForecastCache, forecast_cache_key,
+                            forecast_request_key)
+from services.grid import (GriddedForecast, GridForecastService, GridSpec,
+                           OpenMeteoGridSource)
+from services.prefetch import (HotKeyTracker, ModelRunSchedule, Prefetcher,
+                               RateLimiter)
+from services.resilience import (CircuitBreaker, CircuitState,
+                                 ResilientForecastService)
+from services.weather_services import (ForecastService,
+                                       MeteostatWeatherService,
+                                       OpenMeteoExternalService,
+                                       WeatherService, WindyComExternalService)
+from utils import GridIndex, haversine_km
+from utils.profiling import Profiler, stage
 
 
 class TestCase:
@@ -131,14 +168,18 @@ class TestCaseRepository:
     BASE_DIR = "_test/"
     STORAGE_DIR = "storage/"
 
-    def _forecast(self, fid):
+    def _forecast(self, fid, wind_speed=18):
+        # Identical content is stored once, tests needing distinct runs pass wind_speed.
         obj = Forecast(
             id=fid,
             created_at=datetime.now(),
             valid_at=datetime.now(),
             location=Location(name="A location", lon="11.22", lat="22.11"),
             data=pd.DataFrame(
-                {WeatherParams.TEMPERATURE: [10, 11, 12], WeatherParams.WIND_SPEED: [15, 18, 18]}
+                {
+                    WeatherParams.TEMPERATURE: [10, 11, 12],
+                    WeatherParams.WIND_SPEED: [15, 18, wind_speed],
+                }
             ),
             weather_model=ForecastModels.DEFAULT,
         )
@@ -191,6 +232,156 @@ class TestCaseRepository:
 
         assert max_id == 2
 
+    def test_repository_save_and_retrieve_forecasts(self):
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        single = repository.save_forecast(self._forecast(None))
+
+        saved = repository.save_forecasts([self._forecast(None, value) for value in range(3)])
+        retrieved = repository.retrieve_forecasts([4, 1, 2])
+
+        assert [forecast.id for forecast in saved] == [2, 3, 4]
+        assert os.listdir(self.BASE_DIR + self.STORAGE_DIR).count("segment_2_4.pkl") == 1
+        assert retrieved == [saved[2], single, saved[0]]
+        assert repository.retrieve_forecast(3) == saved[1]
+        assert PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)._reserve_ids(1)[0] == 5
+
+    def _save_batches(self, n_batches, first_value=0):
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        for batch in range(n_batches):
+            value = first_value + 6 * batch
+            repository.save_forecasts([self._forecast(None, value + i) for i in range(5)])
+            repository.save_forecast(self._forecast(None, value + 5))
+
+    def test_repository_concurrent_writers(self):
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=self._save_batches, args=(5, 100 * worker))
+            for worker in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        forecasts = repository.retrieve_forecasts(list(range(1, 121)))
+
+        assert all(worker.exitcode == 0 for worker in workers)
+        assert [forecast.id for forecast in forecasts] == list(range(1, 121))
+        assert sorted(repository.query_forecast_ids(ForecastQuery())) == list(range(1, 121))
+
+    def test_repository_query_forecasts(self):
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        other_location = Location(name="Other location", lon="1.0", lat="2.0")
+        for day in range(6):
+            forecast = self._forecast(None, day)
+            forecast.created_at = forecast.valid_at = datetime(2023, 1, 1 + day)
+            if day % 2:
+                forecast.weather_model = ForecastModels.MODEL_ICON
+            if day == 5:
+                forecast.location = other_location
+            repository.save_forecast(forecast)
+
+        query = ForecastQuery(
+            location=Location(name="A location", lon="11.22", lat="22.11"),
+            weather_model=ForecastModels.MODEL_ICON,
+        )
+        created_query = ForecastQuery(created_from=datetime(2023, 1, 3))
+        streamed = repository.iter_forecasts(ForecastQuery(), batch_size=4)
+
+        assert repository.query_forecast_ids(query) == [2, 4]
+        assert repository.query_forecast_ids(created_query) == [3, 4, 5, 6]
+        assert repository.query_forecast_ids(ForecastQuery(), limit=2, offset=3) == [4, 5]
+        assert [forecast.id for forecast in streamed] == [1, 2, 3, 4, 5, 6]
+        assert repository.query_forecasts(ForecastQuery(location=other_location))[0].id == 6
+
+        repository.index.clear()
+        repository.rebuild_index()
+        assert repository.query_forecast_ids(ForecastQuery(valid_to=datetime(2023, 1, 2))) == [1, 2]
+
+    def test_repository_query_reads_segment_once(self, monkeypatch):
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        repository.save_forecasts([self._forecast(None, wind_speed=value) for value in range(5)])
+        reads = []
+        retrieve_segment = repository._retrieve_segment
+        monkeypatch.setattr(
+            repository,
+            "_retrieve_segment",
+            lambda segment: reads.append(segment) or retrieve_segment(segment),
+        )
+
+        queried = repository.query_forecasts(ForecastQuery())
+        streamed = list(repository.iter_forecasts(ForecastQuery(), batch_size=10))
+
+        assert [forecast.id for forecast in queried] == [1, 2, 3, 4, 5]
+        assert streamed == queried
+        assert reads == [(1, 5), (1, 5)]
+
+    def test_repository_skips_duplicates(self):
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        first = repository.save_forecast(self._forecast(None))
+        again = repository.save_forecast(self._forecast(None))
+        batch = repository.save_forecasts(
+            [self._forecast(None, value) for value in (19, 18, 19, 20)]
+        )
+
+        assert again.id == first.id == 1
+        assert [forecast.id for forecast in batch] == [2, 1, 2, 3]
+        assert os.listdir(self.BASE_DIR + self.STORAGE_DIR).count("segment_2_3.pkl") == 1
+        assert sorted(repository.query_forecast_ids(ForecastQuery())) == [1, 2, 3]
+        assert repository.retrieve_forecast(3).data[WeatherParams.WIND_SPEED].iloc[2] == 20
+
+        repository.index.clear()
+        repository.rebuild_index()
+        assert sorted(repository.query_forecast_ids(ForecastQuery())) == [1, 2, 3]
+
+    def _save_same(self, n_times):
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        for _ in range(n_times):
+            repository.save_forecasts([self._forecast(None, value) for value in range(3)])
+            repository.save_forecast(self._forecast(None, 3))
+
+    def test_repository_concurrent_duplicates(self):
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=self._save_same, args=(3,)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        repository = PklRepository(base_dir=self.BASE_DIR + self.STORAGE_DIR)
+        stored = repository.retrieve_forecasts(repository.query_forecast_ids(ForecastQuery()))
+
+        assert all(worker.exitcode == 0 for worker in workers)
+        speeds = sorted(forecast.data[WeatherParams.WIND_SPEED].iloc[2] for forecast in stored)
+        assert speeds == [0, 1, 2, 3]
+
+    def test_forecast_fingerprint(self):
+        forecast = self._forecast(1)
+        same = self._forecast(1)
+        same.created_at = forecast.created_at
+        same.valid_at = forecast.valid_at
+
+        assert forecast.fingerprint == same.fingerprint
+        assert forecast == same
+        assert forecast == pkl.loads(pkl.dumps(forecast))
+
+        changed = same.data.copy()
+        changed.iloc[0, 0] = 10.5
+        same.data = changed
+        assert forecast.fingerprint != same.fingerprint
+        assert forecast != same
+        same.data = forecast.data
+        same.weather_model = ForecastModels.MODEL_ICON
+        assert forecast.fingerprint != same.fingerprint
+
+        # Changes in place are picked up after a refresh.
+        before = forecast.fingerprint
+        forecast.data.iloc[0, 0] = 10.5
+        assert forecast.fingerprint == before
+        forecast.refresh_fingerprint()
+        assert forecast.fingerprint != before
+
 
 @pytest.fixture()
 def db_config():
@@ -199,3 +390,1240 @@ def db_config():
 
 def test_configure_composite_repository(db_config):
     repository = CompositeRepositoryImplementation(db_config)
+
+
+class TestCaseLocationCatalog:
+    @pytest.fixture()
+    def catalog(self, tmp_path):
+        path = tmp_path / "locations.csv"
+        pd.DataFrame(
+            {
+                "key": ["valencia", "tarifa", "leucate", "hel"],
+                "name": ["Valencia", "Tarifa", "Leucate", "Hel"],
+                "lat": [39.4833, 36.0143, 42.9106, 54.6083],
+                "lon": [-0.3833, -5.6044, 3.0283, 18.8012],
+            }
+        ).to_csv(path, index=False)
+        return LocationCatalog(str(path))
+
+    def test_get_location(self, catalog):
+        location = catalog.get_location("Valencia")
+
+        assert location == Location(name="Valencia", lon="-0.3833", lat="39.4833")
+        with pytest.raises(Exception):
+            catalog.get_location("nowhere")
+
+    def test_spatial_queries(self, catalog):
+        assert [loc.name for loc in catalog.nearest(39.0, -1.0, k=2)] == ["Valencia", "Tarifa"]
+        assert [loc.name for loc in catalog.within_radius(39.0, -1.0, 500)] == ["Valencia"]
+        assert [loc.name for loc in catalog.within_bbox(35, -6, 44, 4)] == [
+            "Valencia",
+            "Tarifa",
+            "Leucate",
+        ]
+
+    def test_grid_index_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        lats, lons = rng.uniform(-80, 80, 2000), rng.uniform(-180, 180, 2000)
+        index = GridIndex(lats, lons, cell_size=2.0)
+
+        positions, _ = index.query_nearest(10.0, 179.5, k=15)
+        distances = haversine_km(10.0, 179.5, lats, lons)
+
+        assert list(positions) == list(np.argsort(distances)[:15])
+        assert set(index.query_radius(10.0, 179.5, 800)[0]) == set(np.flatnonzero(distances <= 800))
+
+
+class TestCaseSchema:
+    def test_conversion_plan(self):
+        plan = ConversionPlan(
+            {
+                WeatherParams.TEMPERATURE: Units.KELVIN,
+                WeatherParams.WIND_SPEED: Units.METERS_PER_SECOND,
+            }
+        )
+        data = pd.DataFrame(
+            {WeatherParams.TEMPERATURE: [273, 283], WeatherParams.WIND_SPEED: [0, 10], "x": [1, 2]}
+        )
+
+        normalized = plan.apply(data)
+
+        assert list(normalized[WeatherParams.TEMPERATURE]) == pytest.approx([-0.15, 9.85])
+        assert list(normalized[WeatherParams.WIND_SPEED]) == pytest.approx([0, 19.438445])
+        assert list(normalized["x"]) == [1, 2]
+        assert list(data[WeatherParams.TEMPERATURE]) == [273, 283]
+
+    def test_meteostat_data_is_normalized(self):
+        raw = pd.DataFrame(
+            {"temp": [20], "wspd": [18.52], "wdir": [90], "wpgt": [37.04], "prcp": [0]},
+            index=pd.DatetimeIndex([datetime(2023, 1, 1)], name="time"),
+        )
+
+        data = MeteostatWeatherService()._to_obj(raw)
+
+        assert list(data.columns) == list(CANONICAL_SCHEMA)
+        assert data.iloc[0].tolist() == pytest.approx([20, 10, 90, 20])
+        assert (data.dtypes == "float64").all()
+
+
+class TestCaseAlignment:
+    @pytest.fixture()
+    def hourly_data(self):
+        return pd.DataFrame(
+            {
+                WeatherParams.WIND_SPEED: [10.0, 20.0, 30.0],
+                WeatherParams.WIND_DIRECTION: [350, 10, 30],
+            },
+            index=pd.date_range("2023-01-01", periods=3, freq="1H"),
+        )
+
+    def test_interpolate_to_utc_grid(self, hourly_data):
+        grid = make_grid(
+            pd.Timestamp("2023-01-01 01:00", tz="Europe/Madrid"),
+            pd.Timestamp("2023-01-01 03:30", tz="Europe/Madrid"),
+            freq="30min",
+        )
+
+        aligned = align_frame(hourly_data, grid)
+
+        assert str(aligned.index.tz) == "UTC"
+        assert aligned[WeatherParams.WIND_SPEED].tolist()[:3] == [10.0, 15.0, 20.0]
+        assert np.isnan(aligned[WeatherParams.WIND_SPEED].iloc[-1])
+        assert aligned[WeatherParams.WIND_DIRECTION].iloc[1] % 360 == pytest.approx(0, abs=1e-9)
+
+    def test_interpolate_leading_nan(self):
+        index = pd.date_range("2023-01-01", periods=4, freq="1H")
+        data = pd.DataFrame({WeatherParams.TEMPERATURE: [np.nan, 2.0, 3.0, 4.0]}, index=index)
+
+        aligned = align_frame(data, index)
+
+        assert np.isnan(aligned[WeatherParams.TEMPERATURE].iloc[0])
+        assert aligned[WeatherParams.TEMPERATURE].tolist()[1:] == [2.0, 3.0, 4.0]
+
+    def test_interpolate_nan_next_to_exact_hit(self):
+        index = pd.DatetimeIndex(["2023-01-01 00:00", "2023-01-01 03:00", "2023-01-01 04:00"])
+        data = pd.DataFrame({WeatherParams.TEMPERATURE: [1.0, 2.0, np.nan]}, index=index)
+        grid = make_grid(datetime(2023, 1, 1), datetime(2023, 1, 1, 4), freq="30min")
+
+        aligned = align_frame(data, grid, max_gap=timedelta(hours=1))
+
+        temperature = aligned[WeatherParams.TEMPERATURE]
+        assert temperature[pd.Timestamp("2023-01-01 00:00", tz="UTC")] == 1.0
+        assert temperature[pd.Timestamp("2023-01-01 03:00", tz="UTC")] == 2.0
+        assert np.isnan(temperature[pd.Timestamp("2023-01-01 01:30", tz="UTC")])
+        assert np.isnan(temperature[pd.Timestamp("2023-01-01 03:30", tz="UTC")])
+
+    def test_mean_resample(self, hourly_data):
+        grid = make_grid(datetime(2023, 1, 1), datetime(2023, 1, 1, 2), freq="2H")
+
+        aligned = align_frame(hourly_data, grid, method="mean")
+
+        assert aligned[WeatherParams.WIND_SPEED].tolist() == [15.0, 30.0]
+        assert aligned[WeatherParams.WIND_DIRECTION].iloc[0] % 360 == pytest.approx(0, abs=1e-9)
+
+    def test_align_many(self, hourly_data):
+        location = Location(name="A location", lon="11.22", lat="22.11")
+        weather = WeatherData(data=hourly_data, location=location)
+        grid = make_grid(datetime(2023, 1, 1), datetime(2023, 1, 1, 2))
+
+        stacked = align_many(
+            [weather, align(weather, grid[:2])],
+            grid,
+            [WeatherParams.WIND_SPEED, WeatherParams.TEMPERATURE],
+        )
+
+        assert stacked.shape == (2, 3, 2)
+        assert stacked[0, :, 0].tolist() == [10.0, 20.0, 30.0]
+        assert np.isnan(stacked[1, 2, 0]) and np.isnan(stacked[:, :, 1]).all()
+
+
+class TestCaseForecastCube:
+    def _forecast(self, created_at, values):
+        return Forecast(
+            created_at=created_at,
+            valid_at=created_at,
+            location=Location(name="A location", lon="11.22", lat="22.11"),
+            data=pd.DataFrame(
+                {WeatherParams.WIND_SPEED: values},
+                index=pd.date_range(created_at, periods=len(values), freq="1H"),
+            ),
+            weather_model=ForecastModels.MODEL_ICON,
+        )
+
+    def test_cube_slices(self, tmp_path):
+        repository = ForecastCubeRepository(base_dir=str(tmp_path), n_leads=6)
+        location = Location(name="A location", lon="11.22", lat="22.11")
+        for hour, values in ((0, [1, 2, 3, 4]), (1, [11, 12, 13]), (3, [31, 32, 33])):
+            repository.save_forecast(self._forecast(datetime(2023, 1, 1, hour), values))
+
+        cube = repository.get_cube(location, ForecastModels.MODEL_ICON, WeatherParams.WIND_SPEED)
+        valid_at = repository.get_valid_at(
+            location, ForecastModels.MODEL_ICON, WeatherParams.WIND_SPEED, datetime(2023, 1, 1, 3)
+        )
+
+        assert cube.values.shape == (4, 6)
+        assert valid_at.tolist() == [4, 13, 31]
+        assert list(valid_at.index.hour) == [0, 1, 3]
+        assert cube.by_lead(timedelta(hours=1)).dropna().tolist() == [2, 12, 32]
+        run = cube.by_issue(datetime(2023, 1, 1, 1))
+        assert run.tolist()[:3] == [11, 12, 13] and np.isnan(run.iloc[3])
+        assert run.index[0] == pd.Timestamp("2023-01-01 01:00", tz="UTC")
+
+        repository.save_forecast(self._forecast(datetime(2023, 1, 1, 2), [21]))
+        assert cube.values.shape == (4, 6)
+        assert cube.by_lead(timedelta(0)).tolist() == [1, 11, 21, 31]
+
+    def test_cube_rejects_overwrite(self, tmp_path):
+        repository = ForecastCubeRepository(base_dir=str(tmp_path), n_leads=6)
+        repository.save_forecast(self._forecast(datetime(2023, 1, 1), [1, 2]))
+
+        with pytest.raises(Exception):
+            repository.save_forecast(self._forecast(datetime(2023, 1, 1), [1, 2]))
+
+
+class TestCaseDeltaForecastRepository:
+    location = Location(name="A location", lon="11.22", lat="22.11")
+
+    def _forecasts(self, n_runs):
+        rng = np.random.default_rng(0)
+        values = rng.normal(15, 5, (24 * 10 + n_runs, 3)).round(1)
+        values[:, 1] = rng.uniform(0, 359, len(values)).round()
+        for run in range(n_runs):
+            created_at = datetime(2023, 1, 1) + timedelta(hours=run)
+            data = pd.DataFrame(
+                values[run:run + 24 * 10].copy(),
+                index=pd.date_range(created_at, periods=24 * 10, freq="1H", tz="UTC"),
+                columns=[WeatherParams.WIND_SPEED, WeatherParams.WIND_DIRECTION, "temperature"],
+            )
+            data.iloc[run % 7::50, 0] = np.nan
+            yield Forecast(
+                created_at=created_at,
+                valid_at=created_at,
+                data=data,
+                location=self.location,
+                weather_model=ForecastModels.MODEL_ICON,
+            )
+
+    def test_roundtrip(self, tmp_path):
+        repository = DeltaForecastRepository(base_dir=str(tmp_path), keyframe_interval=4)
+        forecasts = list(self._forecasts(10))
+        for forecast in forecasts:
+            repository.save_forecast(forecast)
+
+        reader = DeltaForecastRepository(base_dir=str(tmp_path), keyframe_interval=4)
+        for seq in (9, 2, 5, 6):
+            retrieved = reader.retrieve_forecast(self.location, ForecastModels.MODEL_ICON, seq)
+            expected = forecasts[seq]
+            pd.testing.assert_frame_equal(
+                retrieved.data, expected.data, check_names=False, check_freq=False
+            )
+            assert retrieved.created_at == expected.created_at
+        assert reader.list_runs(self.location, ForecastModels.MODEL_ICON) == list(range(10))
+
+        refetched = dataclasses.replace(forecasts[-1], created_at=datetime(2024, 1, 1))
+        assert reader.save_forecast(refetched) == 9
+        assert reader.list_runs(self.location, ForecastModels.MODEL_ICON) == list(range(10))
+
+    def test_deltas_are_smaller_than_pickles(self, tmp_path):
+        repository = DeltaForecastRepository(base_dir=str(tmp_path), keyframe_interval=12)
+        forecasts = list(self._forecasts(12))
+        for forecast in forecasts:
+            repository.save_forecast(forecast)
+
+        stored = sum(os.path.getsize(path) for path in tmp_path.rglob("run_*.bin"))
+        pickled = sum(len(pkl.dumps(forecast)) for forecast in forecasts)
+        assert stored * 10 < pickled
+
+
+class TestCaseEvaluation:
+    def test_parallel_scores_match_sequential(self):
+        rng = np.random.default_rng(0)
+        observations = rng.uniform(0, 360, (7, 500))
+        rows = np.repeat(np.arange(7), 3)
+        forecasts = observations[rows] + rng.normal(0, 10, (21, 500))
+        forecasts[0, :100] = np.nan
+
+        sequential = score_arrays(forecasts, observations, rows, circular=True)
+        parallel = score_arrays(
+            forecasts, observations, rows, circular=True, n_workers=3, min_parallel_values=0
+        )
+
+        np.testing.assert_allclose(parallel, sequential)
+        assert sequential[0, 0] == 400 and sequential[1, 0] == 500
+
+    def test_small_inputs_scored_in_process(self, monkeypatch):
+        def no_pool(*args, **kwargs):
+            raise AssertionError("No worker processes expected.")
+
+        monkeypatch.setattr("analysis.evaluation.ProcessPoolExecutor", no_pool)
+        observations = np.arange(20.0).reshape(2, 10)
+        rows = np.array([0, 1, 1])
+
+        for n_workers in (1, 4, None):
+            scores = score_arrays(observations[rows] + 1, observations, rows, n_workers=n_workers)
+            assert scores[:, 1].tolist() == [1.0, 1.0, 1.0]
+
+    def test_evaluate_models(self):
+        location = Location(name="A location", lon="11.22", lat="22.11")
+        index = pd.date_range("2023-01-01", periods=4, freq="1H")
+        observed = WeatherData(
+            data=pd.DataFrame({WeatherParams.WIND_SPEED: [10.0, 12, 14, 16]}, index=index),
+            location=location,
+        )
+        forecasts = {
+            (location.name, model): Forecast(
+                created_at=datetime(2023, 1, 1),
+                valid_at=datetime(2023, 1, 1),
+                data=pd.DataFrame({WeatherParams.WIND_SPEED: values}, index=index),
+                location=location,
+                weather_model=model,
+            )
+            for model, values in (
+                (ForecastModels.MODEL_ICON, [11.0, 13, 15, 17]),
+                (ForecastModels.DEFAULT, [10.0, 10, 14, np.nan]),
+            )
+        }
+
+        metrics = evaluate_models(
+            {location.name: observed},
+            forecasts,
+            make_grid(index[0], index[-1]),
+            WeatherParams.WIND_SPEED,
+            n_workers=2,
+            min_parallel_values=0,
+        )
+
+        assert metrics["weather_model"].tolist() == ["icon", "default"]
+        assert metrics["count"].tolist() == [4, 3]
+        assert metrics["bias"].tolist() == pytest.approx([1.0, -2 / 3])
+        assert metrics["rmse"].tolist() == pytest.approx([1.0, np.sqrt(4 / 3)])
+
+
+class FakeStations:
+    def nearby(self, lat, lon):
+        return self
+
+    def fetch(self, limit):
+        return pd.DataFrame({"name": ["A station"]}, index=["10000"])
+
+
+class FakeHourly:
+    calls: list = []
+
+    def __init__(self, station, start, end):
+        self.start, self.end = start, end
+        FakeHourly.calls.append((start, end))
+
+    def fetch(self):
+        index = pd.date_range(self.start, self.end, freq="1H", name="time")
+        values = np.arange(len(index), dtype=float)
+        return pd.DataFrame(
+            {"temp": values, "wspd": values, "wdir": values, "wpgt": values, "prcp": values},
+            index=index,
+        )
+
+
+class TestCaseWeatherStreaming:
+    @pytest.fixture(autouse=True)
+    def fake_meteostat(self, monkeypatch):
+        FakeHourly.calls = []
+        monkeypatch.setattr("services.weather_services.meteostat.Stations", FakeStations)
+        monkeypatch.setattr("services.weather_services.meteostat.Hourly", FakeHourly)
+
+    def test_stream_weather_in_chunks(self):
+        location = Location(name="A location", lon="11.22", lat="22.11")
+        start, end = datetime(2023, 1, 1), datetime(2023, 1, 10, 12)
+
+        chunks = WeatherService().stream_weather_for_location(
+            location, start, end, chunk_size=timedelta(days=4)
+        )
+        first = next(chunks)
+
+        assert len(FakeHourly.calls) == 1
+        data = pd.concat([first.data] + [chunk.data for chunk in chunks])
+        assert len(FakeHourly.calls) == 3
+        assert data.index.is_unique
+        assert data.index[0] == start and data.index[-1] == end
+        assert len(data) == 9 * 24 + 13
+
+        for chunk_size in (timedelta(0), timedelta(hours=-1)):
+            with pytest.raises(Exception, match="Chunk size must be positive"):
+                next(WeatherService().stream_weather_for_location(location, start, end, chunk_size))
+
+    def test_observation_store_fetches_only_missing_hours(self, tmp_path):
+        location = Location(name="A location", lon="11.22", lat="22.11")
+        store = ObservationStore(base_dir=str(tmp_path))
+        service = WeatherService(
+            store=store,
+            revision_window=timedelta(hours=6),
+            clock=lambda: datetime(2023, 1, 10),
+        )
+
+        first = service.get_weather_for_location(
+            location, datetime(2023, 1, 1), datetime(2023, 1, 5)
+        )
+        service.get_weather_for_location(location, datetime(2023, 1, 1), datetime(2023, 1, 3))
+        latest = service.get_weather_for_location(
+            location, datetime(2023, 1, 4), datetime(2023, 1, 12)
+        )
+
+        assert FakeHourly.calls == [
+            (datetime(2023, 1, 1), datetime(2023, 1, 5)),
+            (datetime(2023, 1, 4, 18), datetime(2023, 1, 10)),
+        ]
+        assert len(first.data) == 4 * 24 + 1
+        assert first.data[WeatherParams.TEMPERATURE].iloc[-1] == 96
+        assert latest.data.index[0] == datetime(2023, 1, 4)
+        assert latest.data.index[-1] == datetime(2023, 1, 10)
+        # The revision window was fetched again and replaced the stored hours.
+        assert latest.data[WeatherParams.TEMPERATURE][datetime(2023, 1, 4, 17)] == 89
+        assert latest.data[WeatherParams.TEMPERATURE][datetime(2023, 1, 4, 18)] == 0
+        assert store.synced_period("10000") == (datetime(2023, 1, 1), datetime(2023, 1, 10))
+        assert os.path.getsize(tmp_path / "10000" / "timestamps.i8") == (9 * 24 + 1) * 8
+
+        service.get_weather_for_location(location, datetime(2022, 12, 31), datetime(2023, 1, 2))
+        assert FakeHourly.calls[-1] == (datetime(2022, 12, 31), datetime(2023, 1, 1))
+        assert store.read("10000", datetime(2022, 12, 31), datetime(2023, 1, 10)).index.is_unique
+
+    def test_observation_store_concurrent_and_torn_writes(self, tmp_path):
+        store = ObservationStore(base_dir=str(tmp_path))
+        index = pd.date_range("2023-01-01", periods=48, freq="1H")
+
+        def write(day):
+            period = index[24 * day:][:24]
+            data = pd.DataFrame({WeatherParams.TEMPERATURE: float(day)}, index=period)
+            store.write("10000", data, period[0], period[-1])
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(write, [0, 1] * 10))
+
+        data = store.read("10000", index[0], index[-1])
+        assert data.index.equals(pd.DatetimeIndex(index, name=WeatherParams.TIMESTAMP))
+        assert data[WeatherParams.TEMPERATURE].tolist() == [0.0] * 24 + [1.0] * 24
+        assert sorted(os.listdir(tmp_path / "10000")) == [
+            "meta.json",
+            "station.lock",
+            "temperature.f8",
+            "timestamps.i8",
+        ]
+
+        # Bytes of an interrupted append are ignored, then cut by the next append.
+        with open(tmp_path / "10000" / "timestamps.i8", "ab") as f:
+            f.write(b"\1" * 12)
+        assert len(store.read("10000", index[0], index[-1])) == 48
+        inode = os.stat(tmp_path / "10000" / "temperature.f8").st_ino
+        tail = pd.date_range(index[-1], periods=3, freq="1H")
+        store.write(
+            "10000",
+            pd.DataFrame({WeatherParams.TEMPERATURE: [1.0, 2.0, 2.0]}, index=tail),
+            tail[0],
+            tail[-1],
+        )
+        assert os.stat(tmp_path / "10000" / "temperature.f8").st_ino == inode
+        assert os.path.getsize(tmp_path / "10000" / "timestamps.i8") == 50 * 8
+        stored = store.read("10000", index[0], tail[-1])[WeatherParams.TEMPERATURE]
+        assert stored.tolist()[-3:] == [1.0, 2.0, 2.0]
+        # Rewriting stored rows unchanged keeps the files, changing them rewrites them.
+        write(1)
+        assert os.stat(tmp_path / "10000" / "temperature.f8").st_ino == inode
+        corrected = pd.DataFrame({WeatherParams.TEMPERATURE: 3.0}, index=index)
+        store.write("10000", corrected, index[0], index[-1])
+        assert os.stat(tmp_path / "10000" / "temperature.f8").st_ino != inode
+        assert store.read("10000", index[0], tail[-1])[WeatherParams.TEMPERATURE].tolist() == (
+            [3.0] * 48 + [2.0, 2.0]
+        )
+
+        # A crash between the renames leaves files of different lengths behind.
+        with open(tmp_path / "10000" / "temperature.f8", "ab") as f:
+            f.truncate(8 * 30)
+        assert store.synced_period("10000") is None
+        assert store.read("10000", index[0], index[-1]).empty
+        write(1)
+        assert len(store.read("10000", index[0], index[-1])) == 24
+
+
+class FakeForecastService(OpenMeteoExternalService):
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_forecast(self, location, target_timestamp, end_timestamp, extra_params, model):
+        with self._lock:
+            delay = self.delays[min(self.calls, len(self.delays) - 1)]
+            self.calls += 1
+        if delay is None:
+            raise Exception("Provider is down.")
+        if isinstance(delay, threading.Event):
+            delay.wait()
+        else:
+            time.sleep(delay)
+        return Forecast(
+            created_at=datetime(2023, 1, 1),
+            valid_at=datetime(2023, 1, 1),
+            data=pd.DataFrame({WeatherParams.TEMPERATURE: [float(self.calls)]}),
+            location=location,
+            weather_model=model,
+        )
+
+
+class TestCaseResilience:
+    kwargs = dict(
+        location=Location(name="A location", lon="11.22", lat="22.11"),
+        target_timestamp=datetime(2023, 1, 1),
+        end_timestamp=datetime(2023, 1, 2),
+        extra_params=[WeatherParams.TEMPERATURE],
+        model=ForecastModels.MODEL_ICON,
+    )
+
+    def test_circuit_breaker_states(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10, clock=lambda: now[0])
+
+        breaker.record_failure()
+        assert breaker.allow_request()
+        breaker.record_failure()
+        assert breaker.state == CircuitState.OPEN and not breaker.allow_request()
+
+        now[0] = 10.0
+        assert breaker.allow_request() and not breaker.allow_request()
+        breaker.record_failure()
+        assert breaker.state == CircuitState.OPEN
+
+        now[0] = 20.0
+        assert breaker.allow_request()
+        breaker.record_success()
+        assert breaker.state == CircuitState.CLOSED
+
+    def test_hedged_request(self):
+        # The sixth call blocks until released, only the hedged seventh call can answer.
+        release = threading.Event()
+        service = ResilientForecastService(
+            FakeForecastService([0.0] * 5 + [release, 0.0]), hedge_min_samples=5
+        )
+        for _ in range(5):
+            service.get_forecast(**self.kwargs)
+
+        forecast = service.get_forecast(**self.kwargs)
+
+        assert not release.is_set()
+        assert service.service.calls == 7
+        assert forecast.data[WeatherParams.TEMPERATURE].iloc[0] == 7
+        release.set()
+        service.shutdown()
+
+    def test_stale_fallback(self):
+        cache = ForecastCache()
+        breaker = CircuitBreaker(failure_threshold=1)
+        service = ResilientForecastService(
+            FakeForecastService([0.0, None]), breaker=breaker, cache=cache
+        )
+
+        fresh = service.get_forecast(**self.kwargs)
+        stale = service.get_forecast(**self.kwargs)
+        rejected = service.get_forecast(**self.kwargs)
+
+        assert not fresh.stale and stale.stale and rejected.stale
+        assert breaker.state == CircuitState.OPEN
+        assert service.service.calls == 2
+        with pytest.raises(Exception):
+            service.get_forecast(**{**self.kwargs, "model": ForecastModels.DEFAULT})
+        service.shutdown()
+
+
+class TestCasePrefetch:
+    location = Location(name="A location", lon="11.22", lat="22.11")
+    params = [WeatherParams.TEMPERATURE]
+
+    def test_latest_run(self):
+        schedule = ModelRunSchedule(availability_delay=timedelta(hours=4))
+
+        assert schedule.latest_run(datetime(2023, 1, 2, 9, 59)) == datetime(2023, 1, 2, 0)
+        assert schedule.latest_run(datetime(2023, 1, 2, 10)) == datetime(2023, 1, 2, 6)
+        assert schedule.latest_run(datetime(2023, 1, 2, 3)) == datetime(2023, 1, 1, 18)
+
+    def test_new_run_supersedes_cached_forecast(self):
+        external_service = FakeForecastService([0.0])
+        now = [datetime(2023, 1, 2, 9)]
+        cache = ForecastCache(clock=lambda: now[0].replace(tzinfo=timezone.utc).timestamp())
+        forecast_service = ForecastService(
+            [external_service],
+            cache=cache,
+            schedules={ForecastModels.MODEL_ICON: ModelRunSchedule()},
+            clock=lambda: now[0],
+        )
+
+        def request():
+            return forecast_service.get_forecast_for_location(
+                location=self.location,
+                extra_params=self.params,
+                target_timestamp=datetime(2023, 1, 2),
+                model=ForecastModels.MODEL_ICON,
+                external_service_name=external_service.name,
+            )
+
+        request()
+        now[0] = datetime(2023, 1, 2, 9, 59)
+        request()
+        assert external_service.calls == 1
+        # The 06 UTC run became available at 10 UTC, within cache_max_age.
+        now[0] = datetime(2023, 1, 2, 10, 30)
+        request()
+        request()
+        assert external_service.calls == 2
+
+    def test_prefetch_warms_cache(self):
+        external_service = FakeForecastService([0.0])
+        cache, tracker = ForecastCache(), HotKeyTracker()
+        forecast_service = ForecastService([external_service], cache=cache, access_tracker=tracker)
+        keys = [
+            forecast_request_key(external_service.name, self.location, model, self.params)
+            for model in (ForecastModels.MODEL_ICON, ForecastModels.DEFAULT)
+        ]
+        for key in keys:
+            tracker.pin(key)
+        now = [0.0]
+        prefetcher = Prefetcher(
+            forecast_service,
+            cache,
+            tracker,
+            RateLimiter(rate=1, burst=1, clock=lambda: now[0]),
+            schedules={model: ModelRunSchedule() for model in ForecastModels},
+        )
+
+        first = prefetcher.run_pending(datetime(2023, 1, 2, 10))
+        now[0] = 1.0
+        second = prefetcher.run_pending(datetime(2023, 1, 2, 10))
+        now[0] = 2.0
+        nothing_new = prefetcher.run_pending(datetime(2023, 1, 2, 11))
+
+        assert sorted(first + second, key=str) == sorted(keys, key=str) and len(first) == 1
+        assert nothing_new == [] and external_service.calls == 2
+
+        forecast_service.get_forecast_for_location(
+            location=self.location,
+            extra_params=self.params,
+            target_timestamp=datetime(2023, 1, 2),
+            model=ForecastModels.MODEL_ICON,
+            external_service_name=external_service.name,
+        )
+        assert external_service.calls == 2
+        assert tracker.hot_keys(min_count=1)[0] == keys[0]
+
+        now[0] = 3.0
+        assert len(prefetcher.run_pending(datetime(2023, 1, 2, 16))) == 1
+        assert external_service.calls == 3
+
+        # Forecasts cached for one target day are not served for another.
+        forecast_service.get_forecast_for_location(
+            location=self.location,
+            extra_params=self.params,
+            target_timestamp=datetime(2023, 1, 5),
+            model=ForecastModels.MODEL_ICON,
+            external_service_name=external_service.name,
+        )
+        assert external_service.calls == 4
+        assert cache.get(
+            forecast_cache_key(
+                external_service.name,
+                self.location,
+                ForecastModels.MODEL_ICON,
+                self.params,
+                datetime(2023, 1, 5, 12),
+            )
+        )
+
+
+class TestCaseProfiling:
+    def test_profiler_records_stages(self, tmp_path):
+        with stage("ignored"):
+            pass
+
+        with Profiler(sample_interval=0.001) as profiler:
+            for _ in range(2):
+                with stage("sleep"):
+                    time.sleep(0.02)
+            with stage("compute"):
+                sum(i * i for i in range(200_000))
+
+        paths = profiler.write(str(tmp_path), "run")
+
+        assert list(profiler.stage_times) == ["sleep", "compute"]
+        assert len(profiler.stage_times["sleep"]) == 2
+        assert sum(profiler.stage_times["sleep"]) >= 0.04
+        assert "compute" in open(paths["summary"]).read()
+        collapsed = open(paths["collapsed"]).read().splitlines()
+        assert collapsed and all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed)
+        assert any(line.startswith("[sleep];") for line in collapsed)
+
+    def test_profiler_stages_per_thread(self):
+        entered, left = threading.Event(), threading.Event()
+
+        def worker():
+            with stage("worker"):
+                entered.set()
+                left.wait(timeout=5)
+                time.sleep(0.02)
+
+        with Profiler(sample_interval=0.001) as profiler:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                with stage("main"):
+                    pending = executor.submit(worker)
+                    entered.wait(timeout=5)
+                    time.sleep(0.02)
+                left.set()
+                time.sleep(0.02)
+                pending.result()
+
+        assert {name: len(times) for name, times in profiler.stage_times.items()} == {
+            "main": 1,
+            "worker": 1,
+        }
+        assert not any("[worker]" in stack for stack in profiler.samples)
+        assert any(stack.startswith("[main];") for stack in profiler.samples)
+
+
+class TestCaseContainer:
+    def test_components_are_shared(self):
+        container = Container()
+
+        forecast_service = container.forecast_service
+        threads = [
+            threading.Thread(target=lambda: container.get("forecast_service")) for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert container.forecast_service is forecast_service
+        assert forecast_service.cache is container.get("forecast_cache")
+        openmeteo_service = forecast_service.get_external_service(OpenMeteoExternalService.name)
+        assert isinstance(openmeteo_service, ResilientForecastService)
+        assert openmeteo_service.service is container.get("openmeteo_service")
+        assert openmeteo_service.cache is forecast_service.cache
+        assert container.weather_service.external_service is container.get("meteostat_service")
+        assert container.weather_service.store is None
+        assert container.weather_service.qc is container.get("quality_control")
+        container.shutdown()
+        assert container.forecast_service is not forecast_service
+
+    def test_shared_repository_saves_from_threads(self, tmp_path):
+        container = Container({"pkl_repository_dir": str(tmp_path)})
+        location = Location(name="A location", lon="11.22", lat="22.11")
+
+        def save(value):
+            forecast = Forecast(
+                created_at=datetime(2023, 1, 1),
+                valid_at=datetime(2023, 1, 1),
+                data=pd.DataFrame({WeatherParams.TEMPERATURE: [float(value)]}),
+                location=location,
+                weather_model=ForecastModels.DEFAULT,
+            )
+            return container.get("forecast_repository").save_forecast(forecast).id
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            ids = list(executor.map(save, range(40)))
+
+        repository = container.get("forecast_repository")
+        assert sorted(ids) == list(range(1, 41))
+        assert repository.query_forecast_ids(ForecastQuery()) == list(range(1, 41))
+        container.shutdown()
+
+    def test_override_and_shutdown(self):
+        closed = []
+
+        class ClientStub(OpenMeteoClient):
+            def close(self):
+                closed.append(self)
+
+        container = Container()
+        stub = ClientStub(config={})
+        container.register("openmeteo_client", lambda c: stub, close=lambda client: client.close())
+        container.override("windycom_service", FakeForecastService([0.0]))
+        container.startup(["openmeteo_service", "windycom_service"])
+
+        assert container.get("openmeteo_service").client is stub
+        assert isinstance(container.get("windycom_service"), FakeForecastService)
+        with pytest.raises(Exception):
+            container.override("openmeteo_client", stub)
+
+        with container:
+            pass
+        assert closed == [stub]
+
+
+class TestCaseRideableWindows:
+    def test_find_runs(self):
+        mask = np.array([[1, 1, 0, 1], [0, 0, 0, 0], [0, 1, 1, 1]], dtype=bool)
+
+        rows, starts, ends = find_runs(mask)
+
+        assert rows.tolist() == [0, 0, 2]
+        assert starts.tolist() == [0, 3, 1]
+        assert ends.tolist() == [2, 4, 4]
+
+    def test_sector_mask(self):
+        directions = np.array([[350.0, 10, 90, 200], [350, 10, 90, 200]])
+
+        mask = sector_mask(directions, [[(315, 45), (180, 210)], []])
+
+        assert mask.tolist() == [[True, True, False, True], [True, True, True, True]]
+
+    def test_find_forecast_windows(self):
+        index = pd.date_range("2023-01-01", periods=8, freq="1H")
+
+        def forecast(name, model, speed, gusts, direction):
+            return Forecast(
+                created_at=datetime(2023, 1, 1),
+                valid_at=datetime(2023, 1, 1),
+                data=pd.DataFrame(
+                    {
+                        WeatherParams.WIND_SPEED: speed,
+                        WeatherParams.WIND_GUSTS: gusts,
+                        WeatherParams.WIND_DIRECTION: direction,
+                    },
+                    index=index,
+                ),
+                location=Location(name=name, lon="0", lat="0"),
+                weather_model=model,
+            )
+
+        forecasts = [
+            forecast(
+                "Valencia",
+                ForecastModels.MODEL_ICON,
+                [5, 15, 16, 18, 14, 30, 16, 17],
+                [8, 18, 20, 22, 18, 60, 18, 19],
+                [90] * 8,
+            ),
+            forecast(
+                "Tarifa",
+                ForecastModels.DEFAULT,
+                [20] * 8,
+                [25] * 8,
+                [270, 270, 270, 90, 90, 90, 270, 270],
+            ),
+        ]
+
+        windows = find_forecast_windows(
+            forecasts,
+            index,
+            RideRules(min_speed=12, max_speed=35, max_gust_factor=1.5),
+            sectors={"Tarifa": [(60, 120)]},
+            skill={("Valencia", "icon"): 0.5, ("Tarifa", "default"): 0.8},
+        )
+
+        assert windows["location"].tolist() == ["Tarifa", "Valencia", "Valencia"]
+        assert windows["start"].tolist() == [index[3], index[1], index[6]]
+        assert windows["duration"].tolist() == [pd.Timedelta(hours=h) for h in (3, 4, 2)]
+        assert windows["mean_speed"].tolist() == [20, 15.75, 16.5]
+        assert windows["max_gust"].tolist() == [25, 22, 19]
+
+
+class StubGridClient:
+    def __init__(self):
+        self.calls = 0
+
+    def get_forecast_points_data(self, lons, lats, params, model):
+        self.calls += 1
+        times = ["2023-05-01T00:00", "2023-05-01T01:00"]
+        return [
+            {
+                "time": times,
+                "temperature_2m": [10 * lat + lon, 10 * lat + lon + 1],
+                "winddirection_10m": [350.0 if lon < 0.5 else 10.0] * 2,
+            }
+            for lat, lon in zip(lats, lons)
+        ]
+
+
+class TestCaseGridForecast:
+    params = [WeatherParams.TEMPERATURE, WeatherParams.WIND_DIRECTION]
+
+    def test_bilinear_interpolation(self):
+        region = GridSpec(lat_min=40.0, lat_max=41.0, lon_min=0.0, lon_max=1.0, step=0.5)
+        grid = OpenMeteoGridSource(StubGridClient()).fetch(
+            region, self.params, ForecastModels.DEFAULT
+        )
+        assert grid.values.shape == (2, 2, 3, 3)
+
+        values = grid.interpolate([40.25, 40.9, 42.0], [0.25, 0.75, 0.5])
+        assert values.shape == (3, 2, 2)
+        assert np.allclose(values[0, 0], [402.75, 403.75])
+        assert np.allclose(values[1, 0], [409.75, 410.75])
+        # Directions 350 and 10 blend across north instead of through 180.
+        assert np.isclose(np.cos(np.radians(values[0, 1, 0])), 1.0)
+        assert np.isnan(values[2]).all()
+
+    def test_interpolation_skips_nan_corner(self):
+        region = GridSpec(lat_min=40.0, lat_max=41.0, lon_min=0.0, lon_max=1.0, step=0.5)
+        grid = OpenMeteoGridSource(StubGridClient()).fetch(
+            region, self.params, ForecastModels.DEFAULT
+        )
+        grid.values[0, :, 2, 0] = np.nan
+
+        values = grid.interpolate([40.5, 40.5, 40.75, 41.0], [0.0, 0.25, 0.25, 0.0])
+        assert values[:3, 0, 0].tolist() == pytest.approx([405.0, 405.25, 407.0])
+        assert np.isnan(values[3, 0]).all()
+
+    def test_refresh_keeps_loaded_grid(self, tmp_path):
+        region = GridSpec(lat_min=40.0, lat_max=41.0, lon_min=0.0, lon_max=1.0, step=0.5)
+        grid = OpenMeteoGridSource(StubGridClient()).fetch(
+            region, self.params, ForecastModels.DEFAULT
+        )
+        grid.save(str(tmp_path))
+        loaded = GriddedForecast.load(str(tmp_path))
+        expected = np.array(loaded.values)
+
+        grid.values = grid.values + 1
+        grid.save(str(tmp_path))
+
+        assert isinstance(loaded.values, np.memmap)
+        assert np.array_equal(loaded.values, expected)
+        assert np.array_equal(GriddedForecast.load(str(tmp_path)).values, expected + 1)
+        with open(tmp_path / "current") as f:
+            version = f.read()
+        assert sorted(os.listdir(tmp_path)) == ["current", version]
+        assert sorted(os.listdir(tmp_path / version)) == ["meta.json", "values.npy"]
+
+    def test_load_sees_matching_values_and_meta(self, tmp_path):
+        source = OpenMeteoGridSource(StubGridClient())
+        grids = [
+            source.fetch(GridSpec(40.0, 41.0, 0.0, 1.0, step=step), self.params, model)
+            for step, model in ((0.5, ForecastModels.DEFAULT), (0.25, ForecastModels.MODEL_ICON))
+        ]
+        grids[0].save(str(tmp_path))
+        done = threading.Event()
+
+        def save():
+            for position in range(40):
+                grids[position % 2].save(str(tmp_path))
+            done.set()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            saving = executor.submit(save)
+            while not done.is_set():
+                loaded = GriddedForecast.load(str(tmp_path), mmap=False)
+                expected = grids[loaded.weather_model == ForecastModels.MODEL_ICON]
+                assert np.array_equal(loaded.lons, expected.lons)
+                assert np.array_equal(loaded.values, expected.values)
+            saving.result()
+
+    def test_second_spot_reuses_grid(self, tmp_path):
+        client = StubGridClient()
+        region = GridSpec(lat_min=40.0, lat_max=41.0, lon_min=0.0, lon_max=1.0, step=0.5)
+        service = GridForecastService(
+            OpenMeteoGridSource(client), [region], cache_dir=str(tmp_path)
+        )
+        end = datetime(2023, 5, 2)
+        first = service.get_forecast(
+            Location(lat="40.5", lon="0.5", name="A"),
+            None,
+            end,
+            self.params,
+            ForecastModels.DEFAULT,
+        )
+        second = service.get_forecast(
+            Location(lat="40.75", lon="0.25", name="B"),
+            None,
+            end,
+            self.params,
+            ForecastModels.DEFAULT,
+        )
+        assert client.calls == 1
+        assert first.data[WeatherParams.TEMPERATURE].tolist() == pytest.approx([405.5, 406.5])
+        assert second.data[WeatherParams.TEMPERATURE].tolist() == pytest.approx([407.75, 408.75])
+
+        with pytest.raises(Exception):
+            service.get_forecast(
+                Location(lat="50", lon="0", name="C"),
+                None,
+                end,
+                self.params,
+                ForecastModels.DEFAULT,
+            )
+
+    def test_slow_fetch_does_not_block_other_regions(self):
+        source = OpenMeteoGridSource(StubGridClient())
+        slow = GridSpec(lat_min=40.0, lat_max=41.0, lon_min=0.0, lon_max=1.0, step=0.5)
+        fast = GridSpec(lat_min=50.0, lat_max=51.0, lon_min=0.0, lon_max=1.0, step=0.5)
+        started, release = threading.Event(), threading.Event()
+        fetch = source.fetch
+
+        def blocking_fetch(spec, params, model):
+            if spec == slow:
+                started.set()
+                release.wait(timeout=5)
+            return fetch(spec, params, model)
+
+        source.fetch = blocking_fetch
+        service = GridForecastService(source, [slow, fast])
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(service.get_grid, slow, self.params, ForecastModels.DEFAULT)
+            assert started.wait(timeout=5)
+            assert service.get_grid(fast, self.params, ForecastModels.DEFAULT).lats[0] == 50.0
+            assert not pending.done()
+            release.set()
+            assert pending.result(timeout=5).lats[0] == 40.0
+
+
+class TestCaseEnsembleBlending:
+    def test_blend_arrays(self):
+        values = np.array([[[[10.0, 350.0]], [[20.0, 10.0]]]])
+        mse = np.array([[[[1.0, 1.0]], [[4.0, 1.0]]]])
+
+        mean, spread, uncertainty = blend_arrays(values, mse, np.array([False, True]))
+        assert mean.shape == (1, 1, 2)
+        assert mean[0, 0, 0] == pytest.approx(12.0)
+        assert spread[0, 0, 0] == pytest.approx(4.0)
+        assert uncertainty[0, 0, 0] == pytest.approx(np.sqrt(16 + 0.8))
+        assert np.cos(np.radians(mean[0, 0, 1])) == pytest.approx(1.0)
+
+        values[0, 1] = np.nan
+        mean, spread, _ = blend_arrays(values, mse, np.array([False, True]))
+        assert mean[0, 0].tolist() == pytest.approx([10.0, 350.0])
+        assert spread[0, 0, 0] == pytest.approx(0.0)
+
+    def test_blender(self):
+        param = WeatherParams.WIND_SPEED
+        created_at = datetime(2023, 5, 1)
+        index = pd.date_range(created_at, periods=12, freq="1H", tz="UTC")
+        location = Location(lon="0", lat="0", name="Spot")
+
+        def forecast(name, value, created=created_at):
+            return Forecast(
+                data=pd.DataFrame({param: np.full(12, float(value))}, index=index),
+                location=Location(lon="0", lat="0", name=name),
+                created_at=created,
+                valid_at=created,
+                weather_model=ForecastModels.DEFAULT,
+            )
+
+        observed = pd.DataFrame({param: np.full(12, 10.0)}, index=index)
+        observations = {"Spot": WeatherData(observed, location)}
+        history = {("Spot", "a"): [forecast("Spot", 11)], ("Spot", "b"): [forecast("Spot", 13)]}
+        weights = BlendWeights.fit(history, observations, [param], lead_edges=(0, 6))
+        assert weights.mse[0, :, :, 0].tolist() == [[1.0, 1.0], [9.0, 9.0]]
+
+        blender = EnsembleBlender(weights)
+        current = {
+            ("Spot", "a"): forecast("Spot", 20),
+            ("Spot", "b"): forecast("Spot", 30),
+            ("Other", "a"): forecast("Other", 20),
+            ("Other", "b"): forecast("Other", 30),
+        }
+        blended = blender.blend(current)
+        assert blended["Spot"].weather_model == ForecastModels.BLEND
+        assert blended["Spot"].data[param].tolist() == pytest.approx([21.0] * 12)
+        assert blended["Spot"].data["wind_speed_spread"].iloc[0] == pytest.approx(3.0)
+        # Spots without history blend with equal weights.
+        assert blended["Other"].data[param].tolist() == pytest.approx([25.0] * 12)
+
+        assert blender.blend(current)["Spot"] is blended["Spot"]
+        current[("Spot", "a")] = forecast("Spot", 20, created=created_at + timedelta(hours=6))
+        assert blender.blend(current)["Spot"] is not blended["Spot"]
+
+
+class TestCaseArrowExport:
+    index = pd.date_range(
+        "2023-05-01", periods=6, freq="1H", tz="UTC", name=WeatherParams.TIMESTAMP
+    )
+
+    @pytest.fixture()
+    def forecast(self):
+        return Forecast(
+            id=7,
+            data=pd.DataFrame(
+                {
+                    WeatherParams.WIND_SPEED: np.arange(6, dtype=float),
+                    WeatherParams.WIND_DIRECTION: np.full(6, 270.0),
+                },
+                index=self.index,
+            ),
+            location=Location(lon="-5.6", lat="36.0", name="Tarifa"),
+            created_at=datetime(2023, 5, 1),
+            valid_at=datetime(2023, 5, 1),
+            weather_model=ForecastModels.MODEL_ICON,
+        )
+
+    @pytest.fixture()
+    def observations(self):
+        return WeatherData(
+            data=pd.DataFrame({WeatherParams.TEMPERATURE: np.arange(6, dtype=float)}, self.index),
+            location=Location(lon="-5.6", lat="36.0", name="Tarifa station"),
+        )
+
+    def test_feather_roundtrip(self, tmp_path, forecast, observations):
+        path = str(tmp_path / "export.arrow")
+        write_feather(path, iter([forecast, observations]))
+
+        table = read_feather(path)
+        assert table.schema.equals(arrow_io.SCHEMA, check_metadata=True)
+        assert table.num_rows == 12
+        assert table.schema.field("wind_speed").metadata == {b"unit": b"kn"}
+
+        restored_forecast, restored_observations = to_weather_data(table)
+        assert restored_forecast == forecast
+        pd.testing.assert_frame_equal(
+            restored_observations.data, observations.data, check_freq=False
+        )
+
+        write_feather(path, forecast)
+        metadata = read_feather(path).schema.metadata
+        assert json.loads(metadata[b"location"])["name"] == "Tarifa"
+        assert metadata[b"weather_model"] == b"icon"
+        assert metadata[b"created_at"] == b"2023-05-01T00:00:00+00:00"
+
+    def test_socket_and_http_streaming(self, forecast, observations):
+        sender, receiver = socket.socketpair()
+        thread = threading.Thread(target=send_stream, args=(sender, [forecast, observations]))
+        thread.start()
+        received = list(read_stream(receiver.makefile("rb")))
+        thread.join()
+        sender.close()
+        receiver.close()
+        assert [type(item) for item in received] == [Forecast, WeatherData]
+        assert received[0] == forecast
+
+        requests_seen = []
+
+        def get_items(path, query):
+            requests_seen.append((path, query))
+            return iter([forecast] * int(query["n"][0]))
+
+        server = ArrowStreamServer(("127.0.0.1", 0), get_items)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/forecasts?n=3"
+            with urllib.request.urlopen(url) as response:
+                assert response.headers["Content-Type"] == arrow_io.MEDIA_TYPE
+                streamed = list(read_stream(response))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        assert requests_seen == [("/forecasts", {"n": ["3"]})]
+        assert len(streamed) == 3
+        assert all(item == forecast for item in streamed)
+
+
+class TestCaseDownsampling:
+    @pytest.fixture()
+    def series(self):
+        x = np.arange(10_000, dtype=float)
+        y = np.sin(x / 500) * 10 + 15
+        y[4321] = 60.0  # A gust.
+        y[50] = np.nan
+        return x, y
+
+    def test_min_max_keeps_peaks_and_ends(self, series):
+        x, y = series
+        groups = np.repeat(["weather", "forecast"], 5_000)
+        kept = min_max_indices(x, y, 100, groups)
+
+        assert len(kept) <= 2 * 4 * 100
+        assert np.all(np.diff(kept) > 0)
+        assert {0, 4321, 4999, 5000, 9999} <= set(kept)
+        assert 50 not in kept
+        assert y[kept].max() == 60.0
+        assert y[kept].min() == np.nanmin(y)
+
+    def test_plot_downsampled(self, tmp_path, monkeypatch, series):
+        monkeypatch.setattr("plotting.PLOTS_DIR", str(tmp_path))
+        index = pd.date_range("2023-01-01", periods=10_000, freq="10min", name="timestamp")
+        data = pd.DataFrame({WeatherParams.WIND_GUSTS: series[1], "type": "historical"}, index)
+
+        reduced = downsample_frame(
+            data.reset_index(), WeatherParams.TIMESTAMP, WeatherParams.WIND_GUSTS, 400
+        )
+        assert len(reduced) <= 400
+        assert reduced[WeatherParams.WIND_GUSTS].max() == 60.0
+
+        # Data read back from delta or Arrow storage is indexed by UTC timestamps.
+        aware = data.tz_localize("UTC").reset_index()
+        aware_reduced = downsample_frame(
+            aware, WeatherParams.TIMESTAMP, WeatherParams.WIND_GUSTS, 400
+        )
+        assert aware_reduced.index.equals(reduced.index)
+        with pytest.raises(Exception, match="Unknown downsampling method"):
+            downsample_frame(aware, WeatherParams.TIMESTAMP, WeatherParams.WIND_GUSTS, 400, "lttb")
+
+        weather_data = WeatherData(data=data.set_index("type", append=True), location=None)
+        plot_weather_data_as_jpg(
+            weather_data, WeatherParams.WIND_GUSTS, "plot.jpg", downsample=MIN_MAX
+        )
+        assert (tmp_path / "plot.jpg").stat().st_size > 0
+
+
+class TestCaseQualityControl:
+    params = [WeatherParams.TEMPERATURE, WeatherParams.WIND_SPEED, WeatherParams.WIND_DIRECTION]
+
+    def test_check_arrays(self):
+        steps = np.arange(48, dtype=float)
+        values = np.empty((2, 48, 3))
+        values[:, :, 0] = 10 + steps * 0.1
+        values[:, :, 1] = 0.0
+        values[:, :, 2] = steps * 7 % 360
+        values[0, 10, 0] += 20  # Spike.
+        values[0, 20, 0] = 99.0  # Out of range.
+        values[0, 30:32, 0] = np.nan  # Short gap.
+        values[0, 35:41, 0] = np.nan  # Long gap.
+        values[0, 29:32, 2] = [350.0, np.nan, 10.0]
+        values[1, 5:25, 0] = 15.0  # Stuck.
+        values[1, 40:, 0] += 15  # Step.
+
+        cleaned, flags = QualityControl().check(values, self.params)
+
+        assert flags.dtype == np.uint8
+        # Rejected values are removed and filled like any other gap.
+        assert flags[0, 10, 0] == QCFlags.SPIKE | QCFlags.GAP_FILLED
+        assert np.isclose(cleaned[0, 10, 0], 11.0) and flags[0, 11, 0] == 0
+        assert flags[0, 20, 0] == QCFlags.OUT_OF_RANGE | QCFlags.GAP_FILLED
+        assert np.isclose(cleaned[0, 20, 0], 12.0)
+        assert (flags[0, 30:32, 0] == QCFlags.MISSING | QCFlags.GAP_FILLED).all()
+        assert np.allclose(cleaned[0, 30:32, 0], [13.0, 13.1])
+        assert (flags[0, 35:41, 0] == QCFlags.MISSING).all()
+        assert np.isnan(cleaned[0, 35:41, 0]).all()
+        assert np.cos(np.radians(cleaned[0, 30, 2])) == pytest.approx(1.0)
+        assert (flags[1, 5:25, 0] == QCFlags.STUCK).all() and flags[1, 4, 0] == 0
+        assert flags[1, 40, 0] == QCFlags.STEP | QCFlags.GAP_FILLED
+        assert (flags[1, 41:, 0] == 0).all()
+        # Calm wind may stay unchanged.
+        assert (flags[:, :, 1] == 0).all()
+
+    def test_check_frames(self):
+        index = pd.DatetimeIndex(
+            ["2023-01-01 00:00", "2023-01-01 01:00", "2023-01-01 01:00", "2023-01-01 03:00"],
+            name=WeatherParams.TIMESTAMP,
+        )
+        frame = pd.DataFrame({WeatherParams.TEMPERATURE: [10.0, 11.0, 30.0, 13.0]}, index)
+        other = pd.DataFrame(
+            {WeatherParams.TEMPERATURE: [5.0, 5.5]},
+            pd.date_range("2023-01-01 02:00", periods=2, freq="1H", tz="UTC"),
+        )
+
+        (data, flags), (other_data, _) = QualityControl().check_frames([frame, other])
+        assert data.index.tz is None and data.index.is_unique
+        assert data[WeatherParams.TEMPERATURE].tolist() == [10.0, 11.0, 12.0, 13.0]
+        assert flags[WeatherParams.TEMPERATURE].tolist() == [
+            0,
+            QCFlags.DUPLICATE,
+            QCFlags.MISSING | QCFlags.GAP_FILLED,
+            0,
+        ]
+        assert other_data.index[0] == pd.Timestamp("2023-01-01 02:00", tz="UTC")
+        assert len(other_data) == 2
+
+        # Off-grid timestamps are snapped, alone or in a batch alike.
+        offset = frame.set_axis(frame.index + pd.Timedelta(minutes=30))
+        ((alone, alone_flags),) = QualityControl().check_frames([offset])
+        (batched, batched_flags), _ = QualityControl().check_frames([offset, other])
+        assert alone[WeatherParams.TEMPERATURE].tolist() == [10.0, 11.0, 12.0, 13.0]
+        assert alone.equals(batched) and alone_flags.equals(batched_flags)
+        assert alone.index.equals(data.index)
+
+        location = Location(name="A location", lon="11.22", lat="22.11")
+        checked, _ = QualityControl().check_weather_data(WeatherData(frame, location))
+        assert checked.location == location and len(checked.data) == 4
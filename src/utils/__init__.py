@@ -1 +1,2 @@
 from .injection_dict import InjectionDict, create_bijection_dict  # noqa: F401
+from .spatial import GridIndex, haversine_km  # noqa: F401
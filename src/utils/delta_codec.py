@@ -0,0 +1,121 @@
+"""
+Codec storing a table of runs as quantized deltas against the previous run.
+
+A run is a set of float columns over int64 timestamps. Values are quantized to
+integers (value / precision), rows are matched to the previous run by timestamp
+and only the difference is kept, so unchanged values become zeros that compress
+to almost nothing. Keyframes hold the quantized values themselves.
+"""
+import json
+import lzma
+import struct
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+_HEADER = struct.Struct("<I")
+_KEYFRAME = b"K"
+_DELTA = b"D"
+
+
+@dataclass
+class Run:
+    #: Row timestamps, sorted int64.
+    timestamps: np.ndarray
+    #: Quantized values, int64 array of shape (len(timestamps), n_columns).
+    values: np.ndarray
+    #: NaN mask of the values.
+    missing: np.ndarray
+    #: Arbitrary JSON serializable metadata.
+    meta: dict
+
+
+def quantize(values: np.ndarray, precisions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    missing = np.isnan(values)
+    quantized = np.rint(np.where(missing, 0.0, values) / precisions).astype(np.int64)
+    return quantized, missing
+
+
+def dequantize(run: Run, precisions: np.ndarray) -> np.ndarray:
+    return np.where(run.missing, np.nan, run.values * precisions)
+
+
+def _reference(run: Run, previous: Optional[Run]) -> np.ndarray:
+    """
+    Values of the previous run at the timestamps of run, zero where it has none.
+    """
+    reference = np.zeros_like(run.values)
+    if previous is None or len(previous.timestamps) == 0:
+        return reference
+    positions = np.searchsorted(previous.timestamps, run.timestamps)
+    positions = np.clip(positions, 0, len(previous.timestamps) - 1)
+    matched = previous.timestamps[positions] == run.timestamps
+    reference[matched] = previous.values[positions[matched]]
+    return reference
+
+
+def _pack(arrays: dict[str, np.ndarray], meta: dict) -> bytes:
+    header = {"meta": meta, "arrays": []}
+    chunks = []
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header["arrays"].append({"name": name, "dtype": array.dtype.str, "shape": array.shape})
+        chunks.append(array.tobytes())
+    header_bytes = json.dumps(header).encode()
+    return lzma.compress(_HEADER.pack(len(header_bytes)) + header_bytes + b"".join(chunks))
+
+
+def _unpack(payload: bytes) -> tuple[dict[str, np.ndarray], dict]:
+    raw = lzma.decompress(payload)
+    (header_size,) = _HEADER.unpack_from(raw)
+    start, offset = _HEADER.size, _HEADER.size + header_size
+    header = json.loads(raw[start:offset])
+    arrays = {}
+    for spec in header["arrays"]:
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        arrays[spec["name"]] = np.frombuffer(raw, dtype, count, offset).reshape(spec["shape"])
+        offset += count * dtype.itemsize
+    return arrays, header["meta"]
+
+
+def encode(run: Run, previous: Optional[Run] = None) -> bytes:
+    """
+    Encode run, as a delta against previous or as a keyframe if previous is None.
+    """
+    values = run.values - _reference(run, previous)
+    dtype = np.int16 if values.size and np.abs(values).max() < 2**15 else np.int32
+    arrays = {
+        "timestamps": np.diff(run.timestamps, prepend=np.int64(0)),
+        "values": values.astype(dtype),
+        "missing": np.packbits(run.missing, axis=None),
+    }
+    return (_KEYFRAME if previous is None else _DELTA) + _pack(arrays, run.meta)
+
+
+def is_keyframe(payload: bytes) -> bool:
+    return payload[:1] == _KEYFRAME
+
+
+def decode(payload: bytes, previous: Optional[Run] = None) -> Run:
+    """
+    Decode payload; delta payloads need the decoded previous run.
+    """
+    keyframe = is_keyframe(payload)
+    arrays, meta = _unpack(payload[1:])
+    if not keyframe and previous is None:
+        raise Exception("Delta encoded run requires the previous run to decode.")
+
+    timestamps = np.cumsum(arrays["timestamps"]).astype(np.int64)
+    shape = arrays["values"].shape
+    missing = np.unpackbits(arrays["missing"], count=int(np.prod(shape))).reshape(shape)
+    run = Run(
+        timestamps=timestamps,
+        values=arrays["values"].astype(np.int64),
+        missing=missing.astype(bool),
+        meta=meta,
+    )
+    if not keyframe:
+        run.values += _reference(run, previous)
+    return run
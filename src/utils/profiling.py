@@ -0,0 +1,149 @@
+"""
+Opt-in profiling of script runs.
+
+    with Profiler() as profiler:
+        with stage("fetch"):
+            ...
+    print(profiler.summary())
+
+stage() can be used anywhere in the code base, it only records when a Profiler
+is active. Besides wall time per stage, a Profiler collects cProfile statistics
+and samples the call stack of the profiled thread, written as collapsed stacks
+("root;caller;callee count" lines) understood by flamegraph.pl and speedscope.
+"""
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Iterator, Optional
+
+PROFILE_ENV_VARIABLE = "FF_PROFILE"
+
+_active_profiler: Optional["Profiler"] = None
+
+
+def profiling_requested(argv_flag: bool = False) -> bool:
+    return argv_flag or os.environ.get(PROFILE_ENV_VARIABLE, "").lower() in ("1", "true", "yes")
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    if _active_profiler is None:
+        yield
+        return
+    with _active_profiler.stage(name):
+        yield
+
+
+class Profiler:
+    def __init__(self, sample_interval: float = 0.005):
+        self.sample_interval = sample_interval
+        #: Wall times in seconds of every run of a stage, in order of first use.
+        self.stage_times: dict[str, list[float]] = {}
+        self.samples: Counter = Counter()
+        self._profile = cProfile.Profile()
+        #: Stage stack of the current thread; stages run on worker threads as well.
+        self._local = threading.local()
+        #: Stage stacks by thread id, read by the sampler.
+        self._stacks: dict[int, list[str]] = {}
+        self._lock = threading.Lock()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._started_at = 0.0
+        self.wall_time = 0.0
+
+    def __enter__(self) -> "Profiler":
+        global _active_profiler
+        if _active_profiler is not None:
+            raise Exception("Another profiler is already active.")
+        _active_profiler = self
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+        self._started_at = time.perf_counter()
+        self._sampler.start()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _active_profiler
+        self._profile.disable()
+        self.wall_time = time.perf_counter() - self._started_at
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        _active_profiler = None
+
+    def _stages(self) -> list[str]:
+        stages = getattr(self._local, "stages", None)
+        if stages is None:
+            stages = self._local.stages = []
+            with self._lock:
+                self._stacks[threading.get_ident()] = stages
+        return stages
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        stages = self._stages()
+        stages.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            stages.pop()
+            with self._lock:
+                self.stage_times.setdefault(name, []).append(elapsed)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self._thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            with self._lock:
+                stages = [f"[{name}]" for name in self._stacks.get(self._thread_id, [])]
+            self.samples[";".join(stages + frames[::-1])] += 1
+
+    def summary(self, top: int = 15) -> str:
+        lines = [f"Total wall time: {self.wall_time:.3f} s", ""]
+        lines.append(f"{'stage':<40} {'calls':>6} {'total [s]':>10} {'mean [s]':>10} {'share':>7}")
+        for name, times in self.stage_times.items():
+            total = sum(times)
+            share = total / self.wall_time if self.wall_time else 0.0
+            lines.append(
+                f"{name:<40} {len(times):>6} {total:>10.3f} {total / len(times):>10.3f} "
+                f"{share:>7.1%}"
+            )
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        lines += ["", stream.getvalue()]
+        return "\n".join(lines)
+
+    def write(self, output_dir: str, name: str) -> dict[str, str]:
+        """
+        Write the summary table, pstats dump and collapsed stacks and return their paths.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        paths = {
+            "summary": os.path.join(output_dir, f"{name}.txt"),
+            "pstats": os.path.join(output_dir, f"{name}.prof"),
+            "collapsed": os.path.join(output_dir, f"{name}.collapsed"),
+        }
+        with open(paths["summary"], "w") as f:
+            f.write(self.summary())
+        self._profile.dump_stats(paths["pstats"])
+        with open(paths["collapsed"], "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return paths
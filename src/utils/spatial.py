@@ -0,0 +1,147 @@
+"""
+Spatial helpers for querying large sets of points on the globe.
+
+Points are bucketed into a regular lat/lon grid and kept sorted by cell id,
+so every query only touches the cells overlapping its bounding box.
+"""
+import math
+from typing import Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """
+    Great-circle distance in kilometers, broadcast over numpy arrays.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class GridIndex:
+    """
+    Static grid index over (lat, lon) points.
+
+    Query methods return positions into the arrays the index was built from.
+    """
+
+    def __init__(self, lats, lons, cell_size: float = 1.0):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        if self.lats.shape != self.lons.shape or self.lats.ndim != 1:
+            raise ValueError("lats and lons must be 1-D arrays of the same length.")
+
+        self.cell_size = cell_size
+        self._n_rows = math.ceil(180 / cell_size)
+        self._n_cols = math.ceil(360 / cell_size)
+
+        cell_ids = self._row(self.lats) * self._n_cols + self._col(self.lons)
+        self._order = np.argsort(cell_ids, kind="stable")
+        self._sorted_cells = cell_ids[self._order]
+
+    def __len__(self) -> int:
+        return len(self.lats)
+
+    def _row(self, lat):
+        return np.clip(((np.asarray(lat) + 90) // self.cell_size).astype(int), 0, self._n_rows - 1)
+
+    def _col(self, lon):
+        return np.clip(((np.asarray(lon) + 180) // self.cell_size).astype(int), 0, self._n_cols - 1)
+
+    def _candidates(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+        """
+        Positions of all points in cells overlapping the box (min_lon <= max_lon).
+        """
+        col_start, col_end = int(self._col(min_lon)), int(self._col(max_lon))
+        chunks = []
+        for row in range(int(self._row(min_lat)), int(self._row(max_lat)) + 1):
+            first = row * self._n_cols
+            start = np.searchsorted(self._sorted_cells, first + col_start, side="left")
+            end = np.searchsorted(self._sorted_cells, first + col_end, side="right")
+            if end > start:
+                chunks.append(self._order[start:end])
+        if not chunks:
+            return np.empty(0, dtype=int)
+        return np.concatenate(chunks)
+
+    def query_bbox(
+        self, min_lat: float, min_lon: float, max_lat: float, max_lon: float
+    ) -> np.ndarray:
+        """
+        Positions of points inside the box. A box with min_lon > max_lon
+        wraps around the antimeridian.
+        """
+        if min_lon > max_lon:
+            candidates = np.concatenate(
+                [
+                    self._candidates(min_lat, min_lon, max_lat, 180.0),
+                    self._candidates(min_lat, -180.0, max_lat, max_lon),
+                ]
+            )
+            lons = self.lons[candidates]
+            lon_mask = (lons >= min_lon) | (lons <= max_lon)
+        else:
+            candidates = self._candidates(min_lat, min_lon, max_lat, max_lon)
+            lons = self.lons[candidates]
+            lon_mask = (lons >= min_lon) & (lons <= max_lon)
+
+        lats = self.lats[candidates]
+        mask = lon_mask & (lats >= min_lat) & (lats <= max_lat)
+        return np.sort(candidates[mask])
+
+    def query_radius(
+        self, lat: float, lon: float, radius_km: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Positions and distances of points within radius_km, nearest first.
+        """
+        dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+        cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+        if cos_lat <= 1e-9 or dlat / cos_lat >= 180:
+            candidates = self._candidates(min_lat, -180.0, max_lat, 180.0)
+        else:
+            dlon = dlat / cos_lat
+            min_lon, max_lon = lon - dlon, lon + dlon
+            if min_lon < -180 or max_lon > 180:
+                candidates = self.query_bbox(
+                    min_lat, (min_lon + 540) % 360 - 180, max_lat, (max_lon + 540) % 360 - 180
+                )
+            else:
+                candidates = self._candidates(min_lat, min_lon, max_lat, max_lon)
+
+        distances = haversine_km(lat, lon, self.lats[candidates], self.lons[candidates])
+        mask = distances <= radius_km
+        candidates, distances = candidates[mask], distances[mask]
+        order = np.argsort(distances, kind="stable")
+        return candidates[order], distances[order]
+
+    def query_nearest(self, lat: float, lon: float, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Positions and distances of the k nearest points, nearest first.
+
+        The search radius grows until it holds k points, which is exact
+        because query_radius returns every point inside the radius.
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=int), np.empty(0)
+
+        radius_km = self.cell_size * 111.0
+        while radius_km < math.pi * EARTH_RADIUS_KM:
+            positions, distances = self.query_radius(lat, lon, radius_km)
+            if len(positions) >= k:
+                return positions[:k], distances[:k]
+            radius_km *= 2
+
+        distances = haversine_km(lat, lon, self.lats, self.lons)
+        positions = np.argsort(distances, kind="stable")[:k]
+        return positions, distances[positions]